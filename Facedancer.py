@@ -1,15 +1,28 @@
 # Facedancer.py
 #
-# Contains class definitions for Facedancer, FacedancerCommand, FacedancerApp,
-# and GoodFETMonitorApp.
+# Contains class definitions for Facedancer, FacedancerCommand,
+# FacedancerFuture, FacedancerApp, and GoodFETMonitorApp.
 
 from util import *
 
 class Facedancer:
+    # number of commands that may be in flight before submitcmd() forces a
+    # flush; keeps us well inside the firmware's serial receive buffer
+    max_pipeline_depth = 32
+
     def __init__(self, serialport, verbose=0):
         self.serialport = serialport
         self.verbose = verbose
 
+        # commands submitted but not yet written, and commands written whose
+        # responses have not yet been read back
+        self.queued = []
+        self.in_flight = []
+
+        # running total of commands issued, used to tell idle polls apart
+        # from polls that led to real work
+        self.commands_sent = 0
+
         self.reset()
         self.monitor_app = GoodFETMonitorApp(self, verbose=self.verbose)
         self.monitor_app.announce_connected()
@@ -79,11 +92,102 @@ class Facedancer:
 
     def writecmd(self, c):
         """Write a single command."""
+
+        # anything still queued must reach the board first, and its responses
+        # must be drained before the caller's readcmd() sees its own
+        if self.queued or self.in_flight:
+            self.flushcmds()
+
         self.write(c.as_bytestring())
+        self.commands_sent += 1
 
         if self.verbose > 1:
             print("Facedancer Tx command:", c)
 
+    def wait_for_irq(self, timeout):
+        """Block until the board signals a pending USB interrupt.
+
+        Returns True when an interrupt may be pending, False if none arrived
+        within timeout seconds, or None if the transport cannot notify us (in
+        which case the caller must fall back to polling)."""
+
+        wait = getattr(self.serialport, "wait_for_irq", None)
+        if wait is None:
+            return None
+
+        self.flushcmds()
+
+        return wait(timeout)
+
+    def submitcmd(self, c, callback=None):
+        """Queue a command for pipelined execution; returns a FacedancerFuture.
+
+        The command is serialized immediately, so callers may reuse and
+        modify the FacedancerCommand object after submitting it.  Responses
+        are matched to commands in submission order."""
+
+        future = FacedancerFuture(self, c, callback)
+        self.queued.append((c.as_bytestring(), future))
+        self.commands_sent += 1
+
+        if self.verbose > 1:
+            print("Facedancer queued command:", c)
+
+        if len(self.queued) + len(self.in_flight) >= self.max_pipeline_depth:
+            self.flushcmds()
+
+        return future
+
+    def sendcmds(self):
+        """Stream all queued commands to the board in a single write."""
+
+        if not self.queued:
+            return
+
+        b = bytearray()
+        for cmd_bytes, future in self.queued:
+            b += cmd_bytes
+            self.in_flight.append(future)
+
+        self.queued = []
+        self.write(b)
+
+    def flushcmds(self):
+        """Send any queued commands and read back every outstanding response,
+        resolving their futures in order."""
+
+        self.sendcmds()
+
+        while self.in_flight:
+            future = self.in_flight.pop(0)
+            future.set_response(self.readcmd())
+
+
+class FacedancerFuture:
+    """Response placeholder for a command submitted with submitcmd()."""
+
+    def __init__(self, device, cmd, callback=None):
+        self.device = device
+        self.cmd = cmd
+        self.callback = callback
+        self.response = None
+        self.done = False
+
+    def set_response(self, resp):
+        self.response = resp
+        self.done = True
+
+        if self.callback:
+            self.callback(resp)
+
+    def result(self):
+        """Return the response, flushing the pipeline if it has not arrived."""
+
+        if not self.done:
+            self.device.flushcmds()
+
+        return self.response
+
 
 class FacedancerCommand:
     def __init__(self, app=None, verb=None, data=None):
@@ -6,12 +6,16 @@ from util import *
 from Facedancer import *
 from USB import *
 from USBDevice import USBDeviceRequest
+from testcase_overrides import TestcaseOverrides
 import sys
+import time
 
 class MAXUSBApp(FacedancerApp):
     app_name = "MAXUSB"
     app_num = 0x40
 
+    fifo_size = 64                  # bytes per endpoint FIFO packet
+
     reg_ep0_fifo                    = 0x00
     reg_ep1_out_fifo                = 0x01
     reg_ep2_in_fifo                 = 0x02
@@ -42,6 +46,9 @@ class MAXUSBApp(FacedancerApp):
     is_out0_data_avail              = 0x02     # OUT0DAVIRQ
     is_in0_buffer_avail             = 0x01     # IN0BAVIRQ
 
+    # bitmask values for reg_usb_irq = 0x0d
+    usb_irq_bus_reset               = 0x08     # URESIRQ
+
     # bitmask values for reg_usb_control = 0x0f
     usb_control_vbgate              = 0x40
     usb_control_connect             = 0x08
@@ -50,27 +57,29 @@ class MAXUSBApp(FacedancerApp):
     interrupt_level                 = 0x08
     full_duplex                     = 0x10
 
-    def __init__(self, device, logfp, mode, testcase, verbose=0):
-        FacedancerApp.__init__(self, device, verbose)
+    # seconds without an EPIRQ change before service_irqs() gives up on the
+    # host, per mode; modes not listed (e.g. 0) run until stopped
+    idle_timeouts = {
+        1 : 2.0,
+        2 : 10.0,
+        3 : 2.0,
+        4 : 2.0
+    }
 
-        self.connected_device = None
+    # bounds for the poll back-off used when the transport cannot notify us
+    # of interrupts
+    poll_interval_min               = 0.0005
+    poll_interval_max               = 0.02
 
-        self.mode = mode
-        self.netserver_to_endpoint_sd = 0
-        self.netserver_from_endpoint_sd = 0
-        self.server_running = False
-        self.reply_buffer = ""
-        self.testcase = testcase
+    def __init__(self, device, logfp, mode, testcase, verbose=0):
+        FacedancerApp.__init__(self, device, verbose)
 
         self.fplog = 0
 
         if logfp != 0:
             self.fplog = logfp
 
-        self.fingerprint = []
-
-        self.stop = False
-        self.retries = False 
+        self.reset_state(mode, testcase)
         self.enable()
 
         if verbose > 0:
@@ -81,6 +90,40 @@ class MAXUSBApp(FacedancerApp):
         self.write_register(self.reg_pin_control,
                 self.full_duplex | self.interrupt_level)
 
+    def reset_state(self, mode, testcase):
+        self.connected_device = None
+
+        self.mode = mode
+        self.endpoint_bridge = None    # devices.networking.EndpointBridge for -n
+        self.server_running = False
+        self.testcase = testcase
+        self.overrides = TestcaseOverrides(testcase)
+
+        self.fingerprint = []
+
+        self.stop = False
+        self.retries = False 
+
+        # how soon the host reacted to the last connect, for pacing
+        self.connect_time = None
+        self.reset_latency = None
+        self.setup_latency = None
+
+    def begin_testcase(self, mode, testcase):
+        """Prepare an already-enabled app for the next emulated device without
+        resetting the board: soft disconnect and clear leftover chip state."""
+
+        self.reset_state(mode, testcase)
+
+        self.queue_write_register(self.reg_usb_control, self.usb_control_vbgate)
+        self.queue_write_register(self.reg_ep_stalls, 0)
+        self.queue_write_register(self.reg_endpoint_irq, 0xff)
+        self.queue_write_register(self.reg_usb_irq, 0xff)
+        self.device.flushcmds()
+
+        if self.verbose > 0:
+            print(self.app_name, "ready for next testcase")
+
     def init_commands(self):
         self.read_register_cmd  = FacedancerCommand(self.app_num, 0x00, b'')
         self.write_register_cmd = FacedancerCommand(self.app_num, 0x00, b'')
@@ -95,9 +138,8 @@ class MAXUSBApp(FacedancerApp):
         if ack:
             self.write_register_cmd.data[0] |= 1
 
-        self.device.writecmd(self.read_register_cmd)
-    
-        resp = self.device.readcmd()
+        # any pipelined writes still queued go out in the same serial write
+        resp = self.device.submitcmd(self.read_register_cmd).result()
 
         if self.verbose > 2:
             print(self.app_name, "read register 0x%02x has value 0x%02x" %
@@ -117,6 +159,19 @@ class MAXUSBApp(FacedancerApp):
         self.device.writecmd(self.write_register_cmd)
         self.device.readcmd()
 
+    def queue_write_register(self, reg_num, value, ack=False):
+        """Pipelined write_register(); the response is collected later."""
+
+        if self.verbose > 2:
+            print(self.app_name, "queueing write of register 0x%02x with value 0x%02x" %
+                    (reg_num, value))
+
+        data = bytearray([ (reg_num << 3) | 2, value ])
+        if ack:
+            data[0] |= 1
+
+        return self.device.submitcmd(FacedancerCommand(self.app_num, 0x00, data))
+
     def get_version(self):
         return self.read_register(self.reg_revision)
 
@@ -132,6 +187,7 @@ class MAXUSBApp(FacedancerApp):
                 self.usb_control_connect)
 
         self.connected_device = usb_device
+        self.connect_time = time.monotonic()
 
         if self.verbose > 0:
             print(self.app_name, "connected device", self.connected_device.name)
@@ -139,13 +195,20 @@ class MAXUSBApp(FacedancerApp):
     def disconnect(self):
         self.write_register(self.reg_usb_control, self.usb_control_vbgate)
 
+        if self.connected_device is None:
+            return
+
         if self.verbose > 0:
             print(self.app_name, "disconnected device", self.connected_device.name)
+
+        self.connected_device.handle_bus_disconnect()
         self.connected_device = None
 
 
     def clear_irq_bit(self, reg, bit):
-        self.write_register(reg, bit)
+        # nothing depends on the response, so let it ride along with the next
+        # register read instead of costing a round-trip of its own
+        self.queue_write_register(reg, bit)
 
     def read_bytes(self, reg, n):
         if self.verbose > 2:
@@ -154,8 +217,7 @@ class MAXUSBApp(FacedancerApp):
         data = bytes([ (reg << 3) ] + ([0] * n))
         cmd = FacedancerCommand(self.app_num, 0x00, data)
 
-        self.device.writecmd(cmd)
-        resp = self.device.readcmd()
+        resp = self.device.submitcmd(cmd).result()
 
         if self.verbose > 3:
             print(self.app_name, "read", len(resp.data) - 1, "bytes from register", reg)
@@ -172,6 +234,17 @@ class MAXUSBApp(FacedancerApp):
         if self.verbose > 3:
             print(self.app_name, "wrote", len(data) - 1, "bytes to register", reg)
 
+    def queue_write_bytes(self, reg, data):
+        """Pipelined write_bytes(); the null response is collected later."""
+
+        data = bytes([ (reg << 3) | 3 ]) + data
+        cmd = FacedancerCommand(self.app_num, 0x00, data)
+
+        if self.verbose > 3:
+            print(self.app_name, "queued", len(data) - 1, "bytes for register", reg)
+
+        return self.device.submitcmd(cmd)
+
     # HACK: but given the limitations of the MAX chips, it seems necessary
     def send_on_endpoint(self, ep_num, data):
         if ep_num == 0:
@@ -186,15 +259,25 @@ class MAXUSBApp(FacedancerApp):
         else:
             raise ValueError('endpoint ' + str(ep_num) + ' not supported')
 
-        # FIFO buffer is only 64 bytes, must loop
-        while len(data) > 64:
-            self.write_bytes(fifo_reg, data[:64])
-            self.write_register(bc_reg, 64, ack=True)
+        if self.endpoint_bridge:
+            self.endpoint_bridge.publish(0x80 | ep_num, data)
+
+        # FIFO buffer is only 64 bytes, must loop; every chunk is pipelined and
+        # streamed out together, responses are drained by the next read.
+        # Chunks are cut at an offset rather than by re-slicing the tail, so a
+        # memoryview is never copied and long bytes aren't copied repeatedly.
+        size = self.fifo_size
+        offset = 0
+        while len(data) - offset > size:
+            self.queue_write_bytes(fifo_reg, data[offset:offset + size])
+            self.queue_write_register(bc_reg, size, ack=True)
 
-            data = data[64:]
+            offset += size
 
-        self.write_bytes(fifo_reg, data)
-        self.write_register(bc_reg, len(data), ack=True)
+        data = data[offset:]
+        self.queue_write_bytes(fifo_reg, data)
+        self.queue_write_register(bc_reg, len(data), ack=True)
+        self.device.sendcmds()
 
         if self.verbose > 1:
             print(self.app_name, "wrote", bytes_as_hex(data), "to endpoint",
@@ -217,6 +300,23 @@ class MAXUSBApp(FacedancerApp):
 
         return data
 
+    def read_irq_snapshot(self, usb_irq=False):
+        """Read EPIRQ, and USBIRQ as well if usb_irq is set.  The MAX3421E
+        doesn't auto-increment register addresses (a multi-byte access
+        repeats one register, which is how the FIFOs are read), so the two
+        can't be fetched in one burst; they share a serial write instead."""
+
+        if not usb_irq:
+            return MAXUSBIrqSnapshot(self.read_register(self.reg_endpoint_irq), 0)
+
+        # one pipelined serial write, one SPI transaction per register
+        futures = [ self.device.submitcmd(FacedancerCommand(self.app_num,
+                        0x00, bytes([ reg << 3, 0 ])))
+                    for reg in (self.reg_endpoint_irq, self.reg_usb_irq) ]
+        regs = [ f.result().data[1] for f in futures ]
+
+        return MAXUSBIrqSnapshot(regs[0], regs[1])
+
     def stall_ep0(self):
         if self.verbose > 0:
             print(self.app_name, "stalling endpoint 0")
@@ -224,37 +324,29 @@ class MAXUSBApp(FacedancerApp):
         self.write_register(self.reg_ep_stalls, 0x23)
 
     def service_irqs(self):
-        count = 0
         tmp_irq = 0
+        last_activity = time.monotonic()
+        poll_interval = 0
 
-        while self.stop == False:
-            irq = self.read_register(self.reg_endpoint_irq)
-
-            if irq == tmp_irq:
-                count +=1
-            else:
-                count = 0
-
-            if count == 10000 and self.mode == 2:     #This needs to be configurable
-                self.stop = True
-                if self.fplog:
-                    self.fplog.write("\n")
-                return
-
-            if count == 2000 and (self.mode == 3 or self.mode == 1 or self.mode == 4):		#This needs to be configurable
-                self.stop = True
-
-                if len(self.fingerprint) == 0:
-                    print ("\n*** No response from host - check if the host is still functioning correctly ***\n")
-                    self.disconnect()
-                    sys.exit()
-
-
-                self.disconnect()
-
-                if self.fplog:
-                    self.fplog.write("\n")
+        idle_timeout = self.idle_timeouts.get(self.mode, None)
 
+        while self.stop == False:
+            # USBIRQ is only wanted until the first bus reset is timed
+            snapshot = self.read_irq_snapshot(
+                    self.reset_latency is None and bool(self.connect_time))
+            irq = snapshot.endpoint_irq
+            now = time.monotonic()
+            commands_before = self.device.commands_sent
+
+            if irq != tmp_irq:
+                last_activity = now
+
+            if self.reset_latency is None and self.connect_time and \
+                    snapshot.usb_irq & self.usb_irq_bus_reset:
+                self.reset_latency = now - self.connect_time
+
+            if idle_timeout and now - last_activity >= idle_timeout:
+                self.stop_idle()
                 return
 
             if self.verbose > 3:
@@ -269,12 +361,18 @@ class MAXUSBApp(FacedancerApp):
                 self.clear_irq_bit(self.reg_endpoint_irq, self.is_setup_data_avail)
 
                 b = self.read_bytes(self.reg_setup_data_fifo, 8)
+                if self.setup_latency is None and self.connect_time:
+                    self.setup_latency = time.monotonic() - self.connect_time
+                if self.endpoint_bridge:
+                    self.endpoint_bridge.publish(0x00, b)
                 req = USBDeviceRequest(b)
                 self.connected_device.handle_request(req)
 
             if irq & self.is_out1_data_avail:
                 data = self.read_from_endpoint(1)
                 if data:
+                    if self.endpoint_bridge:
+                        self.endpoint_bridge.publish(0x01, data)
                     self.connected_device.handle_data_available(1, data)
                 self.clear_irq_bit(self.reg_endpoint_irq, self.is_out1_data_avail)
 
@@ -290,4 +388,94 @@ class MAXUSBApp(FacedancerApp):
                 except:
                     pass
             tmp_irq = irq
+
+            # anything beyond the snapshot read means the device did some
+            # work; go straight round again
+            if self.device.commands_sent > commands_before or self.stop:
+                poll_interval = 0
+                continue
+
+            self.connected_device.handle_idle()
+
+            # otherwise block until the board reports an interrupt, falling
+            # back to polling with exponential back-off
+            if idle_timeout:
+                remaining = idle_timeout - (time.monotonic() - last_activity)
+            else:
+                remaining = self.poll_interval_max
+
+            pending = self.device.wait_for_irq(max(remaining, 0))
+
+            if pending is False and idle_timeout:
+                self.stop_idle()
+                return
+
+            if pending is not True:
+                poll_interval = min(max(poll_interval * 2,
+                        self.poll_interval_min), self.poll_interval_max)
+                time.sleep(poll_interval)
+
+        self.disconnect()
+
+    def stop_idle(self):
+        """Called once the host has been quiet for the mode's idle timeout."""
+
+        self.stop = True
+
+        if self.mode == 2:
+            if self.fplog:
+                self.fplog.write("\n")
+            return
+
+        if len(self.fingerprint) == 0:
+            print ("\n*** No response from host - check if the host is still functioning correctly ***\n")
+            self.disconnect()
+            sys.exit()
+
         self.disconnect()
+
+        if self.fplog:
+            self.fplog.write("\n")
+
+
+class MAXUSBIrqSnapshot:
+    """The interrupt registers read by one poll; usb_irq is 0 if it was
+    not read."""
+
+    def __init__(self, endpoint_irq, usb_irq):
+        self.endpoint_irq           = endpoint_irq
+        self.usb_irq                = usb_irq
+
+    def __str__(self):
+        return "epirq 0x%02x, usbirq 0x%02x" % (self.endpoint_irq, self.usb_irq)
+
+
+class MAXUSBSession:
+    """Keeps a single Facedancer and MAXUSBApp initialised across many
+    emulated devices, so that only the first one pays for a board reset,
+    the enable handshake and pin setup."""
+
+    def __init__(self, serialport, logfp=0):
+        self.serialport = serialport
+        self.logfp = logfp
+
+        self.device = None
+        self.app = None
+
+    def begin_testcase(self, mode, testcase, verbose=0):
+        if self.app is None:
+            self.device = Facedancer(self.serialport, verbose=verbose)
+            self.app = MAXUSBApp(self.device, self.logfp, mode, testcase,
+                    verbose=verbose)
+        else:
+            self.device.verbose = verbose
+            self.app.verbose = verbose
+            self.app.begin_testcase(mode, testcase)
+
+        return self.app
+
+    def close(self):
+        """Forget the board state; the next testcase re-initialises it."""
+
+        self.device = None
+        self.app = None
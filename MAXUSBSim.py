@@ -0,0 +1,465 @@
+# MAXUSBSim.py
+#
+# Contains class definitions for SimulatedSerialPort, MAX3421ESimulator and
+# VirtualHost, which together stand in for a Facedancer board and the USB host
+# it is plugged into.  A SimulatedSerialPort can be handed to Facedancer in
+# place of a pyserial Serial object, so that MAXUSBApp and every device class
+# in devices/ run unmodified at memory speed with no hardware attached.
+
+from util import *
+
+class SimulatedSerialPort:
+    """Drop-in replacement for serial.Serial speaking the GoodFET protocol."""
+
+    monitor_app_num = 0x00
+    maxusb_app_num  = 0x40
+
+    def __init__(self, host=None, verbose=0):
+        self.verbose = verbose
+        self.rx = bytearray()       # board -> PC
+        self.tx = bytearray()       # PC -> board, not yet a whole command
+        self.dtr = 0
+        self.rts = 0
+
+        if host is None:
+            host = VirtualHost()
+
+        self.chip = MAX3421ESimulator(host, verbose=verbose)
+
+    # pyserial API
+    #####################################################
+
+    def setRTS(self, level):
+        self.rts = level
+
+    def setDTR(self, level):
+        # dropping DTR after halt() releases the board from reset, at which
+        # point the GoodFET firmware announces itself
+        if self.dtr and not level:
+            self.tx = bytearray()
+            self.rx = bytearray()
+            self.chip.reset()
+            self.reply(self.monitor_app_num, 0x7f, b'http://goodfet.sf.net/')
+
+        self.dtr = level
+
+    def inWaiting(self):
+        return len(self.rx)
+
+    def read(self, n):
+        b = bytes(self.rx[:n])
+        del self.rx[:n]
+        return b
+
+    def write(self, b):
+        self.tx += b
+
+        while len(self.tx) >= 4:
+            n = self.tx[2] | (self.tx[3] << 8)
+            if len(self.tx) < n + 4:
+                break
+
+            app = self.tx[0]
+            verb = self.tx[1]
+            data = bytes(self.tx[4:n + 4])
+            del self.tx[:n + 4]
+
+            self.handle_command(app, verb, data)
+
+        return len(b)
+
+    def close(self):
+        pass
+
+    def wait_for_irq(self, timeout):
+        # the simulated bus only moves when we tick it, so rather than sleep
+        # we run the host forward until it raises an interrupt or runs out of
+        # things to do
+        return self.chip.wait_for_irq()
+
+    # GoodFET command handling
+    #####################################################
+
+    def reply(self, app, verb, data):
+        n = len(data)
+        self.rx += bytes([ app, verb, n & 0xff, n >> 8 ]) + data
+
+    def handle_command(self, app, verb, data):
+        if app == self.monitor_app_num:
+            self.handle_monitor_command(verb, data)
+        elif app == self.maxusb_app_num:
+            self.handle_maxusb_command(verb, data)
+        else:
+            raise ValueError('simulated Facedancer has no app 0x%02x' % app)
+
+    def handle_monitor_command(self, verb, data):
+        if verb == 0x02:        # peek
+            addr = data[0] | (data[1] << 8)
+            value = { 0xff0 : 0xf1, 0xff1 : 0x16, 0x56 : 0x8f, 0x57 : 0x8e }
+            self.reply(self.monitor_app_num, verb, bytes([ value.get(addr, 0) ]))
+        elif verb == 0x81:      # echo
+            self.reply(self.monitor_app_num, verb, data)
+        elif verb == 0x82:      # list apps
+            self.reply(self.monitor_app_num, verb, b'simulated')
+            self.reply(self.monitor_app_num, verb, b'MAXUSB')
+            self.reply(self.monitor_app_num, verb, b'')
+        else:                   # 0xb1 announce connected, and anything else
+            self.reply(self.monitor_app_num, verb, b'')
+
+    def handle_maxusb_command(self, verb, data):
+        if verb == 0x00 and len(data) > 0:
+            resp = self.chip.spi_transfer(data)
+        else:                   # 0x10 enable
+            resp = b''
+
+        self.reply(self.maxusb_app_num, verb, resp)
+
+
+class MAX3421ESimulator:
+    """Register file, FIFOs and IRQ bits of a MAX3421E in peripheral mode."""
+
+    reg_ep0_fifo                    = 0x00
+    reg_ep1_out_fifo                = 0x01
+    reg_ep2_in_fifo                 = 0x02
+    reg_ep3_in_fifo                 = 0x03
+    reg_setup_data_fifo             = 0x04
+    reg_ep0_byte_count              = 0x05
+    reg_ep1_out_byte_count          = 0x06
+    reg_ep2_in_byte_count           = 0x07
+    reg_ep3_in_byte_count           = 0x08
+    reg_ep_stalls                   = 0x09
+    reg_endpoint_irq                = 0x0b
+    reg_usb_irq                     = 0x0d
+    reg_usb_control                 = 0x0f
+    reg_revision                    = 0x12
+
+    is_setup_data_avail             = 0x20
+    is_in3_buffer_avail             = 0x10
+    is_in2_buffer_avail             = 0x08
+    is_out1_data_avail              = 0x04
+    is_out0_data_avail              = 0x02
+    is_in0_buffer_avail             = 0x01
+
+    usb_irq_bus_reset               = 0x08
+    usb_irq_suspend                 = 0x10
+
+    usb_control_connect             = 0x08
+
+    revision                        = 0x13
+
+    fifo_regs = (reg_ep0_fifo, reg_ep1_out_fifo, reg_ep2_in_fifo,
+                 reg_ep3_in_fifo, reg_setup_data_fifo)
+
+    def __init__(self, host, verbose=0):
+        self.host = host
+        self.verbose = verbose
+
+        self.reset()
+
+    def reset(self):
+        self.regs = bytearray(32)
+        self.regs[self.reg_revision] = self.revision
+
+        self.fifos = { r : bytearray() for r in self.fifo_regs }
+        self.connected = False
+
+        self.regs[self.reg_endpoint_irq] = self.is_in0_buffer_avail \
+                | self.is_in2_buffer_avail | self.is_in3_buffer_avail
+
+        # a board reset is a fresh plug-in as far as the host is concerned
+        self.host.reset()
+        self.host.attach(self)
+
+    # status bits clocked out while the command byte is shifted in
+    def status(self):
+        usb_irq = self.regs[self.reg_usb_irq]
+        s = self.regs[self.reg_endpoint_irq] & 0x3f
+
+        if usb_irq & self.usb_irq_bus_reset:
+            s |= 0x40
+        if usb_irq & self.usb_irq_suspend:
+            s |= 0x80
+
+        return s
+
+    def spi_transfer(self, data):
+        command = data[0]
+        reg = command >> 3
+        is_write = command & 0x02
+        ackstat = command & 0x01
+
+        resp = bytearray([ self.status() ])
+
+        # the address doesn't auto-increment: every byte of a multi-byte
+        # transfer goes to the same register, which for a FIFO means
+        # successive FIFO bytes
+        if is_write:
+            for b in data[1:]:
+                self.write_register(reg, b)
+            resp += bytes(len(data) - 1)
+        else:
+            for i in range(len(data) - 1):
+                resp.append(self.read_register(reg))
+
+        if ackstat:
+            self.host.status_stage_acked()
+
+        return bytes(resp)
+
+    def read_register(self, reg):
+        reg &= 0x1f
+
+        if reg in self.fifo_regs:
+            fifo = self.fifos[reg]
+            if len(fifo) == 0:
+                return 0
+            b = fifo[0]
+            del fifo[0]
+            return b
+
+        if reg == self.reg_endpoint_irq:
+            # the firmware polls this register; each poll is one tick of the
+            # simulated bus, giving the host a chance to make progress
+            self.host.tick()
+
+        return self.regs[reg]
+
+    def write_register(self, reg, value):
+        reg &= 0x1f
+
+        if reg in self.fifo_regs:
+            self.fifos[reg].append(value)
+
+        elif reg in (self.reg_endpoint_irq, self.reg_usb_irq):
+            # IRQ bits are cleared by writing 1; the IN buffer-available bits
+            # are only cleared by loading a byte count
+            if reg == self.reg_endpoint_irq:
+                value &= ~(self.is_in0_buffer_avail | self.is_in2_buffer_avail
+                        | self.is_in3_buffer_avail)
+            self.regs[reg] &= ~value & 0xff
+
+        elif reg == self.reg_ep0_byte_count:
+            self.load_in_buffer(0, self.reg_ep0_fifo, value,
+                    self.is_in0_buffer_avail)
+
+        elif reg == self.reg_ep2_in_byte_count:
+            self.load_in_buffer(2, self.reg_ep2_in_fifo, value,
+                    self.is_in2_buffer_avail)
+
+        elif reg == self.reg_ep3_in_byte_count:
+            self.load_in_buffer(3, self.reg_ep3_in_fifo, value,
+                    self.is_in3_buffer_avail)
+
+        elif reg == self.reg_ep_stalls:
+            self.regs[reg] = value
+            if value & 0x03:
+                self.host.ep0_stalled()
+
+        elif reg == self.reg_usb_control:
+            self.regs[reg] = value
+            connected = bool(value & self.usb_control_connect)
+            if connected != self.connected:
+                self.connected = connected
+                if connected:
+                    self.regs[self.reg_usb_irq] |= self.usb_irq_bus_reset
+                    self.host.device_connected()
+                else:
+                    self.host.device_disconnected()
+
+        else:
+            self.regs[reg] = value
+
+    def load_in_buffer(self, ep_num, fifo_reg, n, bav_bit):
+        fifo = self.fifos[fifo_reg]
+        packet = bytes(fifo[:n])
+        self.fifos[fifo_reg] = bytearray()
+
+        self.regs[self.reg_endpoint_irq] &= ~bav_bit & 0xff
+
+        # the host drains IN packets as soon as they are armed
+        self.host.in_packet(ep_num, packet)
+        self.regs[self.reg_endpoint_irq] |= bav_bit
+
+    def wait_for_irq(self):
+        wake = self.is_setup_data_avail | self.is_out1_data_avail
+
+        while not (self.regs[self.reg_endpoint_irq] & wake):
+            if not self.host.running or self.host.done():
+                return False
+            self.host.tick()
+
+        return True
+
+    # host-side access
+    #####################################################
+
+    def put_setup_packet(self, setup):
+        self.fifos[self.reg_setup_data_fifo] = bytearray(setup[:8])
+        self.regs[self.reg_endpoint_irq] |= self.is_setup_data_avail
+
+    def put_out_packet(self, data):
+        self.fifos[self.reg_ep1_out_fifo] = bytearray(data)
+        self.regs[self.reg_ep1_out_byte_count] = len(data)
+        self.regs[self.reg_endpoint_irq] |= self.is_out1_data_avail
+
+    def out_packet_pending(self):
+        return bool(self.regs[self.reg_endpoint_irq] & self.is_out1_data_avail)
+
+
+class VirtualHost:
+    """Scripted USB host driving a MAX3421ESimulator.
+
+    A script is a list of steps, executed in order once the device connects:
+
+        ("control", setup)          8-byte setup packet; IN data stage collected
+        ("out", data)               bulk OUT packet on EP1
+        ("wait", ticks)             idle for a number of EPIRQ polls
+
+    Every completed step is appended to self.transfers as a tuple of
+    (step, data received, status) where status is "ok", "stall" or "timeout".
+    Bulk IN data is accumulated per endpoint in self.received."""
+
+    # EPIRQ polls to wait for a device response before giving up on a step
+    transfer_timeout = 200
+
+    def __init__(self, script=None, verbose=0):
+        if script is None:
+            script = VirtualHost.enumeration_script()
+
+        self.script = script
+        self.verbose = verbose
+        self.chip = None
+
+        self.reset()
+
+    def reset(self):
+        self.step_num = 0
+        self.current = None
+        self.current_data = bytearray()
+        self.wait_ticks = 0
+        self.running = False
+
+        self.transfers = [ ]
+        self.received = { }
+
+    def attach(self, chip):
+        self.chip = chip
+
+    # helpers for building scripts
+    #####################################################
+
+    @staticmethod
+    def setup_packet(request_type, request, value=0, index=0, length=0):
+        return bytes([ request_type, request,
+                       value & 0xff, (value >> 8) & 0xff,
+                       index & 0xff, (index >> 8) & 0xff,
+                       length & 0xff, (length >> 8) & 0xff ])
+
+    @staticmethod
+    def get_descriptor(dtype, dindex=0, length=0xff, lang=0):
+        return ("control", VirtualHost.setup_packet(0x80, 6,
+                (dtype << 8) | dindex, lang, length))
+
+    @staticmethod
+    def enumeration_script():
+        return [
+            VirtualHost.get_descriptor(1, 0, 64),
+            ("control", VirtualHost.setup_packet(0x00, 5, 1)),     # SET_ADDRESS
+            VirtualHost.get_descriptor(1, 0, 18),
+            VirtualHost.get_descriptor(2, 0, 9),
+            VirtualHost.get_descriptor(2, 0, 0xff),
+            VirtualHost.get_descriptor(3, 0, 0xff),
+            VirtualHost.get_descriptor(3, 1, 0xff, 0x0409),
+            VirtualHost.get_descriptor(3, 2, 0xff, 0x0409),
+            VirtualHost.get_descriptor(3, 3, 0xff, 0x0409),
+            ("control", VirtualHost.setup_packet(0x00, 9, 1)),     # SET_CONFIGURATION
+        ]
+
+    # events raised by the simulated chip
+    #####################################################
+
+    def device_connected(self):
+        if self.verbose > 0:
+            print("virtual host: device connected")
+
+        # every (re)connect is enumerated from the top of the script
+        self.reset()
+        self.running = True
+
+    def device_disconnected(self):
+        if self.verbose > 0:
+            print("virtual host: device disconnected")
+
+        self.running = False
+
+    def in_packet(self, ep_num, packet):
+        if ep_num != 0:
+            self.received.setdefault(ep_num, bytearray()).extend(packet)
+            return
+
+        if not self.current or self.current[0] != "control":
+            return
+
+        self.current_data += packet
+
+        setup = self.current[1]
+        length = setup[6] | (setup[7] << 8)
+        if len(packet) < 64 or len(self.current_data) >= length:
+            self.complete("ok")
+
+    def status_stage_acked(self):
+        # no-data control transfers finish once the device ACKs status
+        if self.current and self.current[0] == "control":
+            setup = self.current[1]
+            length = setup[6] | (setup[7] << 8)
+            if length == 0 or not (setup[0] & 0x80):
+                self.complete("ok")
+
+    def ep0_stalled(self):
+        if self.current and self.current[0] == "control":
+            self.complete("stall")
+
+    # bus activity
+    #####################################################
+
+    def complete(self, status):
+        if self.verbose > 1:
+            print("virtual host:", self.current[0], "->", status,
+                    bytes_as_hex(self.current_data))
+
+        self.transfers.append((self.current, bytes(self.current_data), status))
+        self.current = None
+        self.current_data = bytearray()
+
+    def done(self):
+        return self.step_num >= len(self.script) and self.current is None
+
+    def tick(self):
+        if not self.running:
+            return
+
+        if self.current:
+            if self.current[0] == "out" and not self.chip.out_packet_pending():
+                self.complete("ok")
+                return
+
+            self.wait_ticks -= 1
+            if self.wait_ticks <= 0:
+                self.complete("ok" if self.current[0] == "wait" else "timeout")
+            return
+
+        if self.step_num >= len(self.script):
+            return
+
+        self.current = self.script[self.step_num]
+        self.step_num += 1
+        self.wait_ticks = self.transfer_timeout
+
+        if self.current[0] == "control":
+            self.chip.put_setup_packet(self.current[1])
+        elif self.current[0] == "out":
+            self.chip.put_out_packet(self.current[1])
+        elif self.current[0] == "wait":
+            self.wait_ticks = self.current[1]
+        else:
+            raise ValueError('unknown virtual host step ' + str(self.current[0]))
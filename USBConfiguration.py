@@ -29,25 +29,13 @@ class USBConfiguration:
         for i in self.interfaces:
             interface_descriptors += i.get_descriptor()
 
-        if self.maxusb_app.testcase[1] == "conf_bLength":
-            bLength = self.maxusb_app.testcase[2]
-        else:
-            bLength = 9
-
-        if self.maxusb_app.testcase[1] == "conf_bDescriptorType":
-            bDescriptorType = self.maxusb_app.testcase[2]
-        else:
-            bDescriptorType = 2
-
-        if self.maxusb_app.testcase[1] == "conf_wTotalLength":
-            wTotalLength = self.maxusb_app.testcase[2]
-        else:
-            wTotalLength = len(interface_descriptors) + 9
-
-        if self.maxusb_app.testcase[1] == "conf_bNumInterfaces":
-            bNumInterfaces = self.maxusb_app.testcase[2]
-        else:
-            bNumInterfaces = len(self.interfaces)
+        bLength = self.maxusb_app.overrides.get("conf_bLength", 9)
+
+        bDescriptorType = self.maxusb_app.overrides.get("conf_bDescriptorType", 2)
+
+        wTotalLength = self.maxusb_app.overrides.get("conf_wTotalLength", len(interface_descriptors) + 9)
+
+        bNumInterfaces = self.maxusb_app.overrides.get("conf_bNumInterfaces", len(self.interfaces))
 
 
 
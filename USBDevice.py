@@ -32,26 +32,21 @@ class USBDevice:
         self.product_id                 = product_id
         self.device_rev                 = device_rev
 
-        if self.maxusb_app.testcase[1] == "string_Manufacturer":
-            self.manufacturer_string_id = self.get_string_id(self.maxusb_app.testcase[2])
-        else:
-            self.manufacturer_string_id = self.get_string_id(manufacturer_string)
+        self.manufacturer_string_id = self.get_string_id(
+                self.maxusb_app.overrides.get("string_Manufacturer", manufacturer_string))
 
-        if self.maxusb_app.testcase[1] == "string_Product":
-            self.product_string_id = self.get_string_id(self.maxusb_app.testcase[2])
-        else:
-            self.product_string_id = self.get_string_id(product_string)
+        self.product_string_id = self.get_string_id(
+                self.maxusb_app.overrides.get("string_Product", product_string))
 
-        if self.maxusb_app.testcase[1] == "string_Serial":
-            self.serial_number_string_id = self.get_string_id(self.maxusb_app.testcase[2])
-        else:
-            self.serial_number_string_id = self.get_string_id(serial_number_string)
+        self.serial_number_string_id = self.get_string_id(
+                self.maxusb_app.overrides.get("string_Serial", serial_number_string))
 
 
 
 
-        # maps from USB.desc_type_* to bytearray OR callable
-        self.descriptors = descriptors
+        # maps from USB.desc_type_* to bytearray OR callable; copied, as the
+        # default dict would otherwise be shared by every device
+        self.descriptors = dict(descriptors)
         self.descriptors[USB.desc_type_device] = self.get_descriptor
         self.descriptors[USB.desc_type_configuration] = self.handle_get_configuration_descriptor_request
         self.descriptors[USB.desc_type_string] = self.handle_get_string_descriptor_request
@@ -75,6 +70,10 @@ class USBDevice:
 
         self.address = 0
 
+        # descriptor bytes already built for the active testcase
+        self.descriptor_cache = { }
+        self.descriptor_cache_overrides = None
+
         self.setup_request_handlers()
 
     def get_string_id(self, s):
@@ -87,6 +86,35 @@ class USBDevice:
 
         return i
 
+    def get_cached_descriptor(self, key, build):
+        """Return the descriptor bytes stored under key, calling build() to
+        create them the first time they are asked for under the active
+        testcase.  The cache is dropped whenever the testcase changes."""
+
+        overrides = self.maxusb_app.overrides
+        if overrides is not self.descriptor_cache_overrides:
+            self.descriptor_cache = { }
+            self.descriptor_cache_overrides = overrides
+
+        try:
+            return self.descriptor_cache[key]
+        except KeyError:
+            pass
+
+        response = build()
+        if response:
+            response = bytes(response)
+
+        self.descriptor_cache[key] = response
+        return response
+
+    def build_descriptor(self, dtype, dindex):
+        response = self.descriptors.get(dtype, None)
+        if callable(response):
+            response = response(dindex)
+
+        return response
+
     def setup_request_handlers(self):
         # see table 9-4 of USB 2.0 spec, page 279
         self.request_handlers = {
@@ -104,6 +132,7 @@ class USBDevice:
         }
 
     def connect(self):
+        self.descriptor_cache = { }
         self.maxusb_app.connect(self)
 
         # skipping USB.state_attached may not be strictly correct (9.1.1.{1,2})
@@ -113,16 +142,23 @@ class USBDevice:
         self.maxusb_app.disconnect()
         self.maxusb_app.server_running = False
 
-        if self.maxusb_app.netserver_to_endpoint_sd:
-            self.maxusb_app.netserver_to_endpoint_sd.close()
-
-        if self.maxusb_app.netserver_from_endpoint_sd:
-            self.maxusb_app.netserver_from_endpoint_sd.close()
+        if self.maxusb_app.endpoint_bridge:
+            self.maxusb_app.endpoint_bridge.close()
 
 
 
         self.state = USB.state_detached
 
+    def handle_idle(self):
+        """Called by the app while the bus is quiet; models with deferred
+        work, such as unsynced writes, override this to do it."""
+        pass
+
+    def handle_bus_disconnect(self):
+        """Called by the app when it drops this device off the bus; models
+        holding buffered state override this to commit it."""
+        pass
+
     def run(self):
         self.maxusb_app.service_irqs()
 
@@ -131,20 +167,11 @@ class USBDevice:
 
     def get_descriptor(self, n):
 
-        if self.maxusb_app.testcase[1] == "dev_bLength":
-            bLength = self.maxusb_app.testcase[2]
-        else:
-            bLength = 18
+        bLength = self.maxusb_app.overrides.get("dev_bLength", 18)
 
-        if self.maxusb_app.testcase[1] == "dev_bDescriptorType":
-            bDescriptorType = self.maxusb_app.testcase[2]
-        else:
-            bDescriptorType = 1
+        bDescriptorType = self.maxusb_app.overrides.get("dev_bDescriptorType", 1)
 
-        if self.maxusb_app.testcase[1] == "dev_bMaxPacketSize0":
-            bMaxPacketSize0 = self.maxusb_app.testcase[2]
-        else:
-            bMaxPacketSize0 = self.max_packet_size_ep0
+        bMaxPacketSize0 = self.maxusb_app.overrides.get("dev_bMaxPacketSize0", self.max_packet_size_ep0)
 
         d = bytearray([
             bLength,       
@@ -363,15 +390,14 @@ class USBDevice:
                     + "language 0x%04x, length %d") \
                     % (dtype, dindex, lang, n))
 
-        response = self.descriptors.get(dtype, None)
+        response = self.get_cached_descriptor((dtype, dindex),
+                lambda: self.build_descriptor(dtype, dindex))
         #print ("desc:", self.descriptors)
-        if callable(response):
-            response = response(dindex)
 
         if response:
             n = min(n, len(response))
             self.maxusb_app.verbose += 1
-            self.maxusb_app.send_on_endpoint(0, response[:n])
+            self.maxusb_app.send_on_endpoint(0, memoryview(response)[:n])
             self.maxusb_app.verbose -= 1
 
             if self.verbose > 5:
@@ -414,38 +440,14 @@ class USBDevice:
         return d
 
     def handle_get_hub_descriptor_request(self, num):
-        if self.maxusb_app.testcase[1] == "hub_bLength":
-            bLength = self.maxusb_app.testcase[2]
-        else:
-            bLength = 9
-        if self.maxusb_app.testcase[1] == "hub_bDescriptorType":
-            bDescriptorType = self.maxusb_app.testcase[2]
-        else:
-            bDescriptorType = 0x29
-        if self.maxusb_app.testcase[1] == "hub_bNbrPorts":
-            bNbrPorts = self.maxusb_app.testcase[2]
-        else:
-            bNbrPorts = 4
-        if self.maxusb_app.testcase[1] == "hub_wHubCharacteristics":
-            wHubCharacteristics = self.maxusb_app.testcase[2]
-        else:
-            wHubCharacteristics = 0xe000
-        if self.maxusb_app.testcase[1] == "hub_bPwrOn2PwrGood":
-            bPwrOn2PwrGood = self.maxusb_app.testcase[2]
-        else:
-            bPwrOn2PwrGood = 0x32
-        if self.maxusb_app.testcase[1] == "hub_bHubContrCurrent":
-            bHubContrCurrent = self.maxusb_app.testcase[2]
-        else:
-            bHubContrCurrent = 0x64
-        if self.maxusb_app.testcase[1] == "hub_DeviceRemovable":
-            DeviceRemovable = self.maxusb_app.testcase[2]
-        else:
-            DeviceRemovable = 0
-        if self.maxusb_app.testcase[1] == "hub_PortPwrCtrlMask":
-            PortPwrCtrlMask = self.maxusb_app.testcase[2]
-        else:
-            PortPwrCtrlMask = 0xff
+        bLength = self.maxusb_app.overrides.get("hub_bLength", 9)
+        bDescriptorType = self.maxusb_app.overrides.get("hub_bDescriptorType", 0x29)
+        bNbrPorts = self.maxusb_app.overrides.get("hub_bNbrPorts", 4)
+        wHubCharacteristics = self.maxusb_app.overrides.get("hub_wHubCharacteristics", 0xe000)
+        bPwrOn2PwrGood = self.maxusb_app.overrides.get("hub_bPwrOn2PwrGood", 0x32)
+        bHubContrCurrent = self.maxusb_app.overrides.get("hub_bHubContrCurrent", 0x64)
+        DeviceRemovable = self.maxusb_app.overrides.get("hub_DeviceRemovable", 0)
+        PortPwrCtrlMask = self.maxusb_app.overrides.get("hub_PortPwrCtrlMask", 0xff)
 
         hub_descriptor = bytes([
                 bLength,                        # length of descriptor in bytes
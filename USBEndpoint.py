@@ -59,25 +59,13 @@ class USBEndpoint:
                    | ((self.sync_type & 0x03) << 2) \
                    | ((self.usage_type & 0x03) << 4)
 
-        if self.maxusb_app.testcase[1] == "end_bLength":
-            bLength = self.maxusb_app.testcase[2]
-        else:
-            bLength = 7
-
-        if self.maxusb_app.testcase[1] == "end_bDescriptorType":
-            bDescriptorType = self.maxusb_app.testcase[2]
-        else:
-            bDescriptorType = 5
-
-        if self.maxusb_app.testcase[1] == "end_bEndpointAddress":
-            bEndpointAddress = self.maxusb_app.testcase[2]
-        else:
-            bEndpointAddress = address
-
-        if self.maxusb_app.testcase[1] == "end_wMaxPacketSize":
-            wMaxPacketSize = self.maxusb_app.testcase[2]
-        else:
-            wMaxPacketSize = self.max_packet_size
+        bLength = self.maxusb_app.overrides.get("end_bLength", 7)
+
+        bDescriptorType = self.maxusb_app.overrides.get("end_bDescriptorType", 5)
+
+        bEndpointAddress = self.maxusb_app.overrides.get("end_bEndpointAddress", address)
+
+        wMaxPacketSize = self.maxusb_app.overrides.get("end_wMaxPacketSize", self.max_packet_size)
 
         d = bytearray([
                 bLength,          # length of descriptor in bytes
@@ -0,0 +1,643 @@
+# USBIPApp.py
+#
+# Contains class definitions for USBIPApp and USBIPSession, which export
+# emulated devices over the USB/IP protocol instead of driving a
+# Facedancer board, and USBIPClient, a minimal stand-in for a USB/IP host.
+#
+# A USBIPApp stands in for MAXUSBApp as the device models' maxusb_app: the
+# setup packet of each control URB goes to the device's handle_request(),
+# bulk and interrupt OUT URBs to handle_data_available() in max packet
+# size pieces, and whatever the device sends with send_on_endpoint() is
+# returned to the host in the next IN URBs on that endpoint.
+
+from collections import deque
+from socket import *
+import select
+import struct
+import time
+import traceback
+
+from util import *
+from USB import *
+from USBDevice import USBDeviceRequest
+from testcase_overrides import TestcaseOverrides
+
+usbip_version           = 0x0111
+
+op_req_devlist          = 0x8005
+op_rep_devlist          = 0x0005
+op_req_import           = 0x8003
+op_rep_import           = 0x0003
+
+usbip_cmd_submit        = 1
+usbip_cmd_unlink        = 2
+usbip_ret_submit        = 3
+usbip_ret_unlink        = 4
+
+usbip_dir_out           = 0
+usbip_dir_in            = 1
+
+usb_speed_full          = 2
+
+# URB status values (negated Linux errno)
+status_stalled          = -32       # EPIPE
+status_unlinked         = -104      # ECONNRESET
+
+op_header = struct.Struct(">HHI")
+usbip_header = struct.Struct(">IIIII")
+submit_header = struct.Struct(">IiiiI8s")
+ret_submit_header = struct.Struct(">iiiii8x")
+unlink_header = struct.Struct(">I24x")
+ret_unlink_header = struct.Struct(">i24x")
+iso_descriptor = struct.Struct(">IIIi")
+
+usb_device_info = struct.Struct(">256s32sIIIHHHBBBBBB")
+usb_interface_info = struct.Struct(">BBBx")
+
+def recv_exact(sock, length):
+    buf = bytearray()
+    while len(buf) < length:
+        chunk = sock.recv(length - len(buf))
+        if not chunk:
+            raise ConnectionError("connection closed")
+        buf += chunk
+
+    return bytes(buf)
+
+
+class USBIPApp:
+    """The maxusb_app of one exported device."""
+
+    app_name = "USBIP"
+
+    fifo_size = 64
+
+    # seconds without a URB, once a host has attached, before the device
+    # is dropped, per mode; an emulated device (mode 3) waits on the host
+    # indefinitely as a quiet USB/IP host sends nothing at all
+    idle_timeouts = {
+        1 : 2.0,
+        2 : 10.0,
+        4 : 2.0
+    }
+
+    def __init__(self, session, logfp, mode, testcase, verbose=0):
+        self.session = session
+        self.verbose = verbose
+        self.fplog = logfp
+
+        self.mode = mode
+        self.testcase = testcase
+        self.overrides = TestcaseOverrides(testcase)
+        self.endpoint_bridge = None
+        self.server_running = False
+
+        self.fingerprint = []
+        self.stop = False
+        self.retries = False
+
+        self.connected_device = None
+        self.client = None
+        self.busid = None
+        self.last_activity = None
+
+        self.ep0_data = bytearray()
+        self.ep0_stalled = False
+        self.in_data = { }              # ep_num -> deque of pending transfers
+        self.in_urbs = { }              # ep_num -> deque of (seqnum, length)
+
+    # device side
+    #####################################################
+
+    def connect(self, usb_device):
+        self.connected_device = usb_device
+        self.session.export(self)
+
+        if self.verbose > 0:
+            print(self.app_name, "exported device", usb_device.name, "as",
+                    self.busid)
+
+    def disconnect(self):
+        if self.client is not None:
+            self.session.detach(self)
+
+        if self.connected_device is None:
+            return
+
+        if self.verbose > 0:
+            print(self.app_name, "disconnected device", self.connected_device.name)
+
+        self.session.unexport(self)
+        self.connected_device.handle_bus_disconnect()
+        self.connected_device = None
+
+    def send_on_endpoint(self, ep_num, data):
+        if ep_num == 0:
+            self.ep0_data += data
+        else:
+            self.in_data.setdefault(ep_num, deque()).append(bytes(data))
+
+        if self.endpoint_bridge:
+            self.endpoint_bridge.publish(0x80 | ep_num, data)
+
+        if self.verbose > 1:
+            print(self.app_name, "wrote", bytes_as_hex(data), "to endpoint",
+                    ep_num)
+
+    def read_from_endpoint(self, ep_num):
+        # OUT data is handed to the device as URBs arrive
+        return b''
+
+    def stall_ep0(self):
+        if self.verbose > 0:
+            print(self.app_name, "stalling endpoint 0")
+
+        self.ep0_stalled = True
+
+    def ack_status_stage(self):
+        pass
+
+    def service_irqs(self):
+        self.session.serve()
+
+    # URBs
+    #####################################################
+
+    def handle_control(self, direction, setup, out_data, length):
+        """(status, IN data) of a control transfer."""
+
+        self.ep0_data = bytearray()
+        self.ep0_stalled = False
+
+        if self.endpoint_bridge:
+            self.endpoint_bridge.publish(0x00, setup)
+
+        req = USBDeviceRequest(setup)
+        if self.find_request_handler(req) is None:
+            if self.verbose > 0:
+                print(self.app_name, "no handler for request", req, "- stalling")
+            self.ep0_stalled = True
+        else:
+            try:
+                self.connected_device.handle_request(req)
+            except Exception:
+                print(self.app_name, "error handling request", req)
+                raise
+
+        if self.ep0_stalled:
+            return status_stalled, b''
+        if direction == usbip_dir_in:
+            return 0, bytes(self.ep0_data[:length])
+
+        return 0, b''
+
+    def find_request_handler(self, req):
+        """The handler USBDevice.handle_request() would dispatch req to, or
+        None.  Recipients and entities without request handlers, such as
+        a class request to a device, count as having none."""
+
+        device = self.connected_device
+        recipient_type = req.get_recipient()
+        index = req.get_index()
+        interfaces = device.configuration.interfaces if device.configuration else [ ]
+
+        recipient = None
+        if recipient_type == USB.request_recipient_device:
+            recipient = device
+        elif recipient_type == USB.request_recipient_interface:
+            if (index & 0xff) < len(interfaces):
+                recipient = interfaces[index & 0xff]
+        elif recipient_type == USB.request_recipient_endpoint:
+            recipient = device.endpoints.get(index, None)
+        elif recipient_type == USB.request_recipient_other and interfaces:
+            recipient = interfaces[0]
+
+        entity = None
+        req_type = req.get_type()
+        if req_type == USB.request_type_standard:
+            entity = recipient
+        elif req_type == USB.request_type_class:
+            entity = getattr(recipient, "device_class", None)
+        elif req_type == USB.request_type_vendor:
+            entity = getattr(recipient, "device_vendor", None)
+
+        if entity == 9:                 # the hub class HACK in handle_request
+            entity = recipient
+
+        handlers = getattr(entity, "request_handlers", None)
+        if not isinstance(handlers, dict):
+            return None
+
+        return handlers.get(req.request, None)
+
+    def handle_out(self, ep_num, data):
+        device = self.connected_device
+
+        size = self.fifo_size
+        endpoint = getattr(device, "endpoints", { }).get(ep_num)
+        if endpoint is not None and endpoint.max_packet_size:
+            size = endpoint.max_packet_size
+
+        if self.endpoint_bridge:
+            self.endpoint_bridge.publish(ep_num, data)
+
+        # the models expect data one packet at a time, as from the FIFO
+        for offset in range(0, max(len(data), 1), size):
+            device.handle_data_available(ep_num, data[offset:offset + size])
+            if self.stop:
+                break
+
+    def queue_in(self, ep_num, seqnum, length):
+        self.in_urbs.setdefault(ep_num, deque()).append((seqnum, length))
+
+    def complete_in(self):
+        """(seqnum, data) for each pending IN URB that can be completed
+        from the data the device has sent; a transfer longer than the URB
+        is split, but two transfers never share one URB."""
+
+        done = [ ]
+
+        for ep_num, urbs in self.in_urbs.items():
+            pending = self.in_data.get(ep_num)
+            if urbs and not pending:
+                # like the IN buffer available interrupt: let the device
+                # produce data on demand (e.g. the next keystroke)
+                try:
+                    self.connected_device.handle_buffer_available(ep_num)
+                except Exception as e:
+                    # as on the MAXUSB path the endpoint is just left idle,
+                    # but not silently
+                    print(self.app_name, "error producing IN data on endpoint",
+                            ep_num, "-", repr(e))
+                    if self.verbose > 0:
+                        traceback.print_exc()
+                pending = self.in_data.get(ep_num)
+
+            while urbs and pending:
+                seqnum, length = urbs.popleft()
+                data = pending[0]
+                if len(data) > length:
+                    pending[0] = data[length:]
+                    data = data[:length]
+                else:
+                    pending.popleft()
+                done.append((seqnum, data))
+
+        return done
+
+    def unlink(self, seqnum):
+        """Drop a pending IN URB; False if it has already completed."""
+
+        for urbs in self.in_urbs.values():
+            for urb in urbs:
+                if urb[0] == seqnum:
+                    urbs.remove(urb)
+                    return True
+
+        return False
+
+    def waiting_for_data(self):
+        return any(urbs and not self.in_data.get(ep_num)
+                for ep_num, urbs in self.in_urbs.items())
+
+    def idle_expired(self, now):
+        timeout = self.idle_timeouts.get(self.mode)
+        if not timeout or self.last_activity is None:
+            return False
+
+        return now - self.last_activity >= timeout
+
+    def device_info(self, busnum, devnum):
+        d = self.connected_device
+        config = d.configurations[0] if d.configurations else None
+
+        info = usb_device_info.pack(
+                ("/sys/devices/umap/" + self.busid).encode(),
+                self.busid.encode(),
+                busnum, devnum, usb_speed_full,
+                d.vendor_id, d.product_id, d.device_rev,
+                d.device_class, d.device_subclass, d.protocol_rel_num,
+                0, len(d.configurations),
+                len(config.interfaces) if config else 0)
+
+        return info, config
+
+
+class USBIPSession:
+    """A USB/IP server on one TCP address exporting any number of emulated
+    devices.  begin_testcase() returns a fresh USBIPApp for each device,
+    which is exported when the device connects; serve() handles hosts
+    until every exported device has been detached or stopped.
+
+    Each device is exported on bus 1 under bus ID 1-N.  All devices are
+    served from the calling thread, so the models need no locking."""
+
+    poll_interval = 0.01
+
+    def __init__(self, address=("127.0.0.1", 3240), logfp=0):
+        self.address = address
+        self.logfp = logfp
+
+        self.sock = None
+        self.exports = { }              # busid -> USBIPApp
+        self.next_devnum = 1
+        self.clients = { }              # socket -> attached USBIPApp or None
+
+    def begin_testcase(self, mode, testcase, verbose=0):
+        return USBIPApp(self, self.logfp, mode, testcase, verbose=verbose)
+
+    def listen(self):
+        if self.sock is not None:
+            return
+
+        self.sock = socket(AF_INET, SOCK_STREAM)
+        self.sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+        self.sock.bind(self.address)
+        self.sock.listen(5)
+
+        print ("USB/IP server listening on %s:%d" % self.address)
+
+    def export(self, app):
+        self.listen()
+
+        app.devnum = self.next_devnum
+        app.busid = "1-%d" % app.devnum
+        self.next_devnum += 1
+        self.exports[app.busid] = app
+
+    def unexport(self, app):
+        self.exports.pop(app.busid, None)
+
+    def detach(self, app):
+        client = app.client
+        app.client = None
+        self.clients.pop(client, None)
+        client.close()
+
+    def close(self):
+        for client in list(self.clients):
+            client.close()
+        self.clients = { }
+
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    # serving
+    #####################################################
+
+    def serve(self):
+        while self.exports:
+            timeout = 0.5
+            if any(app.waiting_for_data() for app in self.exports.values()):
+                timeout = self.poll_interval
+
+            readable, _, _ = select.select([ self.sock ] + list(self.clients),
+                    [ ], [ ], timeout)
+
+            for sock in readable:
+                if sock is self.sock:
+                    client, address = self.sock.accept()
+                    client.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+                    self.clients[client] = None
+                    continue
+
+                if sock not in self.clients:
+                    continue        # closed while handling another socket
+
+                try:
+                    app = self.clients[sock]
+                    if app is None:
+                        self.handle_op(sock)
+                    else:
+                        self.handle_urb(app, sock)
+                except (ConnectionError, OSError, struct.error):
+                    self.drop(sock)
+
+            now = time.monotonic()
+            for app in list(self.exports.values()):
+                if app.client is None:
+                    continue
+
+                if app.stop or app.idle_expired(now):
+                    app.disconnect()
+                else:
+                    app.connected_device.handle_idle()
+                    self.send_in(app)
+
+    def drop(self, sock):
+        app = self.clients.pop(sock, None)
+        sock.close()
+
+        if app is not None:
+            # the host detached: the device is unplugged
+            app.client = None
+            app.disconnect()
+
+    def handle_op(self, sock):
+        version, code, status = op_header.unpack(recv_exact(sock, op_header.size))
+
+        if code == op_req_devlist:
+            reply = op_header.pack(usbip_version, op_rep_devlist, 0)
+            reply += struct.pack(">I", len(self.exports))
+            for app in self.exports.values():
+                info, config = app.device_info(1, app.devnum)
+                reply += info
+                for i in (config.interfaces if config else [ ]):
+                    reply += usb_interface_info.pack(i.iclass, i.subclass,
+                            i.protocol)
+
+            sock.sendall(reply)
+            self.drop(sock)
+
+        elif code == op_req_import:
+            busid = recv_exact(sock, 32).rstrip(b'\0').decode(errors="replace")
+            app = self.exports.get(busid)
+
+            if app is None or app.client is not None:
+                sock.sendall(op_header.pack(usbip_version, op_rep_import, 1))
+                self.drop(sock)
+                return
+
+            info, config = app.device_info(1, app.devnum)
+            sock.sendall(op_header.pack(usbip_version, op_rep_import, 0) + info)
+
+            app.client = sock
+            app.last_activity = time.monotonic()
+            self.clients[sock] = app
+            print ("USB/IP host attached to %s" % busid)
+
+        else:
+            print ("USB/IP: unknown operation 0x%04x" % code)
+            self.drop(sock)
+
+    def handle_urb(self, app, sock):
+        command, seqnum, devid, direction, ep = \
+                usbip_header.unpack(recv_exact(sock, usbip_header.size))
+
+        app.last_activity = time.monotonic()
+
+        if command == usbip_cmd_unlink:
+            unlink_seqnum, = unlink_header.unpack(recv_exact(sock, unlink_header.size))
+            status = status_unlinked if app.unlink(unlink_seqnum) else 0
+            sock.sendall(usbip_header.pack(usbip_ret_unlink, seqnum, 0, 0, 0) +
+                    ret_unlink_header.pack(status))
+            return
+
+        if command != usbip_cmd_submit:
+            raise ConnectionError("unknown USB/IP command %d" % command)
+
+        flags, length, start_frame, packets, interval, setup = \
+                submit_header.unpack(recv_exact(sock, submit_header.size))
+
+        data = b''
+        if direction == usbip_dir_out and length > 0:
+            data = recv_exact(sock, length)
+
+        if packets > 0:
+            # isochronous transfers are not emulated: accept and return
+            # every packet empty
+            descriptors = recv_exact(sock, packets * iso_descriptor.size)
+            frames = b''.join(iso_descriptor.pack(offset, size, 0, 0)
+                    for offset, size, _, _ in iso_descriptor.iter_unpack(descriptors))
+            self.ret_submit(sock, seqnum, 0,
+                    length if direction == usbip_dir_out else 0, b'',
+                    start_frame, packets, frames)
+            return
+
+        if ep == 0:
+            status, reply = app.handle_control(direction, setup, data, length)
+            self.ret_submit(sock, seqnum, status,
+                    len(reply) if direction == usbip_dir_in else len(data), reply)
+        elif direction == usbip_dir_out:
+            app.handle_out(ep, data)
+            self.ret_submit(sock, seqnum, 0, len(data), b'')
+        else:
+            app.queue_in(ep, seqnum, length)
+
+        self.send_in(app)
+
+    def send_in(self, app):
+        for seqnum, data in app.complete_in():
+            self.ret_submit(app.client, seqnum, 0, len(data), data)
+
+    def ret_submit(self, sock, seqnum, status, actual_length, data,
+            start_frame=0, packets=0, iso=b''):
+        sock.sendall(usbip_header.pack(usbip_ret_submit, seqnum, 0, 0, 0) +
+                ret_submit_header.pack(status, actual_length, start_frame,
+                        packets, 0) + data + iso)
+
+
+class USBIPClient:
+    """Just enough of a USB/IP host to list a server's devices, attach to
+    one and run control and bulk transfers against it, for testing the
+    emulated devices without the kernel's vhci driver."""
+
+    def __init__(self, address=("127.0.0.1", 3240)):
+        self.address = address
+        self.sock = None
+        self.seqnum = 0
+        self.devid = 0
+
+    def list_devices(self):
+        """[(busid, idVendor, idProduct, [(class, subclass, proto)...])]"""
+
+        sock = create_connection(self.address)
+        sock.sendall(op_header.pack(usbip_version, op_req_devlist, 0))
+
+        version, code, status = op_header.unpack(recv_exact(sock, op_header.size))
+        count, = struct.unpack(">I", recv_exact(sock, 4))
+
+        devices = [ ]
+        for i in range(count):
+            info = usb_device_info.unpack(recv_exact(sock, usb_device_info.size))
+            interfaces = [ usb_interface_info.unpack(recv_exact(sock,
+                    usb_interface_info.size)) for j in range(info[-1]) ]
+            devices.append((info[1].rstrip(b'\0').decode(), info[5], info[6],
+                    interfaces))
+
+        sock.close()
+        return devices
+
+    def attach(self, busid):
+        self.sock = create_connection(self.address)
+        self.sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+        self.sock.sendall(op_header.pack(usbip_version, op_req_import, 0) +
+                busid.encode().ljust(32, b'\0'))
+
+        version, code, status = op_header.unpack(recv_exact(self.sock, op_header.size))
+        if status != 0:
+            self.sock.close()
+            self.sock = None
+            raise ConnectionError("could not import %s" % busid)
+
+        info = usb_device_info.unpack(recv_exact(self.sock, usb_device_info.size))
+        self.devid = info[2] << 16 | info[3]
+
+    def detach(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def submit(self, ep, direction, length=0, data=b'', setup=bytes(8)):
+        """Send one URB and wait for its completion; returns (status,
+        data)."""
+
+        self.seqnum += 1
+        if direction == usbip_dir_out:
+            length = len(data)
+
+        self.sock.sendall(usbip_header.pack(usbip_cmd_submit, self.seqnum,
+                self.devid, direction, ep) +
+                submit_header.pack(0, length, 0, 0, 0, setup) +
+                (data if direction == usbip_dir_out else b''))
+
+        command, seqnum, devid, _, _ = \
+                usbip_header.unpack(recv_exact(self.sock, usbip_header.size))
+        status, actual, start_frame, packets, errors = \
+                ret_submit_header.unpack(recv_exact(self.sock, ret_submit_header.size))
+
+        reply = b''
+        if direction == usbip_dir_in and actual > 0:
+            reply = recv_exact(self.sock, actual)
+
+        return status, reply
+
+    def control(self, request_type, request, value=0, index=0, length=0, data=b''):
+        setup = struct.pack("<BBHHH", request_type, request, value, index,
+                length or len(data))
+        direction = usbip_dir_in if request_type & 0x80 else usbip_dir_out
+        return self.submit(0, direction, length, data, setup)
+
+    def get_descriptor(self, dtype, index=0, length=255):
+        return self.control(0x80, 6, dtype << 8 | index, 0, length)
+
+    def enumerate(self):
+        """Fetch the device and configuration descriptors and select the
+        first configuration, as a host does; returns the descriptors."""
+
+        status, device = self.get_descriptor(USB.desc_type_device, 0, 18)
+        status, config = self.get_descriptor(USB.desc_type_configuration, 0, 9)
+        if len(config) >= 4:
+            status, config = self.get_descriptor(USB.desc_type_configuration,
+                    0, config[2] | config[3] << 8)
+        self.control(0x00, 9, 1)
+
+        return device, config
+
+
+if __name__ == "__main__":
+    import sys
+
+    host, _, port = (sys.argv[1] if len(sys.argv) > 1 else "127.0.0.1:3240").rpartition(":")
+    client = USBIPClient((host or "127.0.0.1", int(port)))
+
+    for busid, vid, pid, interfaces in client.list_devices():
+        print ("%s: %04x:%04x, interfaces %s" % (busid, vid, pid,
+                ", ".join("%02x:%02x:%02x" % i for i in interfaces)))
+
+        client.attach(busid)
+        device, config = client.enumerate()
+        print ("  device descriptor:", bytes_as_hex(device))
+        print ("  configuration descriptor:", bytes_as_hex(config))
+        client.detach()
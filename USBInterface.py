@@ -64,17 +64,24 @@ class USBInterface:
                     % (dtype, dindex, lang, n))
 
         # TODO: handle KeyError
-        response = self.descriptors[dtype]
-        if callable(response):
-            response = response(dindex)
+        response = self.configuration.device.get_cached_descriptor(
+                (self, dtype, dindex), lambda: self.build_descriptor(dtype, dindex))
 
         if response:
             n = min(n, len(response))
-            self.configuration.device.maxusb_app.send_on_endpoint(0, response[:n])
+            self.configuration.device.maxusb_app.send_on_endpoint(0,
+                    memoryview(response)[:n])
 
             if self.verbose > 5:
                 print(self.name, "sent", n, "bytes in response")
 
+    def build_descriptor(self, dtype, dindex):
+        response = self.descriptors[dtype]
+        if callable(response):
+            response = response(dindex)
+
+        return response
+
     def handle_set_interface_request(self, req):
 
         trace = "Int:SetInt" 
@@ -90,20 +97,11 @@ class USBInterface:
     # Table 9-12 of USB 2.0 spec (pdf page 296)
     def get_descriptor(self):
 
-        if self.maxusb_app.testcase[1] == "int_bLength":
-            bLength = self.maxusb_app.testcase[2]
-        else:
-            bLength = 9
+        bLength = self.maxusb_app.overrides.get("int_bLength", 9)
 
-        if self.maxusb_app.testcase[1] == "int_bDescriptorType":
-            bDescriptorType = self.maxusb_app.testcase[2]
-        else:
-            bDescriptorType = 4
+        bDescriptorType = self.maxusb_app.overrides.get("int_bDescriptorType", 4)
 
-        if self.maxusb_app.testcase[1] == "int_bNumEndpoints":
-            bNumEndpoints = self.maxusb_app.testcase[2]
-        else:
-            bNumEndpoints = len(self.endpoints)
+        bNumEndpoints = self.maxusb_app.overrides.get("int_bNumEndpoints", len(self.endpoints))
 
         d = bytearray([
                 bLength,          # length of descriptor in bytes
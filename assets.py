@@ -0,0 +1,113 @@
+# assets.py
+#
+# Contains the AssetCache class: a process-wide cache of read-only file
+# mappings and prebuilt payloads shared by the device models, so that
+# building a device for every fuzz testcase doesn't reopen and remap the
+# same files.
+
+from collections import OrderedDict
+from mmap import mmap, ACCESS_READ
+import os
+
+class Asset:
+    """A read-only mapping of one file.  data is an mmap, or b'' for an
+    empty file.  The mapping holds the only descriptor for the file, so
+    open descriptors are bounded by the active and idle assets."""
+
+    def __init__(self, path, st):
+        self.path = path
+        self.signature = (st.st_size, st.st_mtime_ns)
+        self.refs = 0
+
+        with open(path, 'rb') as f:
+            if st.st_size == 0:
+                self.data = b''
+            else:
+                self.data = mmap(f.fileno(), 0, access=ACCESS_READ)
+
+    def __len__(self):
+        return len(self.data)
+
+    def close(self):
+        if isinstance(self.data, mmap):
+            self.data.close()
+        self.data = None
+
+
+class AssetCache:
+    """Reference counted file mappings.  acquire() returns the shared
+    Asset for a file, mapping it on first use; release() drops a
+    reference.  Unreferenced assets stay mapped on an LRU list of at most
+    max_idle entries, and are remapped if the file has changed by the
+    time they are acquired again.
+
+    payload() caches any other value built once per process, such as a
+    default response, on its own LRU of max_payloads entries."""
+
+    max_idle = 32
+    max_payloads = 256
+
+    def __init__(self, max_idle=None, max_payloads=None):
+        if max_idle is not None:
+            self.max_idle = max_idle
+        if max_payloads is not None:
+            self.max_payloads = max_payloads
+
+        self.active = { }               # path -> Asset with refs > 0
+        self.idle = OrderedDict()       # path -> Asset, oldest first
+        self.payloads = OrderedDict()
+
+    def acquire(self, filename):
+        path = os.path.realpath(filename)
+        st = os.stat(path)
+
+        asset = self.active.get(path)
+        if asset is None:
+            asset = self.idle.pop(path, None)
+            if asset is not None and asset.signature != (st.st_size, st.st_mtime_ns):
+                asset.close()
+                asset = None
+            if asset is None:
+                asset = Asset(path, st)
+            self.active[path] = asset
+
+        asset.refs += 1
+        return asset
+
+    def release(self, asset):
+        asset.refs -= 1
+        if asset.refs > 0:
+            return
+
+        del self.active[asset.path]
+        self.idle[asset.path] = asset
+
+        while len(self.idle) > self.max_idle:
+            path, old = self.idle.popitem(last=False)
+            old.close()
+
+    def payload(self, key, build):
+        """The value cached under key, calling build() to make it the first
+        time."""
+
+        if key in self.payloads:
+            self.payloads.move_to_end(key)
+            return self.payloads[key]
+
+        value = build()
+        self.payloads[key] = value
+        while len(self.payloads) > self.max_payloads:
+            self.payloads.popitem(last=False)
+
+        return value
+
+    def clear(self):
+        """Unmap every idle asset and forget all payloads."""
+
+        for asset in self.idle.values():
+            asset.close()
+        self.idle.clear()
+        self.payloads.clear()
+
+
+asset_cache = AssetCache()
@@ -0,0 +1,331 @@
+# campaign.py
+#
+# Contains the fuzz campaign scheduler used when umap is given several
+# boards: testcases are handed out from one work queue to a worker process
+# per board, and each testcase's output is collected and printed in
+# testcase order, as if a single board had run them all.  Also contains
+# EnumerationPacer, the delay between one testcase and the next, and
+# CampaignState, the checkpoint file used by --resume.
+
+from collections import deque
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import queue
+import time
+
+from device_registry import load_testcases
+
+class EnumerationPacer:
+    """The pause between testcases, which gives the host time to notice
+    the last device has gone before the next one connects.
+
+    A fixed pacer always waits delay seconds.  An adaptive one adjusts the
+    delay after every testcase from how soon the host enumerated the
+    device, as measured by the MAXUSBApp from the connect to the first bus
+    reset and to the first setup packet: if both came about as fast as the
+    fastest of the recent testcases, the host was ready and the delay
+    shrinks; a slow one, or no setup packet at all, means it was still
+    busy, so the delay grows.  A reset that was not seen is not held
+    against the host.  It stays within min_delay and max_delay."""
+
+    history_size = 16
+    shrink = 0.75
+    grow = 2.0
+    slack = 1.5                 # ready if within slack x the best latency
+    tolerance = 0.02            # plus this many seconds of jitter
+
+    def __init__(self, delay=1.0, adaptive=False, min_delay=0.05, max_delay=5.0):
+        self.adaptive = adaptive
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.delay = delay
+
+        if adaptive:
+            self.delay = min(max(delay, min_delay), max_delay)
+
+        self.history = deque(maxlen=self.history_size)         # setup
+        self.reset_history = deque(maxlen=self.history_size)
+
+    def observe(self, app):
+        """Adjust the delay after a testcase run on app."""
+
+        if not self.adaptive or app is None or not hasattr(app, "setup_latency"):
+            return
+
+        ready = self.prompt(self.history, app.setup_latency)
+        if app.reset_latency is not None:
+            ready = self.prompt(self.reset_history, app.reset_latency) and ready
+
+        if ready:
+            self.delay = max(self.delay * self.shrink, self.min_delay)
+        else:
+            self.delay = min(self.delay * self.grow, self.max_delay)
+
+    def prompt(self, history, latency):
+        """Whether latency is about as low as the best in history, which
+        it is added to."""
+
+        if latency is None:
+            return False
+
+        history.append(latency)
+        return latency <= min(history) * self.slack + self.tolerance
+
+    def wait(self):
+        time.sleep(self.delay)
+
+    def __str__(self):
+        if not self.adaptive:
+            return "%gs" % self.delay
+
+        return "adaptive %g-%gs, now %.2fs" % (self.min_delay,
+                self.max_delay, self.delay)
+
+
+class CampaignState:
+    """The progress of a -f campaign: the FUZZC argument it was started
+    with and a record of every testcase run so far (phase, index, board,
+    start and finish times, outcome).  It is saved after each testcase, by
+    writing a temporary file and renaming it over path, so the file always
+    holds a complete state even if umap is killed mid-write.
+
+    A testcase counts as done once it has run, whether or not the host
+    answered; one that failed to start or was interrupted is run again on
+    resume.  finished is set once the whole campaign has been run."""
+
+    version = 1
+    done_outcomes = ("ok", "no response")
+
+    def __init__(self, path, campaign):
+        self.path = path
+        self.campaign = campaign
+        self.started = timestamp()
+        self.updated = self.started
+        self.cases = [ ]
+        self.done = set()           # (phase, index)
+        self.finished = None
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            data = json.load(f)
+
+        if data.get("version") != cls.version:
+            raise ValueError("unsupported state file version")
+
+        state = cls(path, data["campaign"])
+        state.started = data["started"]
+        state.updated = data["updated"]
+        state.cases = data["cases"]
+        state.done = set((c["phase"], c["index"]) for c in state.cases
+                if c["outcome"] in cls.done_outcomes)
+        state.finished = data.get("finished")
+
+        return state
+
+    def completed(self, phase, index):
+        return (phase, index) in self.done
+
+    def record(self, phase, index, started, outcome, board=None):
+        self.updated = timestamp()
+        self.cases.append({
+            "phase"     : phase,
+            "index"     : index,
+            "board"     : board,
+            "started"   : timestamp(started),
+            "finished"  : self.updated,
+            "outcome"   : outcome,
+        })
+        if outcome in self.done_outcomes:
+            self.done.add((phase, index))
+        self.save()
+
+    def finish(self):
+        """Mark the campaign finished, unless a testcase is left to rerun."""
+
+        if all((c["phase"], c["index"]) in self.done for c in self.cases):
+            self.finished = timestamp()
+            self.save()
+
+    def save(self):
+        data = {
+            "version"   : self.version,
+            "campaign"  : self.campaign,
+            "started"   : self.started,
+            "updated"   : self.updated,
+            "finished"  : self.finished,
+            "cases"     : self.cases,
+        }
+
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(data, f, indent=1)
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(tmp, self.path)
+
+def timestamp(t=None):
+    return time.strftime("%Y/%m/%d %H:%M:%S", time.localtime(t))
+
+def open_session(port, logfp=0):
+    """A session for one -P port: a serial port, "sim" or
+    "usbip[:HOST:PORT]"."""
+
+    if port == "sim":
+        from MAXUSBApp import MAXUSBSession
+        from MAXUSBSim import SimulatedSerialPort
+        return MAXUSBSession(SimulatedSerialPort(), logfp)
+
+    if str(port).startswith("usbip"):
+        from USBIPApp import USBIPSession
+        host, _, tcp_port = port[len("usbip:"):].rpartition(":")
+        return USBIPSession((host or "127.0.0.1", int(tcp_port or 3240)), logfp)
+
+    from MAXUSBApp import MAXUSBSession
+    from serial import Serial, PARITY_NONE
+    return MAXUSBSession(Serial(port, 115200, parity=PARITY_NONE, timeout=2), logfp)
+
+def fuzz_worker(port, entry, usbids, vid, pid, rev, pacer, logging, work, results):
+    """Run testcases from work on one board until the queue is drained or
+    the board's host stops responding; each board paces itself with its
+    own copy of pacer.  Each result is (seq, port, start
+    time, printed output, log output, outcome); a final None seq says the
+    worker is done."""
+
+    tables = {
+        "E" : load_testcases("testcases_class_independent"),
+        "C" : entry.testcases(),
+    }
+    session = None
+
+    while True:
+        item = work.get()
+        if item is None:
+            break
+
+        seq, phase, index = item
+        out = io.StringIO()
+        log = io.StringIO() if logging else 0
+        started = time.time()
+        outcome = "ok"
+        u = None
+
+        with contextlib.redirect_stdout(out):
+            try:
+                if session is None:
+                    session = open_session(port)
+
+                u = session.begin_testcase(entry.fuzz_mode, tables[phase][index])
+                u.fplog = log
+                d = entry.create(u, vid, pid, rev, usbids)
+
+                try:
+                    d.connect()
+                except Exception:
+                    pass
+
+                d.run()
+            except SystemExit:
+                # MAXUSBApp gives up when the host stops answering
+                outcome = "no response"
+            except Exception as e:
+                outcome = "error: %s" % e
+
+        results.put((seq, port, started, out.getvalue(),
+                log and log.getvalue(), outcome))
+
+        if outcome != "ok":
+            break
+
+        pacer.observe(u)
+        pacer.wait()
+
+    results.put((None, port, time.time(), "", "", "done"))
+
+def run_campaign(ports, entry, usbids, vid, pid, rev, pacer, cases, fplog=None,
+        state=None):
+    """Shard cases, a list of (phase, index, description) with phase "E"
+    or "C", across one worker process per port, each emulating entry (a
+    DeviceClass, passed whole so options set on it go along).  Output is
+    printed (and logged) in case order, and each case is recorded in the
+    CampaignState state as soon as it finishes.  Returns the number of
+    cases that were not run because every board stopped early."""
+
+    ctx = multiprocessing.get_context()
+    work = ctx.Queue()
+    results = ctx.Queue()
+
+    for seq, (phase, index, description) in enumerate(cases):
+        work.put((seq, phase, index))
+    for port in ports:
+        work.put(None)
+
+    workers = [ ctx.Process(target=fuzz_worker, daemon=True,
+                    args=(port, entry, usbids, vid, pid, rev, pacer, bool(fplog),
+                          work, results))
+                for port in ports ]
+    for w in workers:
+        w.start()
+
+    finished = { }          # seq -> result, until its turn to be printed
+    next_seq = 0
+    running = len(workers)
+
+    while next_seq < len(cases) and running:
+        try:
+            result = results.get(timeout=1)
+        except queue.Empty:
+            # a worker that died outright never reports done
+            running = sum(w.is_alive() for w in workers)
+            continue
+
+        if result[0] is None:
+            running -= 1
+            continue
+
+        finished[result[0]] = result
+        if state:
+            seq, port, started, output, log, outcome = result
+            state.record(cases[seq][0], cases[seq][1], started, outcome, str(port))
+
+        while next_seq in finished:
+            report(cases[next_seq], finished.pop(next_seq), fplog)
+            next_seq += 1
+
+    # cases lost with a board that stopped
+    skipped = 0
+    for seq in range(next_seq, len(cases)):
+        if seq in finished:
+            report(cases[seq], finished.pop(seq), fplog)
+        else:
+            skipped += 1
+
+    for w in workers:
+        w.join(1)
+        if w.is_alive():
+            w.terminate()
+
+    return skipped
+
+def report(case, result, fplog):
+    phase, index, description = case
+    seq, port, started, output, log, outcome = result
+
+    print_output = " %s [%s]" % (description, port)
+    print (timestamp(started) + print_output)
+    if output:
+        print (output, end="")
+    if outcome != "ok":
+        print ("*** %s: %s ***" % (port, outcome))
+
+    if fplog:
+        fplog.write (timestamp(started))
+        fplog.write (print_output)
+        if log:
+            fplog.write (log)
+        if outcome != "ok":
+            fplog.write ("\n*** %s: %s ***\n" % (port, outcome))
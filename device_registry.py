@@ -0,0 +1,144 @@
+# device_registry.py
+#
+# Contains the registry of emulated device classes used by umap.  Device
+# modules and testcase tables are only imported once a class is selected.
+
+import importlib
+
+class DeviceClass:
+    """One emulated device model.  module/device_name name the USBDevice
+    subclass; it is imported the first time a device is created."""
+
+    def __init__(self, label, module, device_name, testcases=None,
+            emulate_mode=3, fuzz_mode=3, class_ids=False, fixed_ids=None,
+            extra_args=(), extra_kwargs=None, netserver=False,
+            setup_error=None):
+        self.label = label
+        self.module = module
+        self.device_name = device_name
+        self.testcase_table = testcases     # name of a list in testcases.py
+        self.emulate_mode = emulate_mode    # MAXUSBApp mode used by -e
+        self.fuzz_mode = fuzz_mode          # MAXUSBApp mode used by -f/-s
+        self.class_ids = class_ids          # constructor takes class:sub:proto
+        self.fixed_ids = fixed_ids
+        self.extra_args = tuple(extra_args)
+        self.extra_kwargs = dict(extra_kwargs or { })
+        self.netserver = netserver          # honours -n
+        self.setup_error = setup_error      # printed if the device can't be built
+        self.device = None
+
+    def load(self):
+        if self.device is None:
+            m = importlib.import_module(self.module)
+            self.device = getattr(m, self.device_name)
+
+        return self.device
+
+    def create(self, maxusb_app, vid, pid, rev, usbids, verbose=0):
+        args = [ maxusb_app, vid, pid, rev ]
+        if self.class_ids:
+            args += list(self.fixed_ids or usbids)
+        args += self.extra_args
+
+        return self.load()(*args, verbose=verbose, **self.extra_kwargs)
+
+    def __getstate__(self):
+        # sent to campaign workers by name; they import the module themselves
+        state = dict(self.__dict__)
+        state["device"] = None
+        return state
+
+    def testcases(self):
+        if not self.testcase_table:
+            return None
+
+        return load_testcases(self.testcase_table)
+
+
+# (class, subclass, protocol) -> DeviceClass; None in the subclass or
+# protocol position matches anything
+device_classes = { }
+
+def register_device_class(usb_class, subclass, protocol, device_class):
+    device_classes[(usb_class, subclass, protocol)] = device_class
+
+def lookup_device_class(usb_class, subclass, protocol):
+    for key in ((usb_class, subclass, protocol),
+                (usb_class, subclass, None),
+                (usb_class, None, None)):
+        if key in device_classes:
+            return device_classes[key]
+
+    return None
+
+def supported_device_ids():
+    """class:subclass:proto triples umap knows about: the built-in list
+    followed by any exact triples registered by plugins."""
+
+    from device_class_data import supported_devices
+
+    ids = [ list(x) for x in supported_devices ]
+    for key in device_classes:
+        if None not in key and list(key) not in ids:
+            ids.append(list(key))
+
+    return ids
+
+def load_testcases(name):
+    return getattr(importlib.import_module("testcases"), name)
+
+def load_plugins(module_names):
+    """Import third-party device modules; each registers its classes with
+    register_device_class() at import time."""
+
+    for name in module_names:
+        importlib.import_module(name)
+
+
+register_device_class(1, None, None, DeviceClass("Audio",
+        "devices.USBAudio", "USBAudioDevice",
+        testcases="testcases_audio_class"))
+
+register_device_class(2, None, None, DeviceClass("CDC",
+        "devices.USBCDC", "USBCDCDevice"))
+
+register_device_class(3, None, None, DeviceClass("HID",
+        "devices.USBKeyboard", "USBKeyboardDevice",
+        testcases="testcases_hid_class"))
+
+register_device_class(6, None, None, DeviceClass("Image",
+        "devices.USBImage", "USBImageDevice",
+        testcases="testcases_image_class", emulate_mode=2, class_ids=True,
+        extra_args=("ncc_group_logo.jpg",), netserver=True))
+
+register_device_class(7, None, None, DeviceClass("Printer",
+        "devices.USBPrinter", "USBPrinterDevice",
+        testcases="testcases_printer_class", emulate_mode=0, class_ids=True))
+
+register_device_class(8, None, None, DeviceClass("Mass Storage",
+        "devices.USBMassStorage", "USBMassStorageDevice",
+        testcases="testcases_mass_storage_class", fuzz_mode=4,
+        class_ids=True, extra_args=("stick.img",), netserver=True,
+        setup_error="disk image not found - create stick.img using dd or pass --disk DIR"))
+
+register_device_class(9, None, None, DeviceClass("Hub",
+        "devices.USBHub", "USBHubDevice",
+        testcases="testcases_hub_class"))
+
+register_device_class(10, None, None, DeviceClass("CDC Data",
+        "devices.USBCDC", "USBCDCDevice", emulate_mode=0))
+
+register_device_class(11, None, None, DeviceClass("Smartcard",
+        "devices.USBSmartcard", "USBSmartcardDevice",
+        testcases="testcases_smartcard_class", netserver=True))
+
+# HACK: video hosts are fuzzed with the image device
+register_device_class(14, None, None, DeviceClass("Video",
+        "devices.USBImage", "USBImageDevice",
+        class_ids=True, fixed_ids=(0xe, 1, 0),
+        extra_args=("ncc_group_logo.jpg",)))
+
+# selected by -A and -b rather than by class
+iphone_device = DeviceClass("iPhone", "devices.USBIphone", "USBIphoneDevice")
+vendor_device = DeviceClass("Vendor specific", "devices.USBVendorSpecific",
+        "USBVendorDevice")
@@ -91,22 +91,10 @@ class USBAudioInterface(USBInterface):
                 USB.desc_type_report : self.report_descriptor
         }
 
-        if self.maxusb_app.testcase[1] == "CSInterface1_wTotalLength":
-            wTotalLength = self.maxusb_app.testcase[2]
-        else:
-            wTotalLength = 0x0047
-        if self.maxusb_app.testcase[1] == "CSInterface1_bInCollection":
-            bInCollection = self.maxusb_app.testcase[2]
-        else:
-            bInCollection = 0x02
-        if self.maxusb_app.testcase[1] == "CSInterface1_baInterfaceNr1":
-            baInterfaceNr1 = self.maxusb_app.testcase[2]
-        else:
-            baInterfaceNr1 = 0x01
-        if self.maxusb_app.testcase[1] == "CSInterface1_baInterfaceNr2":
-            baInterfaceNr2 = self.maxusb_app.testcase[2]
-        else:
-            baInterfaceNr2 = 0x02
+        wTotalLength = self.maxusb_app.overrides.get("CSInterface1_wTotalLength", 0x0047)
+        bInCollection = self.maxusb_app.overrides.get("CSInterface1_bInCollection", 0x02)
+        baInterfaceNr1 = self.maxusb_app.overrides.get("CSInterface1_baInterfaceNr1", 0x01)
+        baInterfaceNr2 = self.maxusb_app.overrides.get("CSInterface1_baInterfaceNr2", 0x02)
 
         cs_config1 = [
             0x01,           # HEADER
@@ -117,26 +105,11 @@ class USBAudioInterface(USBInterface):
             baInterfaceNr2  # baInterfaceNr2
         ]
 
-        if self.maxusb_app.testcase[1] == "CSInterface2_bTerminalID":
-            bTerminalID = self.maxusb_app.testcase[2]
-        else:
-            bTerminalID = 0x01
-        if self.maxusb_app.testcase[1] == "CSInterface2_wTerminalType":
-            wTerminalType = self.maxusb_app.testcase[2]
-        else:
-            wTerminalType = 0x0101
-        if self.maxusb_app.testcase[1] == "CSInterface2_bAssocTerminal":
-            bAssocTerminal = self.maxusb_app.testcase[2]
-        else:
-            bAssocTerminal = 0x0
-        if self.maxusb_app.testcase[1] == "CSInterface2_bNrChannel":
-            bNrChannel = self.maxusb_app.testcase[2]
-        else:
-            bNrChannel = 0x02
-        if self.maxusb_app.testcase[1] == "CSInterface2_wChannelConfig":
-            wChannelConfig = self.maxusb_app.testcase[2]
-        else:
-            wChannelConfig = 0x0002
+        bTerminalID = self.maxusb_app.overrides.get("CSInterface2_bTerminalID", 0x01)
+        wTerminalType = self.maxusb_app.overrides.get("CSInterface2_wTerminalType", 0x0101)
+        bAssocTerminal = self.maxusb_app.overrides.get("CSInterface2_bAssocTerminal", 0x0)
+        bNrChannel = self.maxusb_app.overrides.get("CSInterface2_bNrChannel", 0x02)
+        wChannelConfig = self.maxusb_app.overrides.get("CSInterface2_wChannelConfig", 0x0002)
 
         cs_config2 = [
             0x02,           # INPUT_TERMINAL
@@ -160,10 +133,7 @@ class USBAudioInterface(USBInterface):
             0           # iTerminal
         ]
 
-        if self.maxusb_app.testcase[1] == "CSInterface4_bSourceID":
-            bSourceID = self.maxusb_app.testcase[2]
-        else:
-            bSourceID = 0x09
+        bSourceID = self.maxusb_app.overrides.get("CSInterface4_bSourceID", 0x09)
 
         cs_config4 = [
             0x03,       # OUTPUT_TERMINAL
@@ -183,30 +153,12 @@ class USBAudioInterface(USBInterface):
             0           # iTerminal
         ]
 
-        if self.maxusb_app.testcase[1] == "CSInterface6_bUnitID":
-            bUnitID = self.maxusb_app.testcase[2]
-        else:
-            bUnitID = 0x09
-        if self.maxusb_app.testcase[1] == "CSInterface6_bSourceID":
-            bSourceID = self.maxusb_app.testcase[2]
-        else:
-            bSourceID = 0x01
-        if self.maxusb_app.testcase[1] == "CSInterface6_bControlSize":
-            bControlSize = self.maxusb_app.testcase[2]
-        else:
-            bControlSize = 0x01
-        if self.maxusb_app.testcase[1] == "CSInterface6_bmaControls0":
-            bmaControls0 = self.maxusb_app.testcase[2]
-        else:
-            bmaControls0 = 0x01
-        if self.maxusb_app.testcase[1] == "CSInterface6_bmaControls1":
-            bmaControls1 = self.maxusb_app.testcase[2]
-        else:
-            bmaControls1 = 0x02
-        if self.maxusb_app.testcase[1] == "CSInterface6_bmaControls2":
-            bmaControls2 = self.maxusb_app.testcase[2]
-        else:
-            bmaControls2 = 0x02
+        bUnitID = self.maxusb_app.overrides.get("CSInterface6_bUnitID", 0x09)
+        bSourceID = self.maxusb_app.overrides.get("CSInterface6_bSourceID", 0x01)
+        bControlSize = self.maxusb_app.overrides.get("CSInterface6_bControlSize", 0x01)
+        bmaControls0 = self.maxusb_app.overrides.get("CSInterface6_bmaControls0", 0x01)
+        bmaControls1 = self.maxusb_app.overrides.get("CSInterface6_bmaControls1", 0x02)
+        bmaControls2 = self.maxusb_app.overrides.get("CSInterface6_bmaControls2", 0x02)
 
         cs_config6 = [
             0x06,           # FEATURE_UNIT
@@ -50,38 +50,14 @@ class USBHubInterface(USBInterface):
         self.maxusb_app = maxusb_app
 
 
-        if self.maxusb_app.testcase[1] == "hub_bLength":
-            bLength = self.maxusb_app.testcase[2]
-        else:
-            bLength = 9
-        if self.maxusb_app.testcase[1] == "hub_bDescriptorType":
-            bDescriptorType = self.maxusb_app.testcase[2]
-        else:
-            bDescriptorType = 0x29
-        if self.maxusb_app.testcase[1] == "hub_bNbrPorts":
-            bNbrPorts = self.maxusb_app.testcase[2]
-        else:
-            bNbrPorts = 4
-        if self.maxusb_app.testcase[1] == "hub_wHubCharacteristics":
-            wHubCharacteristics = self.maxusb_app.testcase[2]
-        else:
-            wHubCharacteristics = 0xe000
-        if self.maxusb_app.testcase[1] == "hub_bPwrOn2PwrGood":
-            bPwrOn2PwrGood = self.maxusb_app.testcase[2]
-        else:
-            bPwrOn2PwrGood = 0x32
-        if self.maxusb_app.testcase[1] == "hub_bHubContrCurrent":
-            bHubContrCurrent = self.maxusb_app.testcase[2]
-        else:
-            bHubContrCurrent = 0x64
-        if self.maxusb_app.testcase[1] == "hub_DeviceRemovable":
-            DeviceRemovable = self.maxusb_app.testcase[2]
-        else:
-            DeviceRemovable = 0
-        if self.maxusb_app.testcase[1] == "hub_PortPwrCtrlMask":
-            PortPwrCtrlMask = self.maxusb_app.testcase[2]
-        else:
-            PortPwrCtrlMask = 0xff
+        bLength = self.maxusb_app.overrides.get("hub_bLength", 9)
+        bDescriptorType = self.maxusb_app.overrides.get("hub_bDescriptorType", 0x29)
+        bNbrPorts = self.maxusb_app.overrides.get("hub_bNbrPorts", 4)
+        wHubCharacteristics = self.maxusb_app.overrides.get("hub_wHubCharacteristics", 0xe000)
+        bPwrOn2PwrGood = self.maxusb_app.overrides.get("hub_bPwrOn2PwrGood", 0x32)
+        bHubContrCurrent = self.maxusb_app.overrides.get("hub_bHubContrCurrent", 0x64)
+        DeviceRemovable = self.maxusb_app.overrides.get("hub_DeviceRemovable", 0)
+        PortPwrCtrlMask = self.maxusb_app.overrides.get("hub_PortPwrCtrlMask", 0xff)
 
         hub_descriptor = bytes([
                 bLength,                        # length of descriptor in bytes
@@ -2,8 +2,8 @@
 #
 # Contains class definitions to implement a USB image device.
 
-from mmap import mmap
 import os
+import struct
 
 from USB import *
 from USBDevice import *
@@ -13,6 +13,11 @@ from USBEndpoint import *
 from USBClass import *
 
 from util import *
+from assets import asset_cache
+from devices.ptpstore import PTPObjectStore, ptp_string, ptp_date
+
+def pack_uint32_array(values):
+    return struct.pack('<%dI' % len(values), *values)
 
 class USBImageClass(USBClass):
     name = "USB image class"
@@ -30,9 +35,10 @@ class USBImageClass(USBClass):
 class USBImageInterface(USBInterface):
     name = "USB image interface"
 
-    def __init__(self, int_num, maxusb_app, thumb_image, partial_image, usbclass, sub, proto, verbose=0):
+    def __init__(self, int_num, maxusb_app, thumb_image, partial_image, usbclass, sub, proto, verbose=0, object_store=None):
         self.thumb_image = thumb_image
         self.partial_image = partial_image
+        self.object_store = object_store
         self.maxusb_app = maxusb_app
         self.int_num = int_num
         descriptors = { }
@@ -98,23 +104,154 @@ class USBImageInterface(USBInterface):
         self.device_class.set_interface(self)
 
 
-    def create_send_ok (self, transaction_id):
+    def create_send_ok (self, transaction_id, *parameters):
 
         if self.verbose > 0:
             print(self.name, "sent Image:OK")
 
+        return self.create_response(transaction_id, 0x2001, *parameters)
 
+    def create_response(self, transaction_id, code, *parameters):
         container_type = b'\x00\x03' # Response block
-        response_code = b'\x20\x01'  # "OK"
-        container_length = b'\x00\x00\x00\x0c' # always this length
+        response_code = code.to_bytes(2, 'big')
+        container_length = (12 + 4 * len(parameters)).to_bytes(4, 'big')
 
         response = change_byte_order(container_length) + \
                    change_byte_order(container_type) + \
                    change_byte_order(response_code) + \
                    change_byte_order(transaction_id)
 
+        for p in parameters:
+            response += p.to_bytes(4, 'little')
+
         return response
 
+    def create_data_header(self, container_type, operation_code,
+            transaction_id, payload_length, container_length_bytes=None):
+        """Header of a data container for payload_length bytes of data;
+        container_length_bytes (little endian) replaces the real length."""
+
+        if container_length_bytes is None:
+            # objects of 4GB or more are sent with the length saturated
+            container_length = min(payload_length + 12, 0xffffffff)
+            container_length_bytes = container_length.to_bytes(4, 'little')
+
+        return container_length_bytes + \
+               change_byte_order(container_type) + \
+               change_byte_order(operation_code) + \
+               change_byte_order(transaction_id)
+
+    def send_data_container(self, header, payload):
+        """Send header and payload as one bulk transfer without joining
+        them: the header is topped up to a full FIFO packet from the
+        payload, so the rest of it can go out as a view."""
+
+        app = self.configuration.device.maxusb_app
+        split = app.fifo_size - len(header)
+
+        if self.verbose > 2:
+            print(self.name, "responding with", len(header) + len(payload),
+                    "bytes of data container")
+
+        app.send_on_endpoint(2, header + bytes(payload[:split]))
+        if len(payload) > split:
+            app.send_on_endpoint(2, payload[split:])
+
+    def get_object_handles(self, container):
+        """Handles for a GetObjectHandles or GetNumObjects request."""
+
+        if not self.object_store:
+            return [ 0x421942ca ]
+
+        return self.object_store.object_handles(
+                int.from_bytes(container.parameter1, 'little'),
+                int.from_bytes(container.parameter2, 'little'),
+                int.from_bytes(container.parameter3, 'little'))
+
+    def is_invalid_object(self, opcode, container):
+        """True if an object request names no object, or asks for the data
+        of a folder."""
+
+        if opcode not in (0x1008, 0x1009, 0x100a, 0x101b):
+            return False
+
+        obj = self.object_store.get_object(int.from_bytes(container.parameter1, 'little'))
+        return obj is None or (obj.is_dir and opcode in (0x1009, 0x101b))
+
+    def get_object_info(self, container):
+        """ObjectInfo defaults, in the big endian form the GetObjectInfo
+        builder uses, for the object named by the request; empty without
+        an object store."""
+
+        if not self.object_store:
+            return { }
+
+        store = self.object_store
+        obj = store.get_object(int.from_bytes(container.parameter1, 'little'))
+        width, height, thumb_size, thumb_width, thumb_height = store.object_details(obj)
+
+        return {
+            "StorageID" : obj.storage.to_bytes(4, 'big'),
+            "ObjectFormat" : obj.format.to_bytes(2, 'big'),
+            "ObjectCompressedSize" : min(obj.size, 0xffffffff).to_bytes(4, 'big'),
+            "ThumbFormat" : (0x3808 if thumb_size else 0).to_bytes(2, 'big'), # JFIF
+            "ThumbCompressedSize" : thumb_size.to_bytes(4, 'big'),
+            "ThumbPixelWidth" : thumb_width.to_bytes(4, 'big'),
+            "ThumbPixelHeight" : thumb_height.to_bytes(4, 'big'),
+            "ImagePixelWidth" : width.to_bytes(4, 'big'),
+            "ImagePixelHeight" : height.to_bytes(4, 'big'),
+            "ImagePixelDepth" : (24 if width else 0).to_bytes(4, 'big'),
+            "ParentObject" : obj.parent.to_bytes(4, 'big'),
+            "AssociationType" : (1 if obj.is_dir else 0).to_bytes(2, 'big'), # generic folder
+            "Filename" : ptp_string(obj.name),
+            "CaptureDate" : ptp_date(obj.mtime),
+            "ModificationDate" : ptp_date(obj.mtime),
+        }
+
+    def get_storage_info(self, container):
+        """StorageInfo defaults for the storage named by the request, as
+        for get_object_info()."""
+
+        if not self.object_store:
+            return { }
+
+        store = self.object_store
+        storage = store.get_storage(int.from_bytes(container.parameter1, 'little'))
+        if storage is None:
+            storage = store.get_storage(store.storage_ids()[0])
+
+        total, free = store.storage_usage(storage)
+
+        return {
+            "MaxCapacity" : total.to_bytes(8, 'big'),
+            "FreeSpaceInBytes" : free.to_bytes(8, 'big'),
+            "StorageDescription" : ptp_string(storage.description),
+            "VolumeLabel" : ptp_string(storage.description),
+        }
+
+    def send_object_range(self, obj, header_fields, offset, length):
+        """Send length bytes of obj from offset as a data container.  The
+        mapping comes from the asset cache, so a host reading an object in
+        many GetPartialObject chunks doesn't remap it each time.  Returns
+        the bytes sent."""
+
+        container_type, operation_code, transaction_id, container_length_bytes = header_fields
+        asset = asset_cache.acquire(obj.path)
+        try:
+            data = memoryview(asset.data)[offset:offset + length]
+            try:
+                sent = len(data)
+                header = self.create_data_header(container_type,
+                        operation_code, transaction_id, sent,
+                        container_length_bytes)
+                self.send_data_container(header, data)
+            finally:
+                data.release()
+        finally:
+            asset_cache.release(asset)
+
+        return sent
+
     def handle_data_available(self, data):
         if self.verbose > 0:
             print(self.name, "handling", len(data), "bytes of Image class data")
@@ -133,20 +270,20 @@ class USBImageInterface(USBInterface):
         #print ("DEBUG: container type:", container_type) 
 
 
-        if self.maxusb_app.testcase[1] == "DeviceInfo_TransactionID":
-            transaction_id = change_byte_order(self.maxusb_app.testcase[2])
-        elif self.maxusb_app.testcase[1] == "StorageIDArray_TransactionID":
-            transaction_id = change_byte_order(self.maxusb_app.testcase[2])
-        elif self.maxusb_app.testcase[1] == "StorageInfo_TransactionID":
-            transaction_id = change_byte_order(self.maxusb_app.testcase[2])
-        elif self.maxusb_app.testcase[1] == "ObjectHandles_TransactionID":
-            transaction_id = change_byte_order(self.maxusb_app.testcase[2])
-        elif self.maxusb_app.testcase[1] == "ObjectInfo_TransactionID":
-            transaction_id = change_byte_order(self.maxusb_app.testcase[2])
-        elif self.maxusb_app.testcase[1] == "ThumbData_TransactionID":
-            transaction_id = change_byte_order(self.maxusb_app.testcase[2])
-        elif self.maxusb_app.testcase[1] == "PartialData_TransactionID":
-            transaction_id = change_byte_order(self.maxusb_app.testcase[2])
+        if "DeviceInfo_TransactionID" in self.maxusb_app.overrides:
+            transaction_id = change_byte_order(self.maxusb_app.overrides["DeviceInfo_TransactionID"])
+        elif "StorageIDArray_TransactionID" in self.maxusb_app.overrides:
+            transaction_id = change_byte_order(self.maxusb_app.overrides["StorageIDArray_TransactionID"])
+        elif "StorageInfo_TransactionID" in self.maxusb_app.overrides:
+            transaction_id = change_byte_order(self.maxusb_app.overrides["StorageInfo_TransactionID"])
+        elif "ObjectHandles_TransactionID" in self.maxusb_app.overrides:
+            transaction_id = change_byte_order(self.maxusb_app.overrides["ObjectHandles_TransactionID"])
+        elif "ObjectInfo_TransactionID" in self.maxusb_app.overrides:
+            transaction_id = change_byte_order(self.maxusb_app.overrides["ObjectInfo_TransactionID"])
+        elif "ThumbData_TransactionID" in self.maxusb_app.overrides:
+            transaction_id = change_byte_order(self.maxusb_app.overrides["ThumbData_TransactionID"])
+        elif "PartialData_TransactionID" in self.maxusb_app.overrides:
+            transaction_id = change_byte_order(self.maxusb_app.overrides["PartialData_TransactionID"])
         else:
             transaction_id = bytes ([container.transaction_id[3], \
                                      container.transaction_id[2], \
@@ -158,15 +295,17 @@ class USBImageInterface(USBInterface):
         response2 = None
 
         if self.maxusb_app.server_running == True:
-            try:
-                self.maxusb_app.netserver_from_endpoint_sd.send(data)
-            except:
-                print ("Error: No network client connected")
-            while True:
-                if len(self.maxusb_app.reply_buffer) > 0:
-                    self.maxusb_app.send_on_endpoint(2, self.maxusb_app.reply_buffer)
-                    self.maxusb_app.reply_buffer = ""
-                    break
+            reply = self.maxusb_app.endpoint_bridge.request(1, data)
+            if reply:
+                self.maxusb_app.send_on_endpoint(2, reply)
+
+
+
+        elif self.object_store and self.is_invalid_object(opcode, container):
+            if self.verbose > 0:
+                print(self.name, "got opcode 0x%04x for unknown object" % opcode)
+
+            response = self.create_response(transaction_id, 0x2009) # Invalid_ObjectHandle
 
 
 
@@ -191,88 +330,84 @@ class USBImageInterface(USBInterface):
         elif opcode == 0x100a:      # GetThumb
             if self.verbose > 0:
                 print(self.name, "got GetThumb")
-            thumb_data = (self.thumb_image.read_data())
 
-            if self.maxusb_app.testcase[1] == "ThumbData_ContainerType":
-                container_type = change_byte_order(self.maxusb_app.testcase[2])
-            else:
-                container_type = b'\x00\x02' # Data block
-            if self.maxusb_app.testcase[1] == "ThumbData_OperationCode":
-                operation_code = change_byte_order(self.maxusb_app.testcase[2])
+            container_type = self.maxusb_app.overrides.get("ThumbData_ContainerType", b'\x00\x02', change_byte_order) # Data block
+            operation_code = self.maxusb_app.overrides.get("ThumbData_OperationCode", b'\x10\x0a', change_byte_order) # GetThumb
+            container_length_bytes = self.maxusb_app.overrides.get("ThumbData_ContainerLength", None, change_byte_order)
+
+            if self.object_store:
+                obj = self.object_store.get_object(int.from_bytes(container.parameter1, 'little'))
+                thumb = self.object_store.get_thumbnail(obj)
+                if thumb is None:
+                    # a folder, or no EXIF thumbnail to offer
+                    thumb = self.thumb_image.image
+                thumbnail_data_object = memoryview(thumb)
             else:
-                operation_code = b'\x10\x0a' # GetThumb
-                thumbnail_data_object = thumb_data
+                thumbnail_data_object = self.thumb_image.get_range(0, len(self.thumb_image.image))
 
-            response = change_byte_order(container_type) + \
-                       change_byte_order(operation_code) + \
-                       change_byte_order(transaction_id) 
+            try:
+                header = self.create_data_header(container_type,
+                        operation_code, transaction_id,
+                        len(thumbnail_data_object), container_length_bytes)
+                self.send_data_container(header, thumbnail_data_object)
+            finally:
+                thumbnail_data_object.release()
 
-            x = 0
-            while x < len(thumbnail_data_object):
-                response += bytes([thumbnail_data_object[x]])
-                x+=1
+            response2 = self.create_send_ok(transaction_id)
 
-            container_length = len(response) + 4
 
 
-            if self.maxusb_app.testcase[1] == "ThumbData_ContainerLength":
-                container_length_bytes = change_byte_order(self.maxusb_app.testcase[2])
+        elif opcode == 0x101b:      # GetPartialObject
+            offset = int.from_bytes(container.parameter2, 'little')
+            max_bytes = int.from_bytes(container.parameter3, 'little')
+
+            if self.verbose > 0:
+                print(self.name, "got GetPartialObject, offset", offset,
+                        "max bytes", max_bytes)
+
+            container_type = self.maxusb_app.overrides.get("PartialObject_ContainerType", b'\x00\x02', change_byte_order) # Data block
+            operation_code = self.maxusb_app.overrides.get("PartialObject_OperationCode", b'\x10\x1b', change_byte_order) # GetPartialObject
+            container_length_bytes = self.maxusb_app.overrides.get("PartialObject_ContainerLength", None, change_byte_order)
+
+            if self.object_store:
+                obj = self.object_store.get_object(int.from_bytes(container.parameter1, 'little'))
+                sent = self.send_object_range(obj, (container_type,
+                        operation_code, transaction_id, container_length_bytes),
+                        offset, max_bytes)
             else:
-                container_length_bytes = bytes([
-                (container_length      ) & 0xff,
-                (container_length >>  8) & 0xff,
-                (container_length >> 16) & 0xff,
-                (container_length >> 24) & 0xff])
+                data_object = self.partial_image.get_range(offset, max_bytes)
+                try:
+                    sent = len(data_object)
+                    header = self.create_data_header(container_type,
+                            operation_code, transaction_id, sent,
+                            container_length_bytes)
+                    self.send_data_container(header, data_object)
+                finally:
+                    data_object.release()
 
-            response = container_length_bytes + response
-            response2 = self.create_send_ok(transaction_id)
+            # the response carries the number of bytes actually sent
+            response2 = self.create_send_ok(transaction_id, sent)
 
 
 
-        elif opcode == 0x101b:      # GetPartialObject
+        elif opcode == 0x1009 and self.object_store:      # GetObject
             if self.verbose > 0:
-                print(self.name, "got GetPartialObject")
+                print(self.name, "got GetObject")
 
+            obj = self.object_store.get_object(int.from_bytes(container.parameter1, 'little'))
+            self.send_object_range(obj, (b'\x00\x02', b'\x10\x09',
+                    transaction_id, None), 0, obj.size)
 
-#            return
-#            partial_data = (self.partial_image.read_data())
-
-#            if self.maxusb_app.testcase[1] == "PartialObject_ContainerType":
-#                container_type = change_byte_order(self.maxusb_app.testcase[2])
-#            else:
-#                container_type = b'\x00\x02' # Data block
-#            if self.maxusb_app.testcase[1] == "PartialObject_OperationCode":
-#                operation_code = change_byte_order(self.maxusb_app.testcase[2])
-#            else:
-#                operation_code = b'\x10\x1b' # GetPartialObject
-#                data_object = partial_data
-#
-#            response = change_byte_order(container_type) + \
-#                       change_byte_order(operation_code) + \
-#                       change_byte_order(transaction_id)
-#
-#            x = 0
-#            while x < len(data_object):
-#                response += bytes([data_object[x]])
-#                x+=1
-#
-#            container_length = len(response) + 4
-#
-#
-#            if self.maxusb_app.testcase[1] == "PartialObject_ContainerLength":
-#                container_length_bytes = change_byte_order(self.maxusb_app.testcase[2])
-#            else:
-#                container_length_bytes = bytes([
-#                (container_length      ) & 0xff,
-#                (container_length >>  8) & 0xff,
-#                (container_length >> 16) & 0xff,
-#                (container_length >> 24) & 0xff])
+            response2 = self.create_send_ok(transaction_id)
 
-#            response = container_length_bytes + response
-#            response2 = self.create_send_ok(transaction_id)
 
 
+        elif opcode == 0x1006:      # GetNumObjects
+            if self.verbose > 0:
+                print(self.name, "got GetNumObjects")
 
+            response = self.create_send_ok(transaction_id,
+                    len(self.get_object_handles(container)))
 
 
 
@@ -280,46 +415,19 @@ class USBImageInterface(USBInterface):
             if self.verbose > 0:
                 print(self.name, "got GetDeviceInfo")
 
-            if self.maxusb_app.testcase[1] == "DeviceInfo_ContainerType":
-                container_type = change_byte_order(self.maxusb_app.testcase[2])
-            else:
-                container_type = b'\x00\x02' # Data block
+            container_type = self.maxusb_app.overrides.get("DeviceInfo_ContainerType", b'\x00\x02', change_byte_order) # Data block
             
-            if self.maxusb_app.testcase[1] == "DeviceInfo_OperationCode":
-                operation_code = change_byte_order(self.maxusb_app.testcase[2])
-            else:
-                operation_code = b'\x10\x01' # GetDeviceInfo
+            operation_code = self.maxusb_app.overrides.get("DeviceInfo_OperationCode", b'\x10\x01', change_byte_order) # GetDeviceInfo
             #transaction ID
-            if self.maxusb_app.testcase[1] == "DeviceInfo_StandardVersion":
-                standard_version = change_byte_order(self.maxusb_app.testcase[2])
-            else:
-                standard_version = b'\x00\x64' # version 1.0
-            if self.maxusb_app.testcase[1] == "DeviceInfo_VendorExtensionID":
-                vendor_extension_id = change_byte_order(self.maxusb_app.testcase[2])
-            else:
-                vendor_extension_id = b'\x00\x00\x00\x06' # Microsoft Corporation
-            if self.maxusb_app.testcase[1] == "DeviceInfo_VendorExtensionVersion":
-                vendor_extension_version = change_byte_order(self.maxusb_app.testcase[2])
-            else:
-                vendor_extension_version = b'\x00\x64' # version 1.0
-            if self.maxusb_app.testcase[1] == "DeviceInfo_VendorExtensionDesc":
-                vendor_extension_desc = change_byte_order(self.maxusb_app.testcase[2])
-            else:
-                vendor_extension_desc = b'\x00'
-            if self.maxusb_app.testcase[1] == "DeviceInfo_FunctionalMode":
-                functional_mode = change_byte_order(self.maxusb_app.testcase[2])
-            else:
-                functional_mode = b'\x00\x00' # standard mode
+            standard_version = self.maxusb_app.overrides.get("DeviceInfo_StandardVersion", b'\x00\x64', change_byte_order) # version 1.0
+            vendor_extension_id = self.maxusb_app.overrides.get("DeviceInfo_VendorExtensionID", b'\x00\x00\x00\x06', change_byte_order) # Microsoft Corporation
+            vendor_extension_version = self.maxusb_app.overrides.get("DeviceInfo_VendorExtensionVersion", b'\x00\x64', change_byte_order) # version 1.0
+            vendor_extension_desc = self.maxusb_app.overrides.get("DeviceInfo_VendorExtensionDesc", b'\x00', change_byte_order)
+            functional_mode = self.maxusb_app.overrides.get("DeviceInfo_FunctionalMode", b'\x00\x00', change_byte_order) # standard mode
            
-            if self.maxusb_app.testcase[1] == "DeviceInfo_OperationsSupportedArraySize":
-                operations_supported_array_size = change_byte_order(self.maxusb_app.testcase[2])
-            else:
-                operations_supported_array_size = b'\x00\x00\x00\x10' # 16 operations supported
+            operations_supported_array_size = self.maxusb_app.overrides.get("DeviceInfo_OperationsSupportedArraySize", b'\x00\x00\x00\x10', change_byte_order) # 16 operations supported
        
-            if self.maxusb_app.testcase[1] == "DeviceInfo_OperationSupported":
-                op1_supported = change_byte_order(self.maxusb_app.testcase[2])
-            else:
-                op1_supported = b'\x10\x01' # GetDeviceInfo
+            op1_supported = self.maxusb_app.overrides.get("DeviceInfo_OperationSupported", b'\x10\x01', change_byte_order) # GetDeviceInfo
             op2_supported = b'\x10\x02' # OpenSession
             op3_supported = b'\x10\x03' # CloseSession
             op4_supported = b'\x10\x04' # GetStorageIDs
@@ -336,44 +444,23 @@ class USBImageInterface(USBInterface):
             op15_supported = b'\x10\x16' # SetDevicePropValue
             op16_supported = b'\x10\x1b' # GetPartialObject
  
-            if self.maxusb_app.testcase[1] == "DeviceInfo_EventsSupportedArraySize":
-                events_supported_array_size = change_byte_order(self.maxusb_app.testcase[2])
-            else:
-                events_supported_array_size = b'\x00\x00\x00\x04' # 4 events supported
+            events_supported_array_size = self.maxusb_app.overrides.get("DeviceInfo_EventsSupportedArraySize", b'\x00\x00\x00\x04', change_byte_order) # 4 events supported
 
-            if self.maxusb_app.testcase[1] == "DeviceInfo_EventSupported":
-                ev1_supported = change_byte_order(self.maxusb_app.testcase[2])
-            else:
-                ev1_supported = b'\x40\x04' # StoredAdded
+            ev1_supported = self.maxusb_app.overrides.get("DeviceInfo_EventSupported", b'\x40\x04', change_byte_order) # StoredAdded
             ev2_supported = b'\x40\x05' # StoreRemoved
             ev3_supported = b'\x40\x08' # DeviceInfoChanged
             ev4_supported = b'\x40\x09' # RequestObjectTransfer
 
-            if self.maxusb_app.testcase[1] == "DeviceInfo_DevicePropertiesSupportedArraySize":
-                device_properties_supported_array_size = change_byte_order(self.maxusb_app.testcase[2])
-            else:
-                device_properties_supported_array_size = b'\x00\x00\x00\x02' # 2 properties supported
+            device_properties_supported_array_size = self.maxusb_app.overrides.get("DeviceInfo_DevicePropertiesSupportedArraySize", b'\x00\x00\x00\x02', change_byte_order) # 2 properties supported
 
-            if self.maxusb_app.testcase[1] == "DeviceInfo_DevicePropertySupported":
-                dp1_supported = change_byte_order(self.maxusb_app.testcase[2])
-            else:
-                dp1_supported = b'\xd4\x06' # Unknown property 
+            dp1_supported = self.maxusb_app.overrides.get("DeviceInfo_DevicePropertySupported", b'\xd4\x06', change_byte_order) # Unknown property 
             dp2_supported = b'\xd4\x07' # Unknown property
 
-            if self.maxusb_app.testcase[1] == "DeviceInfo_CaptureFormatsSupportedArraySize":
-                capture_formats_supported_array_size = change_byte_order(self.maxusb_app.testcase[2])
-            else:
-                capture_formats_supported_array_size = b'\x00\x00\x00\x00' # 0 formats supported
+            capture_formats_supported_array_size = self.maxusb_app.overrides.get("DeviceInfo_CaptureFormatsSupportedArraySize", b'\x00\x00\x00\x00', change_byte_order) # 0 formats supported
 
-            if self.maxusb_app.testcase[1] == "DeviceInfo_ImageFormatsSupportedArraySize":
-                image_formats_supported_array_size = change_byte_order(self.maxusb_app.testcase[2])
-            else:
-                image_formats_supported_array_size = b'\x00\x00\x00\x06' # 6 formats supported
+            image_formats_supported_array_size = self.maxusb_app.overrides.get("DeviceInfo_ImageFormatsSupportedArraySize", b'\x00\x00\x00\x06', change_byte_order) # 6 formats supported
 
-            if self.maxusb_app.testcase[1] == "DeviceInfo_ImageFormatSupported":
-                if1_supported = change_byte_order(self.maxusb_app.testcase[2])
-            else:
-                if1_supported = b'\x30\x01' # Association (Folder)
+            if1_supported = self.maxusb_app.overrides.get("DeviceInfo_ImageFormatSupported", b'\x30\x01', change_byte_order) # Association (Folder)
             if2_supported = b'\x30\x02' # Script
             if3_supported = b'\x30\x06' # DPOF
             if4_supported = b'\x30\x0d' # Unknown image format
@@ -392,26 +479,26 @@ class USBImageInterface(USBInterface):
             device_version_length_bytes = int_to_bytestring(device_version_length)
             serial_number_length_bytes = int_to_bytestring(serial_number_length)
 
-            if self.maxusb_app.testcase[1] == "DeviceInfo_Manufacturer":
-                manufacturer = change_byte_order(self.maxusb_app.testcase[2])
+            if "DeviceInfo_Manufacturer" in self.maxusb_app.overrides:
+                manufacturer = change_byte_order(self.maxusb_app.overrides["DeviceInfo_Manufacturer"])
                 manufacturer_length_bytes = b''
             else:
                 manufacturer_length_bytes = int_to_bytestring(manufacturer_length)
 
-            if self.maxusb_app.testcase[1] == "DeviceInfo_Model":
-                model = change_byte_order(self.maxusb_app.testcase[2])
+            if "DeviceInfo_Model" in self.maxusb_app.overrides:
+                model = change_byte_order(self.maxusb_app.overrides["DeviceInfo_Model"])
                 model_length_bytes = b''
             else:
                 model_length_bytes = int_to_bytestring(model_length)
 
-            if self.maxusb_app.testcase[1] == "DeviceInfo_DeviceVersion":
-                device_version = change_byte_order(self.maxusb_app.testcase[2])
+            if "DeviceInfo_DeviceVersion" in self.maxusb_app.overrides:
+                device_version = change_byte_order(self.maxusb_app.overrides["DeviceInfo_DeviceVersion"])
                 device_version_length_bytes = b''
             else:
                 device_version_length_bytes = int_to_bytestring(device_version_length)
 
-            if self.maxusb_app.testcase[1] == "DeviceInfo_SerialNumber":
-                serial_number = change_byte_order(self.maxusb_app.testcase[2])
+            if "DeviceInfo_SerialNumber" in self.maxusb_app.overrides:
+                serial_number = change_byte_order(self.maxusb_app.overrides["DeviceInfo_SerialNumber"])
                 serial_number_length_bytes = b''
             else:
                 serial_number_length_bytes = int_to_bytestring(serial_number_length)
@@ -468,8 +555,8 @@ class USBImageInterface(USBInterface):
 
             
 
-            if self.maxusb_app.testcase[1] == "DeviceInfo_ContainerLength":
-                container_length_bytes = change_byte_order(self.maxusb_app.testcase[2])
+            if "DeviceInfo_ContainerLength" in self.maxusb_app.overrides:
+                container_length_bytes = change_byte_order(self.maxusb_app.overrides["DeviceInfo_ContainerLength"])
             else:
                 container_length = len(response) + 4
                 container_length_bytes = bytes([
@@ -494,38 +581,32 @@ class USBImageInterface(USBInterface):
                 print(self.name, "got GetStorageIDs")
 
 
-            if self.maxusb_app.testcase[1] == "StorageIDArray_ContainerType":
-                container_type = change_byte_order(self.maxusb_app.testcase[2])
-            else:
-                container_type = b'\x00\x02' # Data block
+            container_type = self.maxusb_app.overrides.get("StorageIDArray_ContainerType", b'\x00\x02', change_byte_order) # Data block
 
-            if self.maxusb_app.testcase[1] == "StorageIDArray_OperationCode":
-                operation_code = change_byte_order(self.maxusb_app.testcase[2])
-            else:
-                operation_code = b'\x10\x04' # GetStorageID
+            operation_code = self.maxusb_app.overrides.get("StorageIDArray_OperationCode", b'\x10\x04', change_byte_order) # GetStorageID
 
-            if self.maxusb_app.testcase[1] == "StorageIDArray_StorageIDsArraySize":
-                storage_id_array_size = change_byte_order(self.maxusb_app.testcase[2])
+            if self.object_store:
+                storage_ids = self.object_store.storage_ids()
             else:
-                storage_id_array_size = b'\x00\x00\x00\x01' # 1 storage ID
+                storage_ids = [ 0x00010001 ] # Phys: 0x0001 Log: 0x0001
 
+            storage_id_array_size = self.maxusb_app.overrides.get("StorageIDArray_StorageIDsArraySize", len(storage_ids).to_bytes(4, 'big'), change_byte_order)
 
-            if self.maxusb_app.testcase[1] == "StorageIDArray_StorageID":
-                storage_id = change_byte_order(self.maxusb_app.testcase[2])
-            else:
-                storage_id = b'\x00\x01\x00\x01' # Phys: 0x0001 Log: 0x0001
+
+            storage_id = self.maxusb_app.overrides.get("StorageIDArray_StorageID", storage_ids[0].to_bytes(4, 'big'), change_byte_order)
 
             response = change_byte_order(container_type) + \
                        change_byte_order(operation_code) + \
                        change_byte_order(transaction_id) + \
                        change_byte_order(storage_id_array_size) + \
-                       change_byte_order(storage_id)
+                       change_byte_order(storage_id) + \
+                       pack_uint32_array(storage_ids[1:])
 
             container_length = len(response) + 4
 
 
-            if self.maxusb_app.testcase[1] == "StorageIDArray_ContainerLength":
-                container_length_bytes = change_byte_order(self.maxusb_app.testcase[2])
+            if "StorageIDArray_ContainerLength" in self.maxusb_app.overrides:
+                container_length_bytes = change_byte_order(self.maxusb_app.overrides["StorageIDArray_ContainerLength"])
             else:
                 container_length_bytes = bytes([
                 (container_length      ) & 0xff,
@@ -544,35 +625,27 @@ class USBImageInterface(USBInterface):
                 print(self.name, "got GetObjectHandles")
 
 
-            if self.maxusb_app.testcase[1] == "ObjectHandles_ContainerType":
-                container_type = change_byte_order(self.maxusb_app.testcase[2])
-            else:
-                container_type = b'\x00\x02' # Data block
+            container_type = self.maxusb_app.overrides.get("ObjectHandles_ContainerType", b'\x00\x02', change_byte_order) # Data block
 
-            if self.maxusb_app.testcase[1] == "ObjectHandles_OperationCode":
-                operation_code = change_byte_order(self.maxusb_app.testcase[2])
-            else:
-                operation_code = b'\x10\x07' # GetObjectHandles
+            operation_code = self.maxusb_app.overrides.get("ObjectHandles_OperationCode", b'\x10\x07', change_byte_order) # GetObjectHandles
 
-            if self.maxusb_app.testcase[1] == "ObjectHandles_ObjectHandleArraySize":
-                object_handle_array_size = change_byte_order(self.maxusb_app.testcase[2])
-            else:
-                object_handle_array_size = b'\x00\x00\x00\x01' # 1 array size
-            if self.maxusb_app.testcase[1] == "ObjectHandles_ObjectHandle":
-                object_handle = change_byte_order(self.maxusb_app.testcase[2])
-            else:
-                object_handle = b'\x42\x19\x42\xca' # Object handle
+            handles = self.get_object_handles(container)
+
+            object_handle_array_size = self.maxusb_app.overrides.get("ObjectHandles_ObjectHandleArraySize", len(handles).to_bytes(4, 'big'), change_byte_order)
+            object_handles = pack_uint32_array(handles)
+            if "ObjectHandles_ObjectHandle" in self.maxusb_app.overrides:
+                object_handles = self.maxusb_app.overrides["ObjectHandles_ObjectHandle"] + object_handles[4:]
 
             response = change_byte_order(container_type) + \
                        change_byte_order(operation_code) + \
                        change_byte_order(transaction_id) + \
                        change_byte_order(object_handle_array_size) + \
-                       change_byte_order(object_handle) 
+                       object_handles
 
             container_length = len(response) + 4
 
-            if self.maxusb_app.testcase[1] == "ObjectHandles_ContainerLength":
-                container_length_bytes = change_byte_order(self.maxusb_app.testcase[2])
+            if "ObjectHandles_ContainerLength" in self.maxusb_app.overrides:
+                container_length_bytes = change_byte_order(self.maxusb_app.overrides["ObjectHandles_ContainerLength"])
             else:
                 container_length_bytes = bytes([
                 (container_length      ) & 0xff,
@@ -588,92 +661,30 @@ class USBImageInterface(USBInterface):
             if self.verbose > 0:
                 print(self.name, "got GetObjectInfo")
 
-
-            if self.maxusb_app.testcase[1] == "ObjectInfo_ContainerType":
-                container_type = change_byte_order(self.maxusb_app.testcase[2])
-            else:
-                container_type = b'\x00\x02' # Data block
-            if self.maxusb_app.testcase[1] == "ObjectInfo_OperationCode":
-                operation_code = change_byte_order(self.maxusb_app.testcase[2])
-            else:
-                operation_code = b'\x10\x08' # GetObjectInfo
-            if self.maxusb_app.testcase[1] == "ObjectInfo_StorageID":
-                storage_id = change_byte_order(self.maxusb_app.testcase[2])
-            else:
-                storage_id = b'\x00\x01\x00\x01' # Phy: 0x0001 Log: 0x0001
-            if self.maxusb_app.testcase[1] == "ObjectInfo_ObjectFormat":
-                object_format = change_byte_order(self.maxusb_app.testcase[2])
-            else:
-                object_format = b'\x38\x01' # EXIF/JPEG
-            if self.maxusb_app.testcase[1] == "ObjectInfo_ProtectionStatus":
-                protection_status = change_byte_order(self.maxusb_app.testcase[2])
-            else:
-                protection_status = b'\x00\x00' # no protection
-            if self.maxusb_app.testcase[1] == "ObjectInfo_ObjectCompressedSize":
-                object_compressed_size = change_byte_order(self.maxusb_app.testcase[2])
-            else:
-                object_compressed_size = b'\x00\x31\xd6\x58' # 3266136
-            if self.maxusb_app.testcase[1] == "ObjectInfo_ThumbFormat":
-                thumb_format = change_byte_order(self.maxusb_app.testcase[2])
-            else:
-                thumb_format = b'\x38\x08' # JFIF
-            if self.maxusb_app.testcase[1] == "ObjectInfo_ThumbCompressedSize":
-                thumb_compressed_size = change_byte_order(self.maxusb_app.testcase[2])
-            else:
-                thumb_compressed_size = b'\x00\x00\x0d\xcd' # 3533
-            if self.maxusb_app.testcase[1] == "ObjectInfo_ThumbPixelWidth":
-                thumb_pixel_width = change_byte_order(self.maxusb_app.testcase[2])
-            else:
-                thumb_pixel_width = b'\x00\x00\x00\xa0' # 160
-            if self.maxusb_app.testcase[1] == "ObjectInfo_ThumbPixelHeight":
-                thumb_pixel_height = change_byte_order(self.maxusb_app.testcase[2])
-            else:
-                thumb_pixel_height = b'\x00\x00\x00\x78' # 120
-            if self.maxusb_app.testcase[1] == "ObjectInfo_ImagePixelWidth":
-                image_pixel_width = change_byte_order(self.maxusb_app.testcase[2])
-            else:
-                image_pixel_width = b'\x00\x00\x0e\x40' # 3648
-            if self.maxusb_app.testcase[1] == "ObjectInfo_ImagePixelHeight":
-                image_pixel_height = change_byte_order(self.maxusb_app.testcase[2])
-            else:
-                image_pixel_height = b'\x00\x00\x0a\xb0' # 2736
-            if self.maxusb_app.testcase[1] == "ObjectInfo_ImagePixelDepth":
-                image_pixel_depth = change_byte_order(self.maxusb_app.testcase[2])
-            else:
-                image_pixel_depth = b'\x00\x00\x00\x18' # 24
-            if self.maxusb_app.testcase[1] == "ObjectInfo_ParentObject":
-                parent_object = change_byte_order(self.maxusb_app.testcase[2])
-            else:
-                parent_object = b'\x00\x00\x00\x00' # Object handle = 0
-            if self.maxusb_app.testcase[1] == "ObjectInfo_AssociationType":
-                association_type = change_byte_order(self.maxusb_app.testcase[2])
-            else:
-                association_type = b'\x00\x00' # undefined
-            if self.maxusb_app.testcase[1] == "ObjectInfo_AssociationDesc":
-                association_desc = change_byte_order(self.maxusb_app.testcase[2])
-            else:
-                association_desc = b'\x00\x00\x00\x00' # undefined
-            if self.maxusb_app.testcase[1] == "ObjectInfo_SequenceNumber":
-                sequence_number = change_byte_order(self.maxusb_app.testcase[2])
-            else:
-                sequence_number = b'\x00\x00\x00\x00' # 0
-            if self.maxusb_app.testcase[1] == "ObjectInfo_Filename":
-                filename = change_byte_order(self.maxusb_app.testcase[2])
-            else:
-                filename = b'\x0D\x50\x00\x31\x00\x30\x00\x31\x00\x30\x00\x37\x00\x34\x00\x39\x00\x2E\x00\x4A\x00\x50\x00\x47\x00\x00\x00' # P1010749.JPG
-            if self.maxusb_app.testcase[1] == "ObjectInfo_CaptureDate":
-                capture_date = change_byte_order(self.maxusb_app.testcase[2])
-            else:
-                capture_date = b'\x10\x32\x00\x30\x00\x31\x00\x33\x00\x30\x00\x37\x00\x32\x00\x33\x00\x54\x00\x31\x00\x31\x00\x30\x00\x35\x00\x30\x00\x36\x00\x00\x00' # 20130723T110506
-            if self.maxusb_app.testcase[1] == "ObjectInfo_ModificationDate":
-                modification_date = change_byte_order(self.maxusb_app.testcase[2])
-            else:
-                modification_date = b'\x10\x32\x00\x30\x00\x31\x00\x33\x00\x30\x00\x37\x00\x32\x00\x33\x00\x54\x00\x31\x00\x31\x00\x30\x00\x35\x00\x30\x00\x36\x00\x00\x00' # 20130723T110506
-
-            if self.maxusb_app.testcase[1] == "ObjectInfo_Keywords":
-                keywords = change_byte_order(self.maxusb_app.testcase[2])
-            else:
-                keywords = b'\x00' # none
+            object_info = self.get_object_info(container)
+
+            container_type = self.maxusb_app.overrides.get("ObjectInfo_ContainerType", b'\x00\x02', change_byte_order) # Data block
+            operation_code = self.maxusb_app.overrides.get("ObjectInfo_OperationCode", b'\x10\x08', change_byte_order) # GetObjectInfo
+            storage_id = self.maxusb_app.overrides.get("ObjectInfo_StorageID", object_info.get("StorageID", b'\x00\x01\x00\x01'), change_byte_order) # Phy: 0x0001 Log: 0x0001
+            object_format = self.maxusb_app.overrides.get("ObjectInfo_ObjectFormat", object_info.get("ObjectFormat", b'\x38\x01'), change_byte_order) # EXIF/JPEG
+            protection_status = self.maxusb_app.overrides.get("ObjectInfo_ProtectionStatus", object_info.get("ProtectionStatus", b'\x00\x00'), change_byte_order) # no protection
+            object_compressed_size = self.maxusb_app.overrides.get("ObjectInfo_ObjectCompressedSize", object_info.get("ObjectCompressedSize", b'\x00\x31\xd6\x58'), change_byte_order) # 3266136
+            thumb_format = self.maxusb_app.overrides.get("ObjectInfo_ThumbFormat", object_info.get("ThumbFormat", b'\x38\x08'), change_byte_order) # JFIF
+            thumb_compressed_size = self.maxusb_app.overrides.get("ObjectInfo_ThumbCompressedSize", object_info.get("ThumbCompressedSize", b'\x00\x00\x0d\xcd'), change_byte_order) # 3533
+            thumb_pixel_width = self.maxusb_app.overrides.get("ObjectInfo_ThumbPixelWidth", object_info.get("ThumbPixelWidth", b'\x00\x00\x00\xa0'), change_byte_order) # 160
+            thumb_pixel_height = self.maxusb_app.overrides.get("ObjectInfo_ThumbPixelHeight", object_info.get("ThumbPixelHeight", b'\x00\x00\x00\x78'), change_byte_order) # 120
+            image_pixel_width = self.maxusb_app.overrides.get("ObjectInfo_ImagePixelWidth", object_info.get("ImagePixelWidth", b'\x00\x00\x0e\x40'), change_byte_order) # 3648
+            image_pixel_height = self.maxusb_app.overrides.get("ObjectInfo_ImagePixelHeight", object_info.get("ImagePixelHeight", b'\x00\x00\x0a\xb0'), change_byte_order) # 2736
+            image_pixel_depth = self.maxusb_app.overrides.get("ObjectInfo_ImagePixelDepth", object_info.get("ImagePixelDepth", b'\x00\x00\x00\x18'), change_byte_order) # 24
+            parent_object = self.maxusb_app.overrides.get("ObjectInfo_ParentObject", object_info.get("ParentObject", b'\x00\x00\x00\x00'), change_byte_order) # Object handle = 0
+            association_type = self.maxusb_app.overrides.get("ObjectInfo_AssociationType", object_info.get("AssociationType", b'\x00\x00'), change_byte_order) # undefined
+            association_desc = self.maxusb_app.overrides.get("ObjectInfo_AssociationDesc", object_info.get("AssociationDesc", b'\x00\x00\x00\x00'), change_byte_order) # undefined
+            sequence_number = self.maxusb_app.overrides.get("ObjectInfo_SequenceNumber", object_info.get("SequenceNumber", b'\x00\x00\x00\x00'), change_byte_order) # 0
+            filename = self.maxusb_app.overrides.get("ObjectInfo_Filename", object_info.get("Filename", b'\x0D\x50\x00\x31\x00\x30\x00\x31\x00\x30\x00\x37\x00\x34\x00\x39\x00\x2E\x00\x4A\x00\x50\x00\x47\x00\x00\x00'), change_byte_order) # P1010749.JPG
+            capture_date = self.maxusb_app.overrides.get("ObjectInfo_CaptureDate", object_info.get("CaptureDate", b'\x10\x32\x00\x30\x00\x31\x00\x33\x00\x30\x00\x37\x00\x32\x00\x33\x00\x54\x00\x31\x00\x31\x00\x30\x00\x35\x00\x30\x00\x36\x00\x00\x00'), change_byte_order) # 20130723T110506
+            modification_date = self.maxusb_app.overrides.get("ObjectInfo_ModificationDate", object_info.get("ModificationDate", b'\x10\x32\x00\x30\x00\x31\x00\x33\x00\x30\x00\x37\x00\x32\x00\x33\x00\x54\x00\x31\x00\x31\x00\x30\x00\x35\x00\x30\x00\x36\x00\x00\x00'), change_byte_order) # 20130723T110506
+
+            keywords = self.maxusb_app.overrides.get("ObjectInfo_Keywords", object_info.get("Keywords", b'\x00'), change_byte_order) # none
 
             response = change_byte_order(container_type) + \
                        change_byte_order(operation_code) + \
@@ -700,8 +711,8 @@ class USBImageInterface(USBInterface):
 
             container_length = len(response) + 4
 
-            if self.maxusb_app.testcase[1] == "ObjectInfo_ContainerLength":
-                container_length_bytes = change_byte_order(self.maxusb_app.testcase[2])
+            if "ObjectInfo_ContainerLength" in self.maxusb_app.overrides:
+                container_length_bytes = change_byte_order(self.maxusb_app.overrides["ObjectInfo_ContainerLength"])
             else:
                 container_length_bytes = bytes([
                 (container_length      ) & 0xff,
@@ -719,54 +730,33 @@ class USBImageInterface(USBInterface):
             if self.verbose > 0:
                 print(self.name, "got GetStorageInfo")
 
-            if self.maxusb_app.testcase[1] == "StorageInfo_ContainerType":
-                container_type = change_byte_order(self.maxusb_app.testcase[2])
-            else:
-                container_type = b'\x00\x02' # Data block
-            if self.maxusb_app.testcase[1] == "StorageInfo_OperationCode":
-                operation_code = change_byte_order(self.maxusb_app.testcase[2])
-            else:
-                operation_code = b'\x10\x05' # GetStorageInfo
+            container_type = self.maxusb_app.overrides.get("StorageInfo_ContainerType", b'\x00\x02', change_byte_order) # Data block
+            operation_code = self.maxusb_app.overrides.get("StorageInfo_OperationCode", b'\x10\x05', change_byte_order) # GetStorageInfo
 
-            if self.maxusb_app.testcase[1] == "StorageInfo_StorageType":
-                storage_type = change_byte_order(self.maxusb_app.testcase[2])
-            else:
-                storage_type = b'\x00\x04' # Removable RAM
-            if self.maxusb_app.testcase[1] == "StorageInfo_FilesystemType":
-                filesystem_type = change_byte_order(self.maxusb_app.testcase[2])
-            else:
-                filesystem_type = b'\x00\x03' # DCF (Design rule for Camera File system)
+            storage_type = self.maxusb_app.overrides.get("StorageInfo_StorageType", b'\x00\x04', change_byte_order) # Removable RAM
+            filesystem_type = self.maxusb_app.overrides.get("StorageInfo_FilesystemType", b'\x00\x03', change_byte_order) # DCF (Design rule for Camera File system)
 
-            if self.maxusb_app.testcase[1] == "StorageInfo_AccessCapability":
-                access_capability = change_byte_order(self.maxusb_app.testcase[2])
-            else:
-                access_capability = b'\x00\x00' # Read-write
+            access_capability = self.maxusb_app.overrides.get("StorageInfo_AccessCapability", b'\x00\x00', change_byte_order) # Read-write
 
-            if self.maxusb_app.testcase[1] == "StorageInfo_MaxCapacity":
-                max_capacity = change_byte_order(self.maxusb_app.testcase[2])
-            else:
-                max_capacity = b'\x00\x00\x00\x00\x78\x18\x00\x00' # 2014838784 bytes
+            storage_info = self.get_storage_info(container)
 
-            if self.maxusb_app.testcase[1] == "StorageInfo_FreeSpaceInBytes":
-                free_space_in_bytes = change_byte_order(self.maxusb_app.testcase[2])
-            else:
-                free_space_in_bytes = b'\x00\x00\x00\x00\x77\xda\x80\x00' # 2010808320 bytes
+            max_capacity = self.maxusb_app.overrides.get("StorageInfo_MaxCapacity", storage_info.get("MaxCapacity", b'\x00\x00\x00\x00\x78\x18\x00\x00'), change_byte_order) # 2014838784 bytes
 
+            free_space_in_bytes = self.maxusb_app.overrides.get("StorageInfo_FreeSpaceInBytes", storage_info.get("FreeSpaceInBytes", b'\x00\x00\x00\x00\x77\xda\x80\x00'), change_byte_order) # 2010808320 bytes
 
-            if self.maxusb_app.testcase[1] == "StorageInfo_FreeSpaceInImages":
-                free_space_in_images = change_byte_order(self.maxusb_app.testcase[2])
-            else:
-                free_space_in_images = b'\x00\x00\x00\x00' # 0 bytes
 
-            if self.maxusb_app.testcase[1] == "StorageInfo_StorageDescription":
-                storage_description = change_byte_order(self.maxusb_app.testcase[2])
+            free_space_in_images = self.maxusb_app.overrides.get("StorageInfo_FreeSpaceInImages", b'\x00\x00\x00\x00', change_byte_order) # 0 bytes
+
+            # PTP strings, sent as they are
+            if "StorageInfo_StorageDescription" in self.maxusb_app.overrides:
+                storage_description = self.maxusb_app.overrides["StorageInfo_StorageDescription"]
             else:
-                storage_description = b'\x00'
+                storage_description = storage_info.get("StorageDescription", b'\x00')
 
-            if self.maxusb_app.testcase[1] == "StorageInfo_VolumeLabel":
-                volume_label = change_byte_order(self.maxusb_app.testcase[2])
+            if "StorageInfo_VolumeLabel" in self.maxusb_app.overrides:
+                volume_label = self.maxusb_app.overrides["StorageInfo_VolumeLabel"]
             else:
-                volume_label = b'\x00' 
+                volume_label = storage_info.get("VolumeLabel", b'\x00')
 
             response = change_byte_order(container_type) + \
                        change_byte_order(operation_code) + \
@@ -777,13 +767,13 @@ class USBImageInterface(USBInterface):
                        change_byte_order(max_capacity) + \
                        change_byte_order(free_space_in_bytes) + \
                        change_byte_order(free_space_in_images) + \
-                       change_byte_order(storage_description) + \
-                       change_byte_order(volume_label)
+                       storage_description + \
+                       volume_label
 
             container_length = len(response) + 4
 
-            if self.maxusb_app.testcase[1] == "StorageInfo_ContainerLength":
-                container_length_bytes = change_byte_order(self.maxusb_app.testcase[2])
+            if "StorageInfo_ContainerLength" in self.maxusb_app.overrides:
+                container_length_bytes = change_byte_order(self.maxusb_app.overrides["StorageInfo_ContainerLength"])
             else:
                 container_length_bytes = bytes([
                 (container_length      ) & 0xff,
@@ -816,19 +806,30 @@ class USBImageInterface(USBInterface):
 
 
 class ThumbImage:
+    """Read-only picture shared through the asset cache; close() drops this
+    device's reference to it."""
+
     def __init__(self, filename):
         self.filename = filename
 
-        self.file = open(self.filename, 'r+b')
-        self.image = mmap(self.file.fileno(), 0)
+        self.asset = asset_cache.acquire(self.filename)
+        self.image = self.asset.data
 
     def close(self):
-        self.image.flush()
-        self.image.close()
+        if self.asset is not None:
+            asset_cache.release(self.asset)
+            self.asset = None
+            self.image = None
 
     def read_data(self):
         return self.image
 
+    def get_range(self, offset, length):
+        """View of up to length bytes at offset; release() it before the
+        image is closed."""
+
+        return memoryview(self.image)[offset:offset + length]
+
 
 
 class ContainerRequestWrapper:
@@ -838,17 +839,35 @@ class ContainerRequestWrapper:
         self.operation_code         = bytestring[6:8]
         self.transaction_id         = bytestring[8:12]
         self.parameter1             = bytestring[12:16]
+        self.parameter2             = bytestring[16:20]
+        self.parameter3             = bytestring[20:24]
 
 
 
 class USBImageDevice(USBDevice):
     name = "USB image device"
 
-    def __init__(self, maxusb_app, vid, pid, rev, int_class, int_sub, int_proto, thumb_image_filename, verbose=0):
+    # one object store per set of directories, so the metadata index built
+    # up by earlier connections (or testcases) is reused
+    object_stores = { }
+
+    # object_dirs, if given, are host directories to expose as PTP storages
+    # in place of the single built-in picture
+    def __init__(self, maxusb_app, vid, pid, rev, int_class, int_sub, int_proto, thumb_image_filename, verbose=0, object_dirs=None):
         self.thumb_image = ThumbImage("ncc_group_logo.jpg")
         self.partial_image = ThumbImage("ncc_group_logo.bin")
 
-        interface1 = USBImageInterface(0, maxusb_app, self.thumb_image, self.partial_image, int_class, int_sub, int_proto, verbose=verbose)
+        self.object_store = None
+        if object_dirs:
+            if isinstance(object_dirs, str):
+                object_dirs = [ object_dirs ]
+            key = tuple(object_dirs)
+            self.object_store = self.object_stores.get(key)
+            if self.object_store is None:
+                self.object_store = PTPObjectStore(object_dirs)
+                self.object_stores[key] = self.object_store
+
+        interface1 = USBImageInterface(0, maxusb_app, self.thumb_image, self.partial_image, int_class, int_sub, int_proto, verbose=verbose, object_store=self.object_store)
 
 
         if vid == 0x1111:
@@ -883,7 +902,14 @@ class USBImageDevice(USBDevice):
                 verbose=verbose
         )
 
+    def handle_bus_disconnect(self):
+        # the device is not connected again, so let the cache have the
+        # pictures back now rather than when the object is dropped
+        self.thumb_image.close()
+        self.partial_image.close()
+
     def disconnect(self):
-        self.disk_image.close()
         USBDevice.disconnect(self)
+        self.thumb_image.close()
+        self.partial_image.close()
 
@@ -44,94 +44,31 @@ class USBKeyboardInterface(USBInterface):
         self.maxusb_app = maxusb_app
 
 
-        if self.maxusb_app.testcase[1] == "Report_Usage_Page":
-            usage_page_generic_desktop_controls = self.maxusb_app.testcase[2]
-        else:
-            usage_page_generic_desktop_controls = b'\x05\x01'
+        usage_page_generic_desktop_controls = self.maxusb_app.overrides.get("Report_Usage_Page", b'\x05\x01')
 #            usage_page_generic_desktop_controls = b'\xb1\x01'
 
 
-        if self.maxusb_app.testcase[1] == "Report_Usage_Keyboard":
-            usage_keyboard = self.maxusb_app.testcase[2]
-        else:
-            usage_keyboard = b'\x09\x06'
+        usage_keyboard = self.maxusb_app.overrides.get("Report_Usage_Keyboard", b'\x09\x06')
         collection_application = b'\xA1\x01'
-        if self.maxusb_app.testcase[1] == "Report_Usage_Page_Keyboard":
-            usage_page_keyboard = self.maxusb_app.testcase[2]
-        else:
-            usage_page_keyboard = b'\x05\x07'
-        if self.maxusb_app.testcase[1] == "Report_Usage_Minimum1":
-            usage_minimum1 = self.maxusb_app.testcase[2]
-        else:
-            usage_minimum1 = b'\x19\xE0'
-        if self.maxusb_app.testcase[1] == "Report_Usage_Maximum1":
-            usage_maximum1 = self.maxusb_app.testcase[2]
-        else:
-            usage_maximum1 = b'\x29\xE7'
-        if self.maxusb_app.testcase[1] == "Report_Logical_Minimum1":
-            logical_minimum1 = self.maxusb_app.testcase[2]
-        else:
-            logical_minimum1 = b'\x15\x00'
-        if self.maxusb_app.testcase[1] == "Report_Logical_Maximum1":
-            logical_maximum1 = self.maxusb_app.testcase[2]
-        else:
-            logical_maximum1 = b'\x25\x01'
-        if self.maxusb_app.testcase[1] == "Report_Report_Size1":
-            report_size1 = self.maxusb_app.testcase[2]
-        else:
-            report_size1 = b'\x75\x01'
-        if self.maxusb_app.testcase[1] == "Report_Report_Count1":
-            report_count1 = self.maxusb_app.testcase[2]
-        else:
-            report_count1 = b'\x95\x08'
-        if self.maxusb_app.testcase[1] == "Report_Input_Data_Variable_Absolute_Bitfield":
-            input_data_variable_absolute_bitfield = self.maxusb_app.testcase[2]
-        else:
-            input_data_variable_absolute_bitfield = b'\x81\x02'
-        if self.maxusb_app.testcase[1] == "Report_Report_Count2":
-            report_count2 = self.maxusb_app.testcase[2]
-        else:
-            report_count2 = b'\x95\x01'
-        if self.maxusb_app.testcase[1] == "Report_Report_Size2":
-            report_size2 = self.maxusb_app.testcase[2]
-        else:
-            report_size2 = b'\x75\x08'
-        if self.maxusb_app.testcase[1] == "Report_Input_Constant_Array_Absolute_Bitfield":
-            input_constant_array_absolute_bitfield = self.maxusb_app.testcase[2]
-        else:
-            input_constant_array_absolute_bitfield = b'\x81\x01'
-        if self.maxusb_app.testcase[1] == "Report_Usage_Minimum2":
-            usage_minimum2 = self.maxusb_app.testcase[2]
-        else:
-            usage_minimum2 = b'\x19\x00'
-        if self.maxusb_app.testcase[1] == "Report_Usage_Maximum2":
-            usage_maximum2 = self.maxusb_app.testcase[2]
-        else:
-            usage_maximum2 = b'\x29\x65'
-        if self.maxusb_app.testcase[1] == "Report_Logical_Minimum2":
-            logical_minimum2 = self.maxusb_app.testcase[2]
-        else:
-            logical_minimum2 = b'\x15\x00'
-        if self.maxusb_app.testcase[1] == "Report_Logical_Maximum2":
-            logical_maximum2 = self.maxusb_app.testcase[2]
-        else:
-            logical_maximum2 = b'\x25\x65'
-        if self.maxusb_app.testcase[1] == "Report_Report_Size3":
-            report_size3 = self.maxusb_app.testcase[2]
-        else:
-            report_size3 = b'\x75\x08'
-        if self.maxusb_app.testcase[1] == "Report_Report_Count3":
-            report_count3 = self.maxusb_app.testcase[2]
-        else:
-            report_count3 = b'\x95\x01'
-        if self.maxusb_app.testcase[1] == "Report_Input_Data_Array_Absolute_Bitfield":
-            input_data_array_absolute_bitfield = self.maxusb_app.testcase[2]
-        else:
-            input_data_array_absolute_bitfield = b'\x81\x00'
-        if self.maxusb_app.testcase[1] == "Report_End_Collection":
-            end_collection = self.maxusb_app.testcase[2]
-        else:
-            end_collection = b'\xc0'
+        usage_page_keyboard = self.maxusb_app.overrides.get("Report_Usage_Page_Keyboard", b'\x05\x07')
+        usage_minimum1 = self.maxusb_app.overrides.get("Report_Usage_Minimum1", b'\x19\xE0')
+        usage_maximum1 = self.maxusb_app.overrides.get("Report_Usage_Maximum1", b'\x29\xE7')
+        logical_minimum1 = self.maxusb_app.overrides.get("Report_Logical_Minimum1", b'\x15\x00')
+        logical_maximum1 = self.maxusb_app.overrides.get("Report_Logical_Maximum1", b'\x25\x01')
+        report_size1 = self.maxusb_app.overrides.get("Report_Report_Size1", b'\x75\x01')
+        report_count1 = self.maxusb_app.overrides.get("Report_Report_Count1", b'\x95\x08')
+        input_data_variable_absolute_bitfield = self.maxusb_app.overrides.get("Report_Input_Data_Variable_Absolute_Bitfield", b'\x81\x02')
+        report_count2 = self.maxusb_app.overrides.get("Report_Report_Count2", b'\x95\x01')
+        report_size2 = self.maxusb_app.overrides.get("Report_Report_Size2", b'\x75\x08')
+        input_constant_array_absolute_bitfield = self.maxusb_app.overrides.get("Report_Input_Constant_Array_Absolute_Bitfield", b'\x81\x01')
+        usage_minimum2 = self.maxusb_app.overrides.get("Report_Usage_Minimum2", b'\x19\x00')
+        usage_maximum2 = self.maxusb_app.overrides.get("Report_Usage_Maximum2", b'\x29\x65')
+        logical_minimum2 = self.maxusb_app.overrides.get("Report_Logical_Minimum2", b'\x15\x00')
+        logical_maximum2 = self.maxusb_app.overrides.get("Report_Logical_Maximum2", b'\x25\x65')
+        report_size3 = self.maxusb_app.overrides.get("Report_Report_Size3", b'\x75\x08')
+        report_count3 = self.maxusb_app.overrides.get("Report_Report_Count3", b'\x95\x01')
+        input_data_array_absolute_bitfield = self.maxusb_app.overrides.get("Report_Input_Data_Array_Absolute_Bitfield", b'\x81\x00')
+        end_collection = self.maxusb_app.overrides.get("Report_End_Collection", b'\xc0')
 
         self.report_descriptor = usage_page_generic_desktop_controls + \
                         usage_keyboard + \
@@ -157,26 +94,14 @@ class USBKeyboardInterface(USBInterface):
                         end_collection
 
 
-        if self.maxusb_app.testcase[1] == "HID_bDescriptorType":
-            bDescriptorType = self.maxusb_app.testcase[2]
-        else:
-            bDescriptorType = b'\x21' # HID
+        bDescriptorType = self.maxusb_app.overrides.get("HID_bDescriptorType", b'\x21') # HID
         bcdHID = b'\x10\x01'
-        if self.maxusb_app.testcase[1] == "HID_bCountryCode":
-            bCountryCode = self.maxusb_app.testcase[2]
-        else:
-            bCountryCode = b'\x00'
-        if self.maxusb_app.testcase[1] == "HID_bNumDescriptors":
-            bNumDescriptors = self.maxusb_app.testcase[2]
-        else:
-            bNumDescriptors = b'\x01'
+        bCountryCode = self.maxusb_app.overrides.get("HID_bCountryCode", b'\x00')
+        bNumDescriptors = self.maxusb_app.overrides.get("HID_bNumDescriptors", b'\x01')
 
-        if self.maxusb_app.testcase[1] == "HID_bDescriptorType2":
-            bDescriptorType2 = self.maxusb_app.testcase[2]
-        else:
-            bDescriptorType2 = b'\x22' #REPORT
-        if self.maxusb_app.testcase[1] == "HID_wDescriptorLength":
-            wDescriptorLength = self.maxusb_app.testcase[2]
+        bDescriptorType2 = self.maxusb_app.overrides.get("HID_bDescriptorType2", b'\x22') #REPORT
+        if "HID_wDescriptorLength" in self.maxusb_app.overrides:
+            wDescriptorLength = self.maxusb_app.overrides["HID_wDescriptorLength"]
         else:
             desclen = len (self.report_descriptor)
             wDescriptorLength =  bytes([
@@ -190,10 +115,7 @@ class USBKeyboardInterface(USBInterface):
                      bDescriptorType2 + \
                      wDescriptorLength
 
-        if self.maxusb_app.testcase[1] == "HID_bLength":
-            bLength = self.maxusb_app.testcase[2]
-        else:
-            bLength = bytes([len(self.hid_descriptor) + 1])
+        bLength = self.maxusb_app.overrides.get("HID_bLength", bytes([len(self.hid_descriptor) + 1]))
 
         self.hid_descriptor = bLength + self.hid_descriptor
 
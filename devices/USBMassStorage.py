@@ -2,8 +2,10 @@
 #
 # Contains class definitions to implement a USB mass storage device.
 
-from mmap import mmap
+from mmap import mmap, ALLOCATIONGRANULARITY
+import bisect
 import os
+import time
 
 from USB import *
 from USBDevice import *
@@ -13,6 +15,27 @@ from USBEndpoint import *
 from USBClass import *
 
 from util import *
+from assets import asset_cache
+from devices.fatimage import FatDiskImage
+
+scsi_opcode_names = {
+    0x00 : "Test Unit Ready",
+    0x03 : "Request Sense",
+    0x12 : "Inquiry",
+    0x1a : "Mode Sense (6)",
+    0x1e : "Prevent/Allow Removal",
+    0x23 : "Read Format Capacity",
+    0x25 : "Read Capacity",
+    0x28 : "Read (10)",
+    0x2a : "Write (10)",
+    0x35 : "Synchronize Cache (10)",
+    0x5a : "Mode Sense (10)",
+    0x88 : "Read (16)",
+    0x8a : "Write (16)",
+    0x9e : "Read Capacity (16)",
+    0xa8 : "Read (12)",
+    0xaa : "Write (12)",
+}
 
 class USBMassStorageClass(USBClass):
     name = "USB mass storage class"
@@ -28,14 +51,20 @@ class USBMassStorageClass(USBClass):
         self.interface.configuration.device.maxusb_app.send_on_endpoint(0, b'')
 
     def handle_get_max_lun_request(self, req):
-        self.interface.configuration.device.maxusb_app.send_on_endpoint(0, b'\x00')
+        max_lun = len(self.interface.disk_images) - 1
+        self.interface.configuration.device.maxusb_app.send_on_endpoint(0, bytes([max_lun]))
 
 
 class USBMassStorageInterface(USBInterface):
     name = "USB mass storage interface"
 
+    # disk_image is one DiskImage, or a list of them for LUN 0, 1, ...
     def __init__(self, maxusb_app, disk_image, usbclass, sub, proto, verbose=0):
-        self.disk_image = disk_image
+        if isinstance(disk_image, (list, tuple)):
+            self.disk_images = list(disk_image)
+        else:
+            self.disk_images = [ disk_image ]
+        self.disk_image = self.disk_images[0]
         self.maxusb_app = maxusb_app
         descriptors = { }
 
@@ -84,9 +113,50 @@ class USBMassStorageInterface(USBInterface):
 
         self.is_write_in_progress = False
         self.write_cbw = None
+        self.write_image = None
         self.write_base_lba = 0
         self.write_length = 0
-        self.write_data = b''
+        self.write_data = bytearray()
+
+        self.setup_scsi_handlers()
+
+        # responses for the common case of no mass storage overrides in the
+        # testcase, built once rather than per command
+        self.default_responses = {
+            0x03 : asset_cache.payload("scsi request sense", self.build_request_sense),
+            0x12 : asset_cache.payload("scsi inquiry", lambda: self.build_inquiry({ })),
+        }
+        for page in (0x1c, 0x3f, 0x00):
+            self.default_responses[(0x1a, page)] = asset_cache.payload(
+                    ("scsi mode sense", page),
+                    lambda: self.build_mode_sense({ }, page))
+        for image in self.disk_images:
+            self.default_responses[(0x23, image)] = self.build_read_format_capacity({ }, image)
+            self.default_responses[(0x25, image)] = self.build_read_capacity({ }, image)
+            self.default_responses[(0x9e, image)] = self.build_read_capacity_16({ }, image)
+
+        # opcode -> [commands, total seconds, slowest seconds]
+        self.scsi_stats = { }
+
+    def setup_scsi_handlers(self):
+        self.scsi_handlers = {
+            0x00 : self.handle_test_unit_ready,
+            0x03 : self.handle_request_sense,
+            0x12 : self.handle_inquiry,
+            0x1a : self.handle_mode_sense,
+            0x1e : self.handle_prevent_allow_removal,
+            0x23 : self.handle_read_format_capacity,
+            0x25 : self.handle_read_capacity,
+            0x28 : self.handle_read,
+            0x2a : self.handle_write,
+            0x35 : self.handle_synchronize_cache,
+            0x5a : self.handle_mode_sense,
+            0x88 : self.handle_read,
+            0x8a : self.handle_write,
+            0x9e : self.handle_service_action_in,
+            0xa8 : self.handle_read,
+            0xaa : self.handle_write,
+        }
 
     def handle_data_available(self, data):
 
@@ -99,377 +169,451 @@ class USBMassStorageInterface(USBInterface):
                 self.maxusb_app.fplog.write (" **SUPPORTED**\n")
             self.maxusb_app.stop = True
 
-        cbw = CommandBlockWrapper(data)
-        opcode = cbw.cb[0]
-        status = 0              # default to success
-        response = None         # with no response data
-
         if self.maxusb_app.server_running == True:
-            try:
-                self.maxusb_app.netserver_from_endpoint_sd.send(data)
-            except:
-                print ("Error: No network client connected")
+            reply = self.maxusb_app.endpoint_bridge.request(1, data)
+            if reply:
+                self.maxusb_app.send_on_endpoint(3, reply)
 
-            while True:
-                if len(self.maxusb_app.reply_buffer) > 0:
-                    self.maxusb_app.send_on_endpoint(3, self.maxusb_app.reply_buffer)
-                    self.maxusb_app.reply_buffer = ""
-                    break
+            self.send_csw(CommandBlockWrapper(data), 0)
+            return
 
-        elif self.is_write_in_progress:
-            if self.verbose > 0:
-                print(self.name, "got", len(data), "bytes of SCSI write data")
+        start = time.perf_counter()
 
-            self.write_data += data
+        if self.is_write_in_progress:
+            cbw = self.write_cbw
+            result = self.handle_write_data(data)
+            commands = 0    # the data phase is timed under its Write command
+        else:
+            cbw = CommandBlockWrapper(data)
+            if cbw.lun < len(self.disk_images) or cbw.cb[0] == 0x03:
+                handler = self.scsi_handlers.get(cbw.cb[0], self.handle_unsupported)
+            else:
+                handler = self.handle_bad_lun
+            result = handler(cbw)
+            commands = 1
 
-            if len(self.write_data) < self.write_length:
-                # more yet to read, don't send the CSW
-                return
+        self.record_scsi_stats(cbw.cb[0], commands, time.perf_counter() - start)
 
-            self.disk_image.put_sector_data(self.write_base_lba, self.write_data)
-            cbw = self.write_cbw
+        # None means the command's data phase is still to come
+        if result is not None:
+            status, response = result
 
-            self.is_write_in_progress = False
-            self.write_data = b''
-
-        elif opcode == 0x00:      # Test Unit Ready: just return OK status
-            if self.verbose > 0:
-                print(self.name, "got SCSI Test Unit Ready")
-
-        elif opcode == 0x03:    # Request Sense
-            if self.verbose > 0:
-                print(self.name, "got SCSI Request Sense, data",
-                        bytes_as_hex(cbw.cb[1:]))
-
-            response_code = b'\x70'
-            valid = b'\x00'
-            filemark = b'\x06'
-            information = b'\x00\x00\x00\x00'
-            command_info = b'\x00\x00\x00\x00'
-            additional_sense_code = b'\x3a'
-            additional_sens_code_qualifier = b'\x00'
-            field_replacement_unti_code = b'\x00'
-            sense_key_specific = b'\x00\x00\x00'
-
-            part1 = response_code + \
-                    valid + \
-                    filemark + \
-                    information
-
-            part2 = command_info + \
-                    additional_sense_code + \
-                    additional_sens_code_qualifier + \
-                    field_replacement_unti_code + \
-                    sense_key_specific
-
-            length = bytes([len(part2)])
-            response = part1 + length + part2
-
-
-        elif opcode == 0x12:    # Inquiry
-            if self.verbose > 0:
-                print(self.name, "got SCSI Inquiry, data",
-                        bytes_as_hex(cbw.cb[1:]))
-
-            if self.maxusb_app.testcase[1] == "inquiry_peripheral":
-                peripheral = self.maxusb_app.testcase[2]
-            else:
-                peripheral = b'\x00'    # SBC
-            if self.maxusb_app.testcase[1] == "inquiry_RMB":
-                RMB = self.maxusb_app.testcase[2]
-            else:
-                RMB = b'\x80'           # Removable
-            if self.maxusb_app.testcase[1] == "inquiry_version":
-                version = self.maxusb_app.testcase[2]
-            else:
-                version = b'\x00'
-            if self.maxusb_app.testcase[1] == "response_data_format":
-                response_data_format = self.maxusb_app.testcase[2]
-            else:
-                response_data_format = b'\x01'
-            if self.maxusb_app.testcase[1] == "config1":
-                config1 = self.maxusb_app.testcase[2]
-            else:
-                config1 = b'\x00'
-            if self.maxusb_app.testcase[1] == "config2":
-                config2 = self.maxusb_app.testcase[2]
-            else:
-                config2 = b'\x00'
-            if self.maxusb_app.testcase[1] == "config3":
-                config3 = self.maxusb_app.testcase[2]
-            else:
-                config3 = b'\x00'
-            if self.maxusb_app.testcase[1] == "vendor_id":
-                vendor_id = self.maxusb_app.testcase[2]
-            else:
-                vendor_id = b'PNY     '
-            if self.maxusb_app.testcase[1] == "product_id":
-                product_id = self.maxusb_app.testcase[2]
-            else:
-                product_id = b'USB 2.0 FD      '
-            if self.maxusb_app.testcase[1] == "product_revision_level":
-                product_revision_level = self.maxusb_app.testcase[2]
-            else:
-                product_revision_level = b'8.02'
-
-            part1 = peripheral + \
-                    RMB + \
-                    version + \
-                    response_data_format
-
-            part2 = config1 + \
-                    config2 + \
-                    config3 + \
-                    vendor_id + \
-                    product_id + \
-                    product_revision_level
-
-            length = bytes([len(part2)])
-            response = part1 + length + part2
-
-
-        elif opcode == 0x1a or opcode == 0x5a:    # Mode Sense (6 or 10)
-            page = cbw.cb[2] & 0x3f
-
-            if self.verbose > 0:
-                print(self.name, "got SCSI Mode Sense, page code 0x%02x" % page)
-
-            if page == 0x1c:
-
-                if self.maxusb_app.testcase[1] == "mode_sense_medium_type":
-                    medium_type = self.maxusb_app.testcase[2]
-                else:
-                    medium_type = b'\x00'
-                if self.maxusb_app.testcase[1] == "mode_sense_device_specific_param":
-                    device_specific_param = self.maxusb_app.testcase[2]
-                else:
-                    device_specific_param = b'\x00'
-                if self.maxusb_app.testcase[1] == "mode_sense_block_descriptor_len":
-                    block_descriptor_len = self.maxusb_app.testcase[2]
-                else:
-                    block_descriptor_len = b'\x00'
-                mode_page_1c = b'\x1c\x06\x00\x05\x00\x00\x00\x00'
-            
-                body =  medium_type + \
-                        device_specific_param + \
-                        block_descriptor_len + \
-                        mode_page_1c 
-
-                if self.maxusb_app.testcase[1] == "mode_sense_length":
-                    length = self.maxusb_app.testcase[2]
-                else:
-                    length = bytes([len(body)]) 
-                response = length + body
-
-            if page == 0x3f:
-                if self.maxusb_app.testcase[1] == "mode_sense_length":
-                    length = self.maxusb_app.testcase[2]
-                else:
-                    length = b'\x45'
-                if self.maxusb_app.testcase[1] == "mode_sense_medium_type":
-                    medium_type = self.maxusb_app.testcase[2]
-                else:
-                    medium_type = b'\x00'
-                if self.maxusb_app.testcase[1] == "mode_sense_device_specific_param":
-                    device_specific_param = self.maxusb_app.testcase[2]
-                else:
-                    device_specific_param = b'\x00'
-                if self.maxusb_app.testcase[1] == "mode_sense_block_descriptor_len":
-                    block_descriptor_len = self.maxusb_app.testcase[2]
-                else:
-                    block_descriptor_len = b'\x08'
-                mode_page = b'\x00\x00\x00\x00'
-
-                response =  length + \
-                            medium_type + \
-                            device_specific_param + \
-                            block_descriptor_len + \
-                            mode_page
+            if response:
+                if self.verbose > 2:
+                    print(self.name, "responding with", len(response), "bytes:",
+                            bytes_as_hex(response))
 
-            else:
-                if self.maxusb_app.testcase[1] == "mode_sense_length":
-                    length = self.maxusb_app.testcase[2]
-                else:
-                    length = b'\x07'
-                if self.maxusb_app.testcase[1] == "mode_sense_medium_type":
-                    medium_type = self.maxusb_app.testcase[2]
-                else:
-                    medium_type = b'\x00'
-                if self.maxusb_app.testcase[1] == "mode_sense_device_specific_param":
-                    device_specific_param = self.maxusb_app.testcase[2]
-                else:
-                    device_specific_param = b'\x00'
-                if self.maxusb_app.testcase[1] == "mode_sense_block_descriptor_len":
-                    block_descriptor_len = self.maxusb_app.testcase[2]
-                else:
-                    block_descriptor_len = b'\x00'
-                mode_page = b'\x00\x00\x00\x00'
-
-                response =  length + \
-                            medium_type + \
-                            device_specific_param + \
-                            block_descriptor_len + \
-                            mode_page
-
-
-        elif opcode == 0x1e:    # Prevent/Allow Removal: feign success
-            if self.verbose > 0:
-                print(self.name, "got SCSI Prevent/Allow Removal")
-
-        #elif opcode == 0x1a or opcode == 0x5a:      # Mode Sense (6 or 10)
-            # TODO
-
-        elif opcode == 0x23:    # Read Format Capacity
-            if self.verbose > 0:
-                print(self.name, "got SCSI Read Format Capacity")
-
-            if self.maxusb_app.testcase[1] == "read_format_capacity_capacity_list_length":
-                capacity_list_length = self.maxusb_app.testcase[2]
-            else:
-                capacity_list_length = b'\x00\x00\x00\x08'
-            if self.maxusb_app.testcase[1] == "read_format_capacity_number_of_blocks":
-                number_of_blocks = self.maxusb_app.testcase[2]
-            else:
-                number_of_blocks = b'\x00\x00\x10\x00'
-            if self.maxusb_app.testcase[1] == "read_format_capacity_descriptor_type":
-                descriptor_type = self.maxusb_app.testcase[2]
-            else:
-                descriptor_type = b'\x00'
-            if self.maxusb_app.testcase[1] == "read_format_capacity_block_length":
-                block_length = self.maxusb_app.testcase[2]
-            else:
-                block_length = b'\x00\x02\x00'
+                self.configuration.device.maxusb_app.send_on_endpoint(3, response)
 
-            response =  capacity_list_length + \
-                        number_of_blocks + \
-                        descriptor_type + \
-                        block_length
+            self.send_csw(cbw, status)
 
+    def send_csw(self, cbw, status):
+        csw = bytes([
+            ord('U'), ord('S'), ord('B'), ord('S'),
+            cbw.tag[0], cbw.tag[1], cbw.tag[2], cbw.tag[3],
+            0x00, 0x00, 0x00, 0x00,
+            status
+        ])
 
-        elif opcode == 0x25:    # Read Capacity
-            if self.verbose > 0:
-                print(self.name, "got SCSI Read Capacity, data",
-                        bytes_as_hex(cbw.cb[1:]))
+        if self.verbose > 3:
+            print(self.name, "responding with status =", status)
 
-            lastlba = self.disk_image.get_sector_count()
+        self.configuration.device.maxusb_app.send_on_endpoint(3, csw)
 
-            if self.maxusb_app.testcase[1] == "read_capacity_logical_block_address":
-                logical_block_address = self.maxusb_app.testcase[2]
-            else:
-                logical_block_address = bytes([
-                    (lastlba >> 24) & 0xff,
-                    (lastlba >> 16) & 0xff,
-                    (lastlba >>  8) & 0xff,
-                    (lastlba      ) & 0xff,
-                ])
+    def record_scsi_stats(self, opcode, commands, elapsed):
+        stats = self.scsi_stats.get(opcode)
+        if stats is None:
+            stats = self.scsi_stats[opcode] = [ 0, 0.0, 0.0 ]
 
+        stats[0] += commands
+        stats[1] += elapsed
+        if elapsed > stats[2]:
+            stats[2] = elapsed
 
-            if self.maxusb_app.testcase[1] == "read_capacity_length":
-                length = self.maxusb_app.testcase[2]
-            else:
-                length = b'\x00\x00\x02\x00'
-            response =  logical_block_address + \
-                        length
+    def scsi_stats_report(self):
+        """Per-opcode command counts and handler time, busiest first."""
 
-        elif opcode == 0x28:    # Read (10)
+        lines = [ "%-24s %8s %10s %10s %10s" % ("SCSI command", "count",
+                "total ms", "mean us", "max us") ]
 
-            if self.maxusb_app.mode == 4:
-                self.maxusb_app.stop = True
+        for opcode, (count, total, slowest) in sorted(self.scsi_stats.items(),
+                key=lambda x: x[1][1], reverse=True):
+            name = scsi_opcode_names.get(opcode, "opcode 0x%02x" % opcode)
+            mean = total / count if count else 0.0
+            lines.append("%-24s %8d %10.2f %10.1f %10.1f" % (name, count,
+                    total * 1e3, mean * 1e6, slowest * 1e6))
 
+        return "\n".join(lines)
 
-            base_lba = cbw.cb[2] << 24 \
-                     | cbw.cb[3] << 16 \
-                     | cbw.cb[4] << 8 \
-                     | cbw.cb[5]
+    def get_response(self, key, build, *args):
+        """The prebuilt response for key, unless this testcase overrides
+        mass storage fields, in which case build it from the overrides."""
 
-            num_blocks = cbw.cb[7] << 8 \
-                       | cbw.cb[8]
+        overrides = self.maxusb_app.overrides
+        if overrides.affects("mass_storage"):
+            return build(overrides, *args)
 
-            if self.verbose > 0:
-                print(self.name, "got SCSI Read (10), lba", base_lba, "+",
-                        num_blocks, "block(s)")
-                        
+        return self.default_responses[key]
 
-            # Note that here we send the data directly rather than putting
-            # something in 'response' and letting the end of the switch send
-            for block_num in range(num_blocks):
-                data = self.disk_image.get_sector_data(base_lba + block_num)
-                self.configuration.device.maxusb_app.send_on_endpoint(3, data)
+    def handle_test_unit_ready(self, cbw):
+        # just return OK status
+        if self.verbose > 0:
+            print(self.name, "got SCSI Test Unit Ready")
 
-        elif opcode == 0x2a:    # Write (10)
-            if self.verbose > 0:
-                print(self.name, "got SCSI Write (10), data",
-                        bytes_as_hex(cbw.cb[1:]))
+        return 0, None
 
-            base_lba = cbw.cb[1] << 24 \
-                     | cbw.cb[2] << 16 \
-                     | cbw.cb[3] <<  8 \
-                     | cbw.cb[4]
+    def handle_request_sense(self, cbw):
+        if self.verbose > 0:
+            print(self.name, "got SCSI Request Sense, data",
+                    bytes_as_hex(cbw.cb[1:]))
+
+        return 0, self.default_responses[0x03]
+
+    def build_request_sense(self):
+        response_code = b'\x70'
+        valid = b'\x00'
+        filemark = b'\x06'
+        information = b'\x00\x00\x00\x00'
+        command_info = b'\x00\x00\x00\x00'
+        additional_sense_code = b'\x3a'
+        additional_sens_code_qualifier = b'\x00'
+        field_replacement_unti_code = b'\x00'
+        sense_key_specific = b'\x00\x00\x00'
+
+        part1 = response_code + \
+                valid + \
+                filemark + \
+                information
+
+        part2 = command_info + \
+                additional_sense_code + \
+                additional_sens_code_qualifier + \
+                field_replacement_unti_code + \
+                sense_key_specific
+
+        length = bytes([len(part2)])
+        return part1 + length + part2
+
+    def handle_inquiry(self, cbw):
+        if self.verbose > 0:
+            print(self.name, "got SCSI Inquiry, data",
+                    bytes_as_hex(cbw.cb[1:]))
+
+        return 0, self.get_response(0x12, self.build_inquiry)
+
+    def build_inquiry(self, overrides):
+        peripheral = overrides.get("inquiry_peripheral", b'\x00') # SBC
+        RMB = overrides.get("inquiry_RMB", b'\x80') # Removable
+        version = overrides.get("inquiry_version", b'\x00')
+        response_data_format = overrides.get("response_data_format", b'\x01')
+        config1 = overrides.get("config1", b'\x00')
+        config2 = overrides.get("config2", b'\x00')
+        config3 = overrides.get("config3", b'\x00')
+        vendor_id = overrides.get("vendor_id", b'PNY     ')
+        product_id = overrides.get("product_id", b'USB 2.0 FD      ')
+        product_revision_level = overrides.get("product_revision_level", b'8.02')
+
+        part1 = peripheral + \
+                RMB + \
+                version + \
+                response_data_format
+
+        part2 = config1 + \
+                config2 + \
+                config3 + \
+                vendor_id + \
+                product_id + \
+                product_revision_level
+
+        length = bytes([len(part2)])
+        return part1 + length + part2
+
+    def handle_mode_sense(self, cbw):
+        # Mode Sense (6 or 10)
+        page = cbw.cb[2] & 0x3f
 
-            num_blocks = cbw.cb[7] << 8 \
-                       | cbw.cb[8]
+        if self.verbose > 0:
+            print(self.name, "got SCSI Mode Sense, page code 0x%02x" % page)
 
-            if self.verbose > 0:
-                print(self.name, "got SCSI Write (10), lba", base_lba, "+",
-                        num_blocks, "block(s)")
+        if page not in (0x1c, 0x3f):
+            page = 0x00
 
-            # save for later
-            self.write_cbw = cbw
-            self.write_base_lba = base_lba
-            self.write_length = num_blocks * self.disk_image.block_size
-            self.is_write_in_progress = True
+        return 0, self.get_response((0x1a, page), self.build_mode_sense, page)
 
-            # because we need to snarf up the data from wire before we reply
-            # with the CSW
-            return
+    def build_mode_sense(self, overrides, page):
+        if page == 0x1c:
+            medium_type = overrides.get("mode_sense_medium_type", b'\x00')
+            device_specific_param = overrides.get("mode_sense_device_specific_param", b'\x00')
+            block_descriptor_len = overrides.get("mode_sense_block_descriptor_len", b'\x00')
+            mode_page_1c = b'\x1c\x06\x00\x05\x00\x00\x00\x00'
 
-        elif opcode == 0x35:    # Synchronize Cache (10): blindly OK
-            if self.verbose > 0:
-                print(self.name, "got Synchronize Cache (10)")
+            body =  medium_type + \
+                    device_specific_param + \
+                    block_descriptor_len + \
+                    mode_page_1c
 
+            length = overrides.get("mode_sense_length", bytes([len(body)]))
+            return length + body
+
+        if page == 0x3f:
+            length = overrides.get("mode_sense_length", b'\x45')
+            block_descriptor_len = overrides.get("mode_sense_block_descriptor_len", b'\x08')
         else:
-            if self.verbose > 0:
-                print(self.name, "received unsupported SCSI opcode 0x%x" % opcode)
-            status = 0x02   # command failed
-            if cbw.data_transfer_length > 0:
-                response = bytes([0] * cbw.data_transfer_length)
+            length = overrides.get("mode_sense_length", b'\x07')
+            block_descriptor_len = overrides.get("mode_sense_block_descriptor_len", b'\x00')
 
-        if response and self.maxusb_app.server_running == False:
-            if self.verbose > 2:
-                print(self.name, "responding with", len(response), "bytes:",
-                        bytes_as_hex(response))
+        medium_type = overrides.get("mode_sense_medium_type", b'\x00')
+        device_specific_param = overrides.get("mode_sense_device_specific_param", b'\x00')
+        mode_page = b'\x00\x00\x00\x00'
 
-            self.configuration.device.maxusb_app.send_on_endpoint(3, response)
+        return  length + \
+                medium_type + \
+                device_specific_param + \
+                block_descriptor_len + \
+                mode_page
 
+    def handle_prevent_allow_removal(self, cbw):
+        # feign success
+        if self.verbose > 0:
+            print(self.name, "got SCSI Prevent/Allow Removal")
 
-        csw = bytes([
-            ord('U'), ord('S'), ord('B'), ord('S'),
-            cbw.tag[0], cbw.tag[1], cbw.tag[2], cbw.tag[3],
-            0x00, 0x00, 0x00, 0x00,
-            status
-        ])
+        return 0, None
 
-        if self.verbose > 3:
-            print(self.name, "responding with status =", status)
+    def handle_read_format_capacity(self, cbw):
+        if self.verbose > 0:
+            print(self.name, "got SCSI Read Format Capacity")
 
-#        if self.maxusb_app.server_running == False:
-        self.configuration.device.maxusb_app.send_on_endpoint(3, csw)
+        image = self.disk_images[cbw.lun]
+        return 0, self.get_response((0x23, image), self.build_read_format_capacity, image)
+
+    def build_read_format_capacity(self, overrides, image):
+        blocks = min(image.get_sector_count() + 1, 0xffffffff)
+
+        capacity_list_length = overrides.get("read_format_capacity_capacity_list_length", b'\x00\x00\x00\x08')
+        number_of_blocks = overrides.get("read_format_capacity_number_of_blocks", blocks.to_bytes(4, 'big'))
+        descriptor_type = overrides.get("read_format_capacity_descriptor_type", b'\x00')
+        block_length = overrides.get("read_format_capacity_block_length", image.block_size.to_bytes(3, 'big'))
+
+        return  capacity_list_length + \
+                number_of_blocks + \
+                descriptor_type + \
+                block_length
+
+    def handle_read_capacity(self, cbw):
+        if self.verbose > 0:
+            print(self.name, "got SCSI Read Capacity, data",
+                    bytes_as_hex(cbw.cb[1:]))
+
+        image = self.disk_images[cbw.lun]
+        return 0, self.get_response((0x25, image), self.build_read_capacity, image)
+
+    def build_read_capacity(self, overrides, image):
+        # an LBA that doesn't fit tells the host to use Read Capacity (16)
+        lastlba = min(image.get_sector_count(), 0xffffffff)
+
+        if "read_capacity_logical_block_address" in overrides:
+            logical_block_address = overrides["read_capacity_logical_block_address"]
+        else:
+            logical_block_address = bytes([
+                (lastlba >> 24) & 0xff,
+                (lastlba >> 16) & 0xff,
+                (lastlba >>  8) & 0xff,
+                (lastlba      ) & 0xff,
+            ])
+
+        length = overrides.get("read_capacity_length", image.block_size.to_bytes(4, 'big'))
+        return  logical_block_address + \
+                length
+
+    def handle_service_action_in(self, cbw):
+        if cbw.cb[1] & 0x1f != 0x10:
+            return self.handle_unsupported(cbw)
+
+        if self.verbose > 0:
+            print(self.name, "got SCSI Read Capacity (16), data",
+                    bytes_as_hex(cbw.cb[1:]))
+
+        image = self.disk_images[cbw.lun]
+        response = self.get_response((0x9e, image), self.build_read_capacity_16, image)
+
+        allocation_length = int.from_bytes(cbw.cb[10:14], 'big')
+        return 0, response[:allocation_length]
+
+    def build_read_capacity_16(self, overrides, image):
+        logical_block_address = image.get_sector_count().to_bytes(8, 'big')
+        length = overrides.get("read_capacity_length", image.block_size.to_bytes(4, 'big'))
+
+        # no protection, one logical block per physical block, lowest
+        # aligned LBA 0, then reserved
+        return  logical_block_address + \
+                length + \
+                bytes(20)
+
+    def get_lba_range(self, cb):
+        """(first LBA, block count) from a Read/Write (10), (12) or (16)
+        command block."""
+
+        opcode = cb[0]
+        if opcode in (0x88, 0x8a):
+            return int.from_bytes(cb[2:10], 'big'), int.from_bytes(cb[10:14], 'big')
+
+        base_lba = int.from_bytes(cb[2:6], 'big')
+        if opcode in (0xa8, 0xaa):
+            return base_lba, int.from_bytes(cb[6:10], 'big')
+
+        return base_lba, cb[7] << 8 | cb[8]
+
+    def handle_read(self, cbw):
+        # Read (10), (12) or (16)
+        if self.maxusb_app.mode == 4:
+            self.maxusb_app.stop = True
+
+        image = self.disk_images[cbw.lun]
+        base_lba, num_blocks = self.get_lba_range(cbw.cb)
+
+        if self.verbose > 0:
+            print(self.name, "got SCSI", scsi_opcode_names[cbw.cb[0]],
+                    "lun", cbw.lun, "lba", base_lba, "+", num_blocks, "block(s)")
+
+        # Note that here we send the data directly rather than returning it
+        # as the response.  The whole LBA range goes out as one view of the
+        # image, so packets stay full across sector boundaries and nothing
+        # is copied before the FIFO writes.
+        data = image.get_sector_range(base_lba, num_blocks)
+        try:
+            self.configuration.device.maxusb_app.send_on_endpoint(3, data)
+        finally:
+            data.release()
+
+        return 0, None
+
+    def handle_write(self, cbw):
+        # Write (10), (12) or (16)
+        if self.verbose > 0:
+            print(self.name, "got SCSI", scsi_opcode_names[cbw.cb[0]], "data",
+                    bytes_as_hex(cbw.cb[1:]))
+
+        image = self.disk_images[cbw.lun]
+        base_lba, num_blocks = self.get_lba_range(cbw.cb)
+
+        if self.verbose > 0:
+            print(self.name, "got SCSI", scsi_opcode_names[cbw.cb[0]],
+                    "lun", cbw.lun, "lba", base_lba, "+", num_blocks, "block(s)")
+
+        # no data phase follows; the next packet is a new CBW
+        if num_blocks == 0:
+            return 0, None
+
+        # save for later
+        self.write_cbw = cbw
+        self.write_image = image
+        self.write_base_lba = base_lba
+        self.write_length = num_blocks * image.block_size
+        self.is_write_in_progress = True
+
+        # because we need to snarf up the data from wire before we reply
+        # with the CSW
+        return None
+
+    def handle_write_data(self, data):
+        if self.verbose > 0:
+            print(self.name, "got", len(data), "bytes of SCSI write data")
+
+        self.write_data += data
+
+        if len(self.write_data) < self.write_length:
+            # more yet to read, don't send the CSW
+            return None
+
+        status = 0
+        if self.write_image is None:
+            status = 0x01       # data for a LUN we don't have: drop it
+        else:
+            # the whole payload lands in the image as one contiguous copy
+            self.write_image.put_sector_range(self.write_base_lba,
+                    memoryview(self.write_data)[:self.write_length])
+
+        self.is_write_in_progress = False
+        self.write_image = None
+        self.write_data = bytearray()
+
+        return status, None
+
+    def handle_synchronize_cache(self, cbw):
+        if self.verbose > 0:
+            print(self.name, "got Synchronize Cache (10)")
+
+        self.disk_images[cbw.lun].flush()
+
+        return 0, None
+
+    def handle_unsupported(self, cbw):
+        if self.verbose > 0:
+            print(self.name, "received unsupported SCSI opcode 0x%x" % cbw.cb[0])
+
+        # command failed
+        if cbw.data_transfer_length > 0:
+            return 0x02, bytes(cbw.data_transfer_length)
+
+        return 0x02, None
+
+    def handle_bad_lun(self, cbw):
+        if self.verbose > 0:
+            print(self.name, "got SCSI opcode 0x%x for missing lun %d" %
+                    (cbw.cb[0], cbw.lun))
+
+        if cbw.data_transfer_length == 0:
+            return 0x01, None
+
+        if cbw.flags & 0x80:
+            return 0x01, bytes(cbw.data_transfer_length)
+
+        # swallow the data-out phase before failing the command
+        self.write_cbw = cbw
+        self.write_image = None
+        self.write_length = cbw.data_transfer_length
+        self.is_write_in_progress = True
+        return None
 
 
 class DiskImage:
-    def __init__(self, filename, block_size):
+    """Block device backed by an mmap of filename.  Writes go straight into
+    the mapping but are only synced to disk on flush(): on SYNCHRONIZE
+    CACHE, on disconnect/close, or once flush_threshold bytes are dirty or
+    the oldest dirty write is flush_age seconds old.  The age is checked on
+    every write and by flush_if_due(), which the device calls while the
+    bus is idle."""
+
+    flush_threshold = 4 * 1024 * 1024   # bytes
+    flush_age = 5.0                     # seconds
+    dirty_since = None
+
+    def __init__(self, filename, block_size, flush_threshold=None,
+            flush_age=None):
         self.filename = filename
         self.block_size = block_size
 
+        if flush_threshold is not None:
+            self.flush_threshold = flush_threshold
+        if flush_age is not None:
+            self.flush_age = flush_age
+
         statinfo = os.stat(self.filename)
         self.size = statinfo.st_size
 
         self.file = open(self.filename, 'r+b')
         self.image = mmap(self.file.fileno(), 0)
 
+        # sorted, non-overlapping [start, end) byte ranges not yet synced
+        self.dirty_starts = [ ]
+        self.dirty_ends = [ ]
+        self.dirty_bytes = 0
+        self.dirty_since = None
+
     def close(self):
-        self.image.flush()
+        self.flush()
         self.image.close()
+        self.file.close()
 
     def get_sector_count(self):
         return int(self.size / self.block_size) - 1
@@ -480,12 +624,167 @@ class DiskImage:
 
         return self.image[block_start:block_end]
 
+    def get_sector_range(self, address, count):
+        """Return a memoryview over count sectors starting at address, cut
+        short at the end of the image.  Release it when done; the image
+        can't be closed while a view is held."""
+
+        block_start = min(address * self.block_size, self.size)
+        block_end   = min((address + count) * self.block_size, self.size)
+
+        return memoryview(self.image)[block_start:block_end]
+
     def put_sector_data(self, address, data):
-        block_start = address * self.block_size
-        block_end   = (address + 1) * self.block_size   # slices are NON-inclusive
+        self.put_sector_range(address, data[:self.block_size])
+
+    def put_sector_range(self, address, data):
+        """Copy data, any number of whole or partial sectors, into the image
+        starting at sector address; anything past the end is dropped."""
+
+        block_start = min(address * self.block_size, self.size)
+        block_end   = min(block_start + len(data), self.size)
+
+        if block_end <= block_start:
+            return
+
+        self.image[block_start:block_end] = data[:block_end - block_start]
+        self.mark_dirty(block_start, block_end)
+
+    def mark_dirty(self, start, end):
+        # merge with every range that overlaps or touches [start, end)
+        lo = bisect.bisect_left(self.dirty_ends, start)
+        hi = bisect.bisect_right(self.dirty_starts, end)
+
+        if lo < hi:
+            start = min(start, self.dirty_starts[lo])
+            end = max(end, self.dirty_ends[hi - 1])
+            for i in range(lo, hi):
+                self.dirty_bytes -= self.dirty_ends[i] - self.dirty_starts[i]
+
+        self.dirty_starts[lo:hi] = [ start ]
+        self.dirty_ends[lo:hi] = [ end ]
+        self.dirty_bytes += end - start
+
+        if self.dirty_since is None:
+            self.dirty_since = time.monotonic()
 
-        self.image[block_start:block_end] = data[:self.block_size]
-        self.image.flush()
+        if self.dirty_bytes >= self.flush_threshold:
+            self.flush()
+        else:
+            self.flush_if_due()
+
+    def flush_if_due(self):
+        """Flush if the oldest dirty write is flush_age seconds old."""
+
+        if self.dirty_since is not None and \
+                time.monotonic() - self.dirty_since >= self.flush_age:
+            self.flush()
+
+    def flush(self):
+        """Sync the dirty ranges of the mapping back to the file."""
+
+        for start, end in zip(self.dirty_starts, self.dirty_ends):
+            # msync offsets must be page aligned
+            offset = start - (start % ALLOCATIONGRANULARITY)
+            self.image.flush(offset, end - offset)
+
+        self.dirty_starts = [ ]
+        self.dirty_ends = [ ]
+        self.dirty_bytes = 0
+        self.dirty_since = None
+
+
+class OverlayDiskImage(DiskImage):
+    """Copy-on-write view of a disk image: the file is mapped read-only and
+    every write lands in a sparse in-memory delta of whole blocks.  The
+    delta can be snapshotted and restored (or dropped with reset()) at a
+    cost proportional to the number of dirty blocks, so a fuzzing campaign
+    can start each testcase from the same disk without copying it."""
+
+    def __init__(self, filename, block_size):
+        self.filename = filename
+        self.block_size = block_size
+
+        # the base mapping is shared with any other overlay of the same file
+        self.asset = asset_cache.acquire(self.filename)
+        self.image = self.asset.data
+        self.size = len(self.asset)
+
+        # block number -> bytes; values are never mutated in place, so a
+        # snapshot only has to copy the dict
+        self.delta = { }
+
+    def close(self):
+        self.delta = { }
+        if self.asset is not None:
+            asset_cache.release(self.asset)
+            self.asset = None
+            self.image = None
+
+    def flush(self):
+        # nothing is ever written back to the base image
+        pass
+
+    def snapshot(self):
+        return dict(self.delta)
+
+    def restore(self, snapshot):
+        self.delta = dict(snapshot)
+
+    def reset(self):
+        self.delta = { }
+
+    def get_base_block(self, block):
+        start = block * self.block_size
+        return self.image[start:start + self.block_size]
+
+    def get_sector_data(self, address):
+        if address in self.delta:
+            return self.delta[address]
+
+        return DiskImage.get_sector_data(self, address)
+
+    def get_sector_range(self, address, count):
+        view = DiskImage.get_sector_range(self, address, count)
+
+        # only the blocks inside the image; a fuzzed count can be 2^32
+        end = address + -(-len(view) // self.block_size)
+        if len(self.delta) < end - address:
+            dirty = sorted(b for b in self.delta if address <= b < end)
+        else:
+            dirty = [ b for b in range(address, end) if b in self.delta ]
+        if not dirty:
+            return view
+
+        # patch the overlaid blocks into a private copy of the range
+        data = bytearray(view)
+        view.release()
+
+        for block in dirty:
+            start = (block - address) * self.block_size
+            data[start:start + self.block_size] = \
+                    self.delta[block][:len(data) - start]
+
+        return memoryview(data)
+
+    def put_sector_range(self, address, data):
+        block_start = min(address * self.block_size, self.size)
+        block_end   = min(block_start + len(data), self.size)
+
+        offset = 0
+        block = address
+        while block_start + offset < block_end:
+            n = min(self.block_size, block_end - block_start - offset)
+            chunk = data[offset:offset + n]
+
+            if n < self.block_size:
+                old = self.delta.get(block) or self.get_base_block(block)
+                chunk = bytes(chunk) + old[n:]
+
+            self.delta[block] = bytes(chunk)
+
+            offset += n
+            block += 1
 
 
 class CommandBlockWrapper:
@@ -517,10 +816,46 @@ class CommandBlockWrapper:
 class USBMassStorageDevice(USBDevice):
     name = "USB mass storage device"
 
-    def __init__(self, maxusb_app, vid, pid, rev, int_class, int_sub, int_proto, disk_image_filename, verbose=0):
-        self.disk_image = DiskImage(disk_image_filename, 512)
+    # one overlay per image file and block size, kept across mass storage
+    # fuzz testcases
+    overlays = { }
+
+    # disk_image_filename may also name a directory, which is presented as
+    # a synthesized FAT volume of disk_size bytes (default: big enough), or
+    # be a list of names to expose one LUN per image
+    def __init__(self, maxusb_app, vid, pid, rev, int_class, int_sub, int_proto, disk_image_filename, verbose=0, disk_size=None, block_size=512):
+        if isinstance(disk_image_filename, str):
+            filenames = [ disk_image_filename ]
+        else:
+            filenames = list(disk_image_filename)[:16]
+
+        self.disk_images = [ ]
+        self.owns_disk_image = maxusb_app.mode != 4
+
+        for filename in filenames:
+            if maxusb_app.mode == 4:
+                # fuzzing: never touch the image on disk and start every
+                # testcase from the same contents
+                key = (filename, block_size)
+                overlay = self.overlays.get(key)
+                if overlay is None:
+                    if os.path.isdir(filename):
+                        overlay = FatDiskImage(filename, block_size, disk_size)
+                    else:
+                        overlay = OverlayDiskImage(filename, block_size)
+                    self.overlays[key] = overlay
+                overlay.reset()
+
+                self.disk_images.append(overlay)
+            elif os.path.isdir(filename):
+                self.disk_images.append(FatDiskImage(filename, block_size, disk_size))
+            else:
+                self.disk_images.append(DiskImage(filename, block_size))
+
+        self.disk_image = self.disk_images[0]
 
-        interface = USBMassStorageInterface(maxusb_app, self.disk_image, int_class, int_sub, int_proto, verbose=verbose)
+        interface = USBMassStorageInterface(maxusb_app, self.disk_images, int_class, int_sub, int_proto, verbose=verbose)
+        self.interface = interface
 
         if vid == 0x1111:
             vid = 0x154b
@@ -553,7 +888,20 @@ class USBMassStorageDevice(USBDevice):
                 verbose=verbose
         )
 
+    def handle_idle(self):
+        for image in self.disk_images:
+            image.flush_if_due()
+
+    def handle_bus_disconnect(self):
+        for image in self.disk_images:
+            image.flush()
+
+        if self.verbose > 0 and self.interface.scsi_stats:
+            print(self.interface.scsi_stats_report())
+
     def disconnect(self):
-        self.disk_image.close()
         USBDevice.disconnect(self)
+        if self.owns_disk_image:
+            for image in self.disk_images:
+                image.close()
 
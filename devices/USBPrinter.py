@@ -2,8 +2,8 @@
 #
 # Contains class definitions to implement a USB printer device.
 
-from mmap import mmap
 import os
+import re
 import time
 
 from USB import *
@@ -14,6 +14,7 @@ from USBEndpoint import *
 from USBClass import *
 
 from util import *
+from assets import asset_cache
 
 class USBPrinterClass(USBClass):
     name = "USB printer class"
@@ -37,62 +38,32 @@ class USBPrinterClass(USBClass):
                 self.maxusb_app.fplog.write (" **SUPPORTED**\n")
             self.maxusb_app.stop = True
 
-        if self.maxusb_app.testcase[1] == "Device_ID_Key1":
-            device_id_key1 = self.maxusb_app.testcase[2]
+        # the default string is the same for every device, so it is built
+        # once per process
+        overrides = self.maxusb_app.overrides
+        if overrides.affects("printer"):
+            device_id_response = self.build_device_id(overrides)
         else:
-            device_id_key1 = b"MFG"
-        if self.maxusb_app.testcase[1] == "Device_ID_Value1":
-            device_id_value1 = self.maxusb_app.testcase[2]
-        else:
-            device_id_value1 = b"Hewlett-Packard"
-        if self.maxusb_app.testcase[1] == "Device_ID_Key2":
-            device_id_key2 = self.maxusb_app.testcase[2]
-        else:
-            device_id_key2 = b"CMD"
-        if self.maxusb_app.testcase[1] == "Device_ID_Value2":
-            device_id_value2 = self.maxusb_app.testcase[2]
-        else:
-            device_id_value2 = b"PJL,PML,PCLXL,POSTSCRIPT,PCL"
-        if self.maxusb_app.testcase[1] == "Device_ID_Key3":
-            device_id_key3 = self.maxusb_app.testcase[2]
-        else:
-            device_id_key3 = b"MDL"
-        if self.maxusb_app.testcase[1] == "Device_ID_Value3":
-            device_id_value3 = self.maxusb_app.testcase[2]
-        else:
-            device_id_value3 = b"HP Color LaserJet CP1515n"
-        if self.maxusb_app.testcase[1] == "Device_ID_Key4":
-            device_id_key4 = self.maxusb_app.testcase[2]
-        else:
-            device_id_key4 = b"CLS"
-        if self.maxusb_app.testcase[1] == "Device_ID_Value4":
-            device_id_value4 = self.maxusb_app.testcase[2]
-        else:
-            device_id_value4 = b"PRINTER"
-        if self.maxusb_app.testcase[1] == "Device_ID_Key5":
-            device_id_key5 = self.maxusb_app.testcase[2]
-        else:
-            device_id_key5 = b"DES"
-        if self.maxusb_app.testcase[1] == "Device_ID_Value5":
-            device_id_value5 = self.maxusb_app.testcase[2]
-        else:
-            device_id_value5 = b"Hewlett-Packard Color LaserJet CP1515n"
-        if self.maxusb_app.testcase[1] == "Device_ID_Key6":
-            device_id_key6 = self.maxusb_app.testcase[2]
-        else:
-            device_id_key6 = b"MEM"
-        if self.maxusb_app.testcase[1] == "Device_ID_Value6":
-            device_id_value6 = self.maxusb_app.testcase[2]
-        else:
-            device_id_value6 = b"MEM=55MB"
-        if self.maxusb_app.testcase[1] == "Device_ID_Key7":
-            device_id_key7 = self.maxusb_app.testcase[2]
-        else:
-            device_id_key7 = b"COMMENT"
-        if self.maxusb_app.testcase[1] == "Device_ID_Value7":
-            device_id_value7 = self.maxusb_app.testcase[2]
-        else:
-            device_id_value7 = b"RES=600x8"
+            device_id_response = asset_cache.payload("printer device id",
+                    lambda: self.build_device_id({ }))
+
+        self.interface.configuration.device.maxusb_app.send_on_endpoint(0, device_id_response)
+
+    def build_device_id(self, overrides):
+        device_id_key1 = overrides.get("Device_ID_Key1", b"MFG")
+        device_id_value1 = overrides.get("Device_ID_Value1", b"Hewlett-Packard")
+        device_id_key2 = overrides.get("Device_ID_Key2", b"CMD")
+        device_id_value2 = overrides.get("Device_ID_Value2", b"PJL,PML,PCLXL,POSTSCRIPT,PCL")
+        device_id_key3 = overrides.get("Device_ID_Key3", b"MDL")
+        device_id_value3 = overrides.get("Device_ID_Value3", b"HP Color LaserJet CP1515n")
+        device_id_key4 = overrides.get("Device_ID_Key4", b"CLS")
+        device_id_value4 = overrides.get("Device_ID_Value4", b"PRINTER")
+        device_id_key5 = overrides.get("Device_ID_Key5", b"DES")
+        device_id_value5 = overrides.get("Device_ID_Value5", b"Hewlett-Packard Color LaserJet CP1515n")
+        device_id_key6 = overrides.get("Device_ID_Key6", b"MEM")
+        device_id_value6 = overrides.get("Device_ID_Value6", b"MEM=55MB")
+        device_id_key7 = overrides.get("Device_ID_Key7", b"COMMENT")
+        device_id_value7 = overrides.get("Device_ID_Value7", b"RES=600x8")
 
 
         device_id_length = b"\x00\xAB" # 171 bytes
@@ -109,9 +80,7 @@ class USBPrinterClass(USBClass):
         (length >> 8) & 0xff,
         (length)      & 0xff])
 
-        device_id_response = device_id_length + device_id_elements
-
-        self.interface.configuration.device.maxusb_app.send_on_endpoint(0, device_id_response)
+        return device_id_length + device_id_elements
 
 
 class USBPrinterInterface(USBInterface):
@@ -120,9 +89,7 @@ class USBPrinterInterface(USBInterface):
     def __init__(self, int_num, maxusb_app, usbclass, sub, proto, verbose=0):
         self.maxusb_app = maxusb_app
         self.int_num = int_num
-        self.filename = time.strftime("%Y%m%d%H%M%S", time.localtime())
-        self.filename += ".pcl"
-        self.writing = False
+        self.capture = PrintJobCapture(verbose)
 
 
         descriptors = { }
@@ -210,26 +177,167 @@ class USBPrinterInterface(USBInterface):
         self.write_data = b''
 
     def handle_data_available(self,data):
+        self.capture.write(data)
+
+class PrintJobCapture:
+    """Streams the data sent to a printer interface into one file per print
+    job.  The job language is guessed from its first bytes and the end of
+    the job found incrementally, so a terminator split across packets is
+    still seen:
+
+        PJL         "@PJL EOJ" line, plus the UEL that normally follows it
+        PostScript  Ctrl-D, a "%%EOF" line or a UEL
+        PCL         a UEL after the start of the job
+
+    Anything left open is closed by close() when the device goes away."""
+
+    uel = b'\x1b%-12345X'       # Universal Exit Language
+
+    terminators = {
+        "pjl"   : re.compile(rb'@PJL[ \t]+EOJ[^\n]*\n'),
+        "ps"    : re.compile(rb'%%EOF[^\n]*\n|\x04|\x1b%-12345X'),
+        "pcl"   : re.compile(rb'\x1b%-12345X'),
+    }
+
+    extensions = {
+        "pjl"   : ".pcl",
+        "ps"    : ".ps",
+        "pcl"   : ".pcl",
+    }
+
+    # bytes kept from the previous packet to match terminators across a
+    # packet boundary; enough for a PJL EOJ line with a long job name
+    tail_size = 256
+    buffer_size = 256 * 1024
+
+    # bytes skipped between jobs rather than starting a job of their own
+    separators = b'\x00\x04\r\n'
+
+    # job openings that start_job() tells apart
+    signatures = (uel, b'@PJL', b'%!')
+
+    jobs = 0                    # numbers the files across all interfaces
+
+    def __init__(self, verbose=0):
+        self.verbose = verbose
+        self.file = None
+        self.filename = None
+        self.language = None
+        self.job_length = 0
+        self.tail = b''
+        self.uel_seen = -1      # UEL bytes matched after EOJ; -1 if not ending
+        self.pending = b''      # start of the next job, not yet classified
+
+    def write(self, data):
+        while data:
+            if self.file is None:
+                data = (self.pending + data).lstrip(self.separators)
+                self.pending = b''
+                if not data:
+                    return
+                if len(data) < len(self.uel) and \
+                        any(s.startswith(data) for s in self.signatures):
+                    # too short to tell the language yet
+                    self.pending = data
+                    return
+                self.start_job(data)
+
+            if self.uel_seen >= 0:
+                data = self.finish_uel(data)
+                continue
+
+            end = self.find_end(data)
+            if end < 0:
+                self.append(data)
+                return
+
+            self.append(data[:end])
+            data = data[end:]
+
+            if self.language == "pjl":
+                self.uel_seen = 0
+            else:
+                self.finish_job()
+
+    def start_job(self, data):
+        if data.startswith(self.uel) or data.startswith(b'@PJL'):
+            self.language = "pjl"
+        elif data.startswith(b'%!'):
+            self.language = "ps"
+        else:
+            self.language = "pcl"
+
+        PrintJobCapture.jobs += 1
+        self.filename = time.strftime("%Y%m%d%H%M%S", time.localtime()) + \
+                "-%d" % PrintJobCapture.jobs + self.extensions[self.language]
+        self.file = open(self.filename, "wb", buffering=self.buffer_size)
+        self.job_length = 0
+        self.tail = b''
+        self.uel_seen = -1
+
+        print ("Writing print job to %s" % self.filename)
+
+    def append(self, data):
+        self.file.write(data)
+        self.job_length += len(data)
+        self.tail = (self.tail + data)[-self.tail_size:]
 
-        if self.writing == False:
-            print ("Writing PCL file: %s" % self.filename)
+    def find_end(self, data):
+        """Offset in data just past the job's terminator, or -1."""
 
-        text_buffer=""
+        buf = self.tail + data
+        skip = len(self.tail)
+        pattern = self.terminators[self.language]
 
-        with open(self.filename, "ab") as out_file:
-            self.writing = True
-            out_file.write(data)
+        # the leading UEL of a job is not its end
+        pos = 1 if self.job_length == len(self.tail) else 0
 
-        x=0
-        while x < len(data):
-            text_buffer += chr(data[x])
-            x+=1
+        m = pattern.search(buf, pos)
+        if m is None:
+            return -1
 
+        return m.end() - skip
+
+    def finish_uel(self, data):
+        """Take the UEL that closes a PJL job, which may be split across
+        packets, and finish the job.  Returns the rest of data."""
+
+        want = self.uel[self.uel_seen:]
+        n = 0
+        while n < len(want) and n < len(data) and data[n] == want[n]:
+            n += 1
+
+        if n == len(data) and n < len(want):
+            # all of data is more of the UEL; wait for the rest
+            self.append(data)
+            self.uel_seen += n
+            return b''
+
+        if n == len(want):
+            self.append(data[:n])
+        else:
+            n = 0
+
+        self.finish_job()
+        return data[n:]
+
+    def finish_job(self):
+        self.file.close()
+        print ("Print job complete: %s (%d bytes)" % (self.filename,
+                self.job_length))
+
+        self.file = None
+        self.uel_seen = -1
+
+    def close(self):
+        if self.file is None and self.pending:
+            self.start_job(self.pending)
+            self.append(self.pending)
+            self.pending = b''
+
+        if self.file is not None:
+            self.finish_job()
 
-        if 'EOJ\n' in text_buffer:
-            print ("File write complete")
-            out_file.close()
-            self.maxusb_app.stop = True    
 
 class USBPrinterDevice(USBDevice):
     name = "USB printer device"
@@ -251,6 +359,8 @@ class USBPrinterDevice(USBDevice):
         if rev == 0x3333:
             rev = 0x0100
 
+        self.interfaces = [ interface1, interface2 ]
+
         config = USBConfiguration(
                 maxusb_app,
                 1,                                          # index
@@ -275,6 +385,11 @@ class USBPrinterDevice(USBDevice):
                 verbose=verbose
         )
 
+    def handle_bus_disconnect(self):
+        # a job still open when the host goes away is kept as it is
+        for interface in self.interfaces:
+            interface.capture.close()
+
     def disconnect(self):
         USBDevice.disconnect(self)
 
@@ -39,92 +39,29 @@ class USBSmartcardInterface(USBInterface):
 
         self.maxusb_app = maxusb_app
 
-        if self.maxusb_app.testcase[1] == "icc_bLength":
-            bLength = self.maxusb_app.testcase[2]
-        else:
-            bLength = b'\x36'
+        bLength = self.maxusb_app.overrides.get("icc_bLength", b'\x36')
 
-        if self.maxusb_app.testcase[1] == "icc_bDescriptorType":
-            bDescriptorType = self.maxusb_app.testcase[2]
-        else:
-            bDescriptorType = b'\x21'   # USB-ICC
+        bDescriptorType = self.maxusb_app.overrides.get("icc_bDescriptorType", b'\x21') # USB-ICC
         bcdCCID = b'\x10\x01'
-        if self.maxusb_app.testcase[1] == "icc_bMaxSlotIndex":
-            bMaxSlotIndex = self.maxusb_app.testcase[2]
-        else:
-            bMaxSlotIndex = b'\x00' # index of highest available slot
-        if self.maxusb_app.testcase[1] == "icc_bVoltageSupport":
-            bVoltageSupport = self.maxusb_app.testcase[2]
-        else:
-            bVoltageSupport = b'\x07'
-        if self.maxusb_app.testcase[1] == "icc_dwProtocols":
-            dwProtocols = self.maxusb_app.testcase[2]
-        else:
-            dwProtocols = b'\x03\x00\x00\x00'
-        if self.maxusb_app.testcase[1] == "icc_dwDefaultClock":
-            dwDefaultClock = self.maxusb_app.testcase[2]
-        else:
-            dwDefaultClock = b'\xA6\x0E\x00\x00'
-        if self.maxusb_app.testcase[1] == "icc_dwMaximumClock":
-            dwMaximumClock = self.maxusb_app.testcase[2]
-        else:
-            dwMaximumClock = b'\x4C\x1D\x00\x00'
-        if self.maxusb_app.testcase[1] == "icc_bNumClockSupported":
-            bNumClockSupported = self.maxusb_app.testcase[2]
-        else:
-            bNumClockSupported = b'\x00'
-        if self.maxusb_app.testcase[1] == "icc_dwDataRate":
-            dwDataRate = self.maxusb_app.testcase[2]
-        else:
-            dwDataRate = b'\x60\x27\x00\x00'
-        if self.maxusb_app.testcase[1] == "icc_dwMaxDataRate":
-            dwMaxDataRate = self.maxusb_app.testcase[2]
-        else:
-            dwMaxDataRate = b'\xB4\xC4\x04\x00'
-        if self.maxusb_app.testcase[1] == "icc_bNumDataRatesSupported":
-            bNumDataRatesSupported = self.maxusb_app.testcase[2]
-        else:
-            bNumDataRatesSupported = b'\x00'
-        if self.maxusb_app.testcase[1] == "icc_dwMaxIFSD":
-            dwMaxIFSD = self.maxusb_app.testcase[2]
-        else:
-            dwMaxIFSD = b'\xFE\x00\x00\x00'
-        if self.maxusb_app.testcase[1] == "icc_dwSynchProtocols":
-            dwSynchProtocols = self.maxusb_app.testcase[2]
-        else:
-            dwSynchProtocols =  b'\x00\x00\x00\x00'
-        if self.maxusb_app.testcase[1] == "icc_dwMechanical":
-            dwMechanical = self.maxusb_app.testcase[2]
-        else:
-            dwMechanical = b'\x00\x00\x00\x00'
-        if self.maxusb_app.testcase[1] == "icc_dwFeatures":
-            dwFeatures = self.maxusb_app.testcase[2]
-        else:
-            dwFeatures = b'\x30\x00\x01\x00'
-        if self.maxusb_app.testcase[1] == "icc_dwMaxCCIDMessageLength":
-            dwMaxCCIDMessageLength = self.maxusb_app.testcase[2]
-        else:
-            dwMaxCCIDMessageLength = b'\x0F\x01\x00\x00'
-        if self.maxusb_app.testcase[1] == "icc_bClassGetResponse":
-            bClassGetResponse = self.maxusb_app.testcase[2]
-        else:
-            bClassGetResponse = b'\x00'
-        if self.maxusb_app.testcase[1] == "icc_bClassEnvelope":
-            bClassEnvelope = self.maxusb_app.testcase[2]
-        else:
-            bClassEnvelope = b'\x00'
-        if self.maxusb_app.testcase[1] == "icc_wLcdLayout":
-            wLcdLayout = self.maxusb_app.testcase[2]
-        else:
-            wLcdLayout = b'\x00\x00'
-        if self.maxusb_app.testcase[1] == "icc_bPinSupport":
-            bPinSupport = self.maxusb_app.testcase[2]
-        else:
-            bPinSupport = b'\x00'
-        if self.maxusb_app.testcase[1] == "icc_bMaxCCIDBusySlots":
-            bMaxCCIDBusySlots = self.maxusb_app.testcase[2]
-        else:
-            bMaxCCIDBusySlots = b'\x01'
+        bMaxSlotIndex = self.maxusb_app.overrides.get("icc_bMaxSlotIndex", b'\x00') # index of highest available slot
+        bVoltageSupport = self.maxusb_app.overrides.get("icc_bVoltageSupport", b'\x07')
+        dwProtocols = self.maxusb_app.overrides.get("icc_dwProtocols", b'\x03\x00\x00\x00')
+        dwDefaultClock = self.maxusb_app.overrides.get("icc_dwDefaultClock", b'\xA6\x0E\x00\x00')
+        dwMaximumClock = self.maxusb_app.overrides.get("icc_dwMaximumClock", b'\x4C\x1D\x00\x00')
+        bNumClockSupported = self.maxusb_app.overrides.get("icc_bNumClockSupported", b'\x00')
+        dwDataRate = self.maxusb_app.overrides.get("icc_dwDataRate", b'\x60\x27\x00\x00')
+        dwMaxDataRate = self.maxusb_app.overrides.get("icc_dwMaxDataRate", b'\xB4\xC4\x04\x00')
+        bNumDataRatesSupported = self.maxusb_app.overrides.get("icc_bNumDataRatesSupported", b'\x00')
+        dwMaxIFSD = self.maxusb_app.overrides.get("icc_dwMaxIFSD", b'\xFE\x00\x00\x00')
+        dwSynchProtocols = self.maxusb_app.overrides.get("icc_dwSynchProtocols",  b'\x00\x00\x00\x00')
+        dwMechanical = self.maxusb_app.overrides.get("icc_dwMechanical", b'\x00\x00\x00\x00')
+        dwFeatures = self.maxusb_app.overrides.get("icc_dwFeatures", b'\x30\x00\x01\x00')
+        dwMaxCCIDMessageLength = self.maxusb_app.overrides.get("icc_dwMaxCCIDMessageLength", b'\x0F\x01\x00\x00')
+        bClassGetResponse = self.maxusb_app.overrides.get("icc_bClassGetResponse", b'\x00')
+        bClassEnvelope = self.maxusb_app.overrides.get("icc_bClassEnvelope", b'\x00')
+        wLcdLayout = self.maxusb_app.overrides.get("icc_wLcdLayout", b'\x00\x00')
+        bPinSupport = self.maxusb_app.overrides.get("icc_bPinSupport", b'\x00')
+        bMaxCCIDBusySlots = self.maxusb_app.overrides.get("icc_bMaxCCIDBusySlots", b'\x01')
 
         self.icc_descriptor =    bLength + \
                             bDescriptorType + \
@@ -230,44 +167,19 @@ class USBSmartcardInterface(USBInterface):
 #        print ("bReserved=",bReserved) 
 
         if self.maxusb_app.server_running == True:
-            try:
-                self.maxusb_app.netserver_from_endpoint_sd.send(data)
-            except:
-                print ("Error: No network client connected")
-
-            while True:
-                if len(self.maxusb_app.reply_buffer) > 0:
-                    self.maxusb_app.send_on_endpoint(2, self.maxusb_app.reply_buffer)
-                    self.maxusb_app.reply_buffer = ""
-                    break
+            reply = self.maxusb_app.endpoint_bridge.request(1, data)
+            if reply:
+                self.maxusb_app.send_on_endpoint(2, reply)
 
 
         elif command == 0x61: # PC_to_RDR_SetParameters
 
-            if self.maxusb_app.testcase[1] == "SetParameters_bMessageType":
-                bMessageType = self.maxusb_app.testcase[2]
-            else:
-                bMessageType = b'\x82'  # RDR_to_PC_Parameters
-            if self.maxusb_app.testcase[1] == "SetParameters_dwLength":
-                dwLength = self.maxusb_app.testcase[2]
-            else:
-                dwLength = b'\x05\x00\x00\x00' # Message-specific data length
-            if self.maxusb_app.testcase[1] == "SetParameters_bSlot":
-                bSlot = self.maxusb_app.testcase[2]
-            else:
-                bSlot = b'\x00' # fixed for legacy reasons
-            if self.maxusb_app.testcase[1] == "SetParameters_bStatus":
-                bStatus = self.maxusb_app.testcase[2]
-            else:
-                bStatus = b'\x00' # reserved
-            if self.maxusb_app.testcase[1] == "SetParameters_bError":
-                bError = self.maxusb_app.testcase[2]
-            else:
-                bError = b'\x80'
-            if self.maxusb_app.testcase[1] == "SetParameters_bProtocolNum":
-                bProtocolNum = self.maxusb_app.testcase[2]
-            else:
-                bProtocolNum = b'\x00'
+            bMessageType = self.maxusb_app.overrides.get("SetParameters_bMessageType", b'\x82') # RDR_to_PC_Parameters
+            dwLength = self.maxusb_app.overrides.get("SetParameters_dwLength", b'\x05\x00\x00\x00') # Message-specific data length
+            bSlot = self.maxusb_app.overrides.get("SetParameters_bSlot", b'\x00') # fixed for legacy reasons
+            bStatus = self.maxusb_app.overrides.get("SetParameters_bStatus", b'\x00') # reserved
+            bError = self.maxusb_app.overrides.get("SetParameters_bError", b'\x80')
+            bProtocolNum = self.maxusb_app.overrides.get("SetParameters_bProtocolNum", b'\x00')
 
             abProtocolDataStructure = b'\x11\x00\x00\x0a\x00'
             
@@ -285,30 +197,12 @@ class USBSmartcardInterface(USBInterface):
 
             if bReserved == 2:
 
-                if self.maxusb_app.testcase[1] == "IccPowerOn_bMessageType":
-                    bMessageType = self.maxusb_app.testcase[2]
-                else:
-                    bMessageType = b'\x80'  # RDR_to_PC_DataBlock
-                if self.maxusb_app.testcase[1] == "IccPowerOn_dwLength":
-                    dwLength = self.maxusb_app.testcase[2]
-                else:
-                    dwLength = b'\x12\x00\x00\x00' # Message-specific data length
-                if self.maxusb_app.testcase[1] == "IccPowerOn_bSlot":
-                    bSlot = self.maxusb_app.testcase[2]
-                else:
-                    bSlot = b'\x00' # fixed for legacy reasons
-                if self.maxusb_app.testcase[1] == "IccPowerOn_bStatus":
-                    bStatus = self.maxusb_app.testcase[2]
-                else:
-                    bStatus = b'\x00'
-                if self.maxusb_app.testcase[1] == "IccPowerOn_bError":
-                    bError = self.maxusb_app.testcase[2]
-                else:
-                    bError = b'\x80'
-                if self.maxusb_app.testcase[1] == "IccPowerOn_bChainParameter":
-                    bChainParameter = self.maxusb_app.testcase[2]
-                else:
-                    bChainParameter = b'\x00'
+                bMessageType = self.maxusb_app.overrides.get("IccPowerOn_bMessageType", b'\x80') # RDR_to_PC_DataBlock
+                dwLength = self.maxusb_app.overrides.get("IccPowerOn_dwLength", b'\x12\x00\x00\x00') # Message-specific data length
+                bSlot = self.maxusb_app.overrides.get("IccPowerOn_bSlot", b'\x00') # fixed for legacy reasons
+                bStatus = self.maxusb_app.overrides.get("IccPowerOn_bStatus", b'\x00')
+                bError = self.maxusb_app.overrides.get("IccPowerOn_bError", b'\x80')
+                bChainParameter = self.maxusb_app.overrides.get("IccPowerOn_bChainParameter", b'\x00')
                 abData = b'\x3b\x6e\x00\x00\x80\x31\x80\x66\xb0\x84\x12\x01\x6e\x01\x83\x00\x90\x00'
                 response =  bMessageType + \
                             dwLength + \
@@ -320,30 +214,12 @@ class USBSmartcardInterface(USBInterface):
                             abData
 
             else:
-                if self.maxusb_app.testcase[1] == "IccPowerOn_bMessageType":
-                    bMessageType = self.maxusb_app.testcase[2]
-                else:
-                    bMessageType = b'\x80'  # RDR_to_PC_DataBlock
-                if self.maxusb_app.testcase[1] == "IccPowerOn_dwLength":
-                    dwLength = self.maxusb_app.testcase[2]
-                else:
-                    dwLength = b'\x00\x00\x00\x00' # Message-specific data length
-                if self.maxusb_app.testcase[1] == "IccPowerOn_bSlot":
-                    bSlot = self.maxusb_app.testcase[2]
-                else:
-                    bSlot = b'\x00' # fixed for legacy reasons
-                if self.maxusb_app.testcase[1] == "IccPowerOn_bStatus":
-                    bStatus = self.maxusb_app.testcase[2]
-                else:
-                    bStatus = b'\x40'
-                if self.maxusb_app.testcase[1] == "IccPowerOn_bError":
-                    bError = self.maxusb_app.testcase[2]
-                else:
-                    bError = b'\xfe'
-                if self.maxusb_app.testcase[1] == "IccPowerOn_bChainParameter":
-                    bChainParameter = self.maxusb_app.testcase[2]
-                else:
-                    bChainParameter = b'\x00'
+                bMessageType = self.maxusb_app.overrides.get("IccPowerOn_bMessageType", b'\x80') # RDR_to_PC_DataBlock
+                dwLength = self.maxusb_app.overrides.get("IccPowerOn_dwLength", b'\x00\x00\x00\x00') # Message-specific data length
+                bSlot = self.maxusb_app.overrides.get("IccPowerOn_bSlot", b'\x00') # fixed for legacy reasons
+                bStatus = self.maxusb_app.overrides.get("IccPowerOn_bStatus", b'\x40')
+                bError = self.maxusb_app.overrides.get("IccPowerOn_bError", b'\xfe')
+                bChainParameter = self.maxusb_app.overrides.get("IccPowerOn_bChainParameter", b'\x00')
 
                 response =  bMessageType + \
                             dwLength + \
@@ -357,22 +233,10 @@ class USBSmartcardInterface(USBInterface):
 
         elif command == 0x63: # PC_to_RDR_IccPowerOff
 
-            if self.maxusb_app.testcase[1] == "IccPowerOff_bMessageType":
-                bMessageType = self.maxusb_app.testcase[2]
-            else:
-                bMessageType = b'\x81'  # PC_to_RDR_IccPowerOff
-            if self.maxusb_app.testcase[1] == "IccPowerOff_dwLength":
-                dwLength = self.maxusb_app.testcase[2]
-            else:
-                dwLength = b'\x00\x00\x00\x00' # Message-specific data length
-            if self.maxusb_app.testcase[1] == "IccPowerOff_bSlot":
-                bSlot = self.maxusb_app.testcase[2]
-            else:
-                bSlot = b'\x00' # fixed for legacy reasons
-            if self.maxusb_app.testcase[1] == "IccPowerOff_abRFU":
-                abRFU = self.maxusb_app.testcase[2]            
-            else:
-                abRFU = b'\x01' # reserved
+            bMessageType = self.maxusb_app.overrides.get("IccPowerOff_bMessageType", b'\x81') # PC_to_RDR_IccPowerOff
+            dwLength = self.maxusb_app.overrides.get("IccPowerOff_dwLength", b'\x00\x00\x00\x00') # Message-specific data length
+            bSlot = self.maxusb_app.overrides.get("IccPowerOff_bSlot", b'\x00') # fixed for legacy reasons
+            abRFU = self.maxusb_app.overrides.get("IccPowerOff_abRFU", b'\x01') # reserved
 
             response =  bMessageType + \
                         dwLength + \
@@ -425,30 +289,12 @@ class USBSmartcardInterface(USBInterface):
 
         elif command == 0x6f: # PC_to_RDR_XfrBlock message
 
-            if self.maxusb_app.testcase[1] == "XfrBlock_bMessageType":
-                bMessageType = self.maxusb_app.testcase[2]
-            else:
-                bMessageType = b'\x80'  # RDR_to_PC_DataBlock
-            if self.maxusb_app.testcase[1] == "XfrBlock_dwLength":
-                dwLength = self.maxusb_app.testcase[2]
-            else:
-                dwLength = b'\x02\x00\x00\x00' # Message-specific data length
-            if self.maxusb_app.testcase[1] == "XfrBlock_bSlot":
-                bSlot = self.maxusb_app.testcase[2]
-            else:
-                bSlot = b'\x00' # fixed for legacy reasons
-            if self.maxusb_app.testcase[1] == "XfrBlock_bStatus":
-                bStatus = self.maxusb_app.testcase[2]
-            else:
-                bStatus = b'\x00' # reserved
-            if self.maxusb_app.testcase[1] == "XfrBlock_bError":
-                bError = self.maxusb_app.testcase[2]
-            else:
-                bError = b'\x80'
-            if self.maxusb_app.testcase[1] == "XfrBlock_bChainParameter":
-                bChainParameter = self.maxusb_app.testcase[2]
-            else:
-                bChainParameter = b'\x00'
+            bMessageType = self.maxusb_app.overrides.get("XfrBlock_bMessageType", b'\x80') # RDR_to_PC_DataBlock
+            dwLength = self.maxusb_app.overrides.get("XfrBlock_dwLength", b'\x02\x00\x00\x00') # Message-specific data length
+            bSlot = self.maxusb_app.overrides.get("XfrBlock_bSlot", b'\x00') # fixed for legacy reasons
+            bStatus = self.maxusb_app.overrides.get("XfrBlock_bStatus", b'\x00') # reserved
+            bError = self.maxusb_app.overrides.get("XfrBlock_bError", b'\x80')
+            bChainParameter = self.maxusb_app.overrides.get("XfrBlock_bChainParameter", b'\x00')
             abData = b'\x6a\x82' 
 
             response =  bMessageType + \
@@ -462,39 +308,15 @@ class USBSmartcardInterface(USBInterface):
 
         elif command == 0x73: # PC_to_RDR_SetDataRateAndClockFrequency
 
-            if self.maxusb_app.testcase[1] == "SetDataRateAndClockFrequency_bMessageType":
-                bMessageType = self.maxusb_app.testcase[2]
-            else:
-                bMessageType = b'\x84'  # RDR_to_PC_DataRateAndClockFrequency
-            if self.maxusb_app.testcase[1] == "SetDataRateAndClockFrequency_dwLength":
-                dwLength = self.maxusb_app.testcase[2]
-            else:
-                dwLength = b'\x08\x00\x00\x00' # Message-specific data length
-            if self.maxusb_app.testcase[1] == "SetDataRateAndClockFrequency_bSlot":
-                bSlot = self.maxusb_app.testcase[2]
-            else:
-                bSlot = b'\x00' # fixed for legacy reasons
-            if self.maxusb_app.testcase[1] == "SetDataRateAndClockFrequency_bStatus":
-                bStatus = self.maxusb_app.testcase[2]
-            else:
-                bStatus = b'\x00' # reserved
-            if self.maxusb_app.testcase[1] == "SetDataRateAndClockFrequency_bError":
-                bError = self.maxusb_app.testcase[2]
-            else:
-                bError = b'\x80'
-            if self.maxusb_app.testcase[1] == "SetDataRateAndClockFrequency_bRFU":
-                bRFU = self.maxusb_app.testcase[2]
-            else:
-                bRFU = b'\x80'
-            if self.maxusb_app.testcase[1] == "SetDataRateAndClockFrequency_dwClockFrequency":
-                dwClockFrequency = self.maxusb_app.testcase[2]
-            else:
-                dwClockFrequency = b'\xA6\x0E\x00\x00'
+            bMessageType = self.maxusb_app.overrides.get("SetDataRateAndClockFrequency_bMessageType", b'\x84') # RDR_to_PC_DataRateAndClockFrequency
+            dwLength = self.maxusb_app.overrides.get("SetDataRateAndClockFrequency_dwLength", b'\x08\x00\x00\x00') # Message-specific data length
+            bSlot = self.maxusb_app.overrides.get("SetDataRateAndClockFrequency_bSlot", b'\x00') # fixed for legacy reasons
+            bStatus = self.maxusb_app.overrides.get("SetDataRateAndClockFrequency_bStatus", b'\x00') # reserved
+            bError = self.maxusb_app.overrides.get("SetDataRateAndClockFrequency_bError", b'\x80')
+            bRFU = self.maxusb_app.overrides.get("SetDataRateAndClockFrequency_bRFU", b'\x80')
+            dwClockFrequency = self.maxusb_app.overrides.get("SetDataRateAndClockFrequency_dwClockFrequency", b'\xA6\x0E\x00\x00')
 
-            if self.maxusb_app.testcase[1] == "SetDataRateAndClockFrequency_dwDataRate":
-                dwDataRate = self.maxusb_app.testcase[2]
-            else:
-                dwDataRate = b'\x60\x27\x00\x00' 
+            dwDataRate = self.maxusb_app.overrides.get("SetDataRateAndClockFrequency_dwDataRate", b'\x60\x27\x00\x00')
 
             response =  bMessageType + \
                         dwLength + \
@@ -0,0 +1,540 @@
+# fatimage.py
+#
+# Contains the FatDiskImage class: a virtual FAT16/FAT32 block device built
+# on the fly from a host directory or an in-memory file list, for use by
+# USBMassStorageDevice in place of a dd-created image.
+
+from array import array
+import bisect
+import os
+import struct
+import time
+
+class FatNode:
+    """A file or directory on the synthesized volume."""
+
+    def __init__(self, name, is_dir, parent=None, size=0, path=None,
+            data=None, mtime=None):
+        self.name = name
+        self.is_dir = is_dir
+        self.parent = parent
+        self.size = size
+        self.path = path            # host file backing this node, if any
+        self.data = data            # in-memory contents, if any
+        self.mtime = mtime or time.time()
+
+        self.children = [ ]
+        self.short_name = None
+        self.needs_lfn = False
+        self.first_cluster = 0
+        self.cluster_count = 0
+        self.dir_bytes = None       # directory contents, built on first read
+
+    def read(self, offset, n):
+        if self.data is not None:
+            return self.data[offset:offset + n]
+
+        if self.path is None or offset >= self.size:
+            return b''
+
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            return f.read(min(n, self.size - offset))
+
+
+class FatDiskImage:
+    """Read/write block device presenting a FAT volume whose boot sector,
+    FATs, directories and file data are all computed per LBA on demand.
+    Only the directory tree is scanned up front; file data is read from
+    the host when the sectors are requested.  Host writes land in a sparse
+    in-memory overlay and never reach the source files.
+
+    source is a host directory or a list of (path, bytes) tuples, where
+    path may contain "/" to place the file in a subdirectory."""
+
+    min_size = 64 * 1024 * 1024
+    fat32_threshold = 512 * 1024 * 1024
+    fat16_root_entries = 512
+
+    def __init__(self, source, block_size=512, size=None, fat_type=None,
+            label="UMAP"):
+        self.filename = source if isinstance(source, str) else "<memory>"
+        self.block_size = block_size
+        self.label = label.upper().encode("ascii", "replace")[:11].ljust(11)
+        self.volume_id = int(time.time()) & 0xffffffff
+
+        self.root = FatNode("", True)
+        if isinstance(source, str):
+            self.scan_directory(self.root, source)
+        else:
+            for path, data in source:
+                self.add_file(path, bytes(data))
+
+        self.assign_short_names(self.root)
+
+        needed = self.estimate_bytes(self.root)
+        if size is None:
+            size = max(self.min_size, needed + needed // 8)
+        if fat_type is None:
+            fat_type = 32 if size >= self.fat32_threshold else 16
+
+        self.size = size - size % block_size
+        self.layout(fat_type)
+        self.allocate()
+
+        self.delta = { }
+
+    # building the tree
+    #####################################################
+
+    def scan_directory(self, node, path):
+        with os.scandir(path) as it:
+            entries = sorted(it, key=lambda e: e.name)
+
+        for e in entries:
+            st = e.stat()
+            if e.is_dir():
+                child = FatNode(e.name, True, node, mtime=st.st_mtime)
+                node.children.append(child)
+                self.scan_directory(child, e.path)
+            elif e.is_file():
+                if st.st_size >= 1 << 32:
+                    print("FAT image: skipping", e.path, "(4GB or larger)")
+                    continue
+                node.children.append(FatNode(e.name, False, node,
+                        size=st.st_size, path=e.path, mtime=st.st_mtime))
+
+    def add_file(self, path, data):
+        parts = [ p for p in path.replace("\\", "/").split("/") if p ]
+        node = self.root
+
+        for part in parts[:-1]:
+            for child in node.children:
+                if child.is_dir and child.name == part:
+                    node = child
+                    break
+            else:
+                child = FatNode(part, True, node)
+                node.children.append(child)
+                node = child
+
+        node.children.append(FatNode(parts[-1], False, node, size=len(data),
+                data=data))
+
+    # 8.3 and long names
+    #####################################################
+
+    short_name_invalid = set('"*+,/:;<=>?[\\]| .')
+
+    def short_name_part(self, s, n):
+        s = s.upper()
+        return "".join("_" if (c in self.short_name_invalid or ord(c) > 127)
+                else c for c in s)[:n]
+
+    def assign_short_names(self, node):
+        used = set()
+
+        for child in node.children:
+            name = child.name
+            if "." in name[1:]:
+                base, ext = name.rsplit(".", 1)
+            else:
+                base, ext = name, ""
+
+            basis = self.short_name_part(base, 8)
+            ext = self.short_name_part(ext, 3)
+            short = (basis.ljust(8) + ext.ljust(3)).encode("ascii")
+
+            exact = len(base) <= 8 and len(ext) <= 3 and \
+                    (base + ("." + ext if ext else "")) == name.upper() and \
+                    basis == base.upper()
+
+            if not exact or short in used or not basis:
+                n = 1
+                while True:
+                    tail = "~%d" % n
+                    short = ((basis or "_")[:8 - len(tail)] + tail).ljust(8)
+                    short = (short + ext.ljust(3)).encode("ascii")
+                    if short not in used:
+                        break
+                    n += 1
+
+            used.add(short)
+            child.short_name = short
+            child.needs_lfn = not exact or name != name.upper()
+
+            if child.is_dir:
+                self.assign_short_names(child)
+
+    @staticmethod
+    def lfn_checksum(short_name):
+        s = 0
+        for c in short_name:
+            s = (((s & 1) << 7) + (s >> 1) + c) & 0xff
+        return s
+
+    def lfn_entries(self, node):
+        name = node.name.encode("utf-16-le")
+        chars = [ name[i:i + 2] for i in range(0, len(name), 2) ]
+        if len(chars) % 13:
+            chars.append(b'\x00\x00')
+        while len(chars) % 13:
+            chars.append(b'\xff\xff')
+
+        checksum = FatDiskImage.lfn_checksum(node.short_name)
+        count = len(chars) // 13
+        entries = [ ]
+
+        for seq in range(count, 0, -1):
+            part = chars[(seq - 1) * 13:seq * 13]
+            order = seq | (0x40 if seq == count else 0)
+            entries.append(bytes([order]) + b''.join(part[0:5]) +
+                    bytes([0x0f, 0, checksum]) + b''.join(part[5:11]) +
+                    b'\x00\x00' + b''.join(part[11:13]))
+
+        return entries
+
+    def entry_count(self, node):
+        n = 0
+        for child in node.children:
+            n += 1
+            if child.needs_lfn:
+                n += (len(child.name.encode("utf-16-le")) // 2 + 12) // 13
+
+        if node is self.root:
+            n += 1              # volume label
+        else:
+            n += 2              # "." and ".."
+
+        return n
+
+    # geometry
+    #####################################################
+
+    def estimate_bytes(self, node):
+        # generous upper bound with 32K clusters, used to size the volume
+        total = (self.entry_count(node) * 32 + 32767) & ~32767
+        for child in node.children:
+            if child.is_dir:
+                total += self.estimate_bytes(child)
+            else:
+                total += (child.size + 32767) & ~32767
+
+        return total + 1024 * 1024
+
+    def layout(self, fat_type):
+        bps = self.block_size
+        total = self.size // bps
+
+        self.fat_type = fat_type
+        if fat_type == 32:
+            self.reserved_sectors = 32
+            self.root_dir_sectors = 0
+            entry_size = 4
+            spc = 1
+            for limit, n in ((8 << 30, 4096), (16 << 30, 8192),
+                             (32 << 30, 16384), (None, 32768)):
+                if limit is None or self.size <= limit:
+                    spc = max(1, n // bps)
+                    break
+        elif fat_type == 16:
+            self.reserved_sectors = 1
+            self.root_dir_sectors = (self.fat16_root_entries * 32 + bps - 1) // bps
+            entry_size = 2
+            spc = 1
+            while (total // spc) >= 65525 and spc < 128:
+                spc *= 2
+        else:
+            raise ValueError("unsupported FAT type " + str(fat_type))
+
+        # the FAT size depends on the cluster count and vice versa
+        fat_sectors = 1
+        while True:
+            data_sectors = total - self.reserved_sectors - 2 * fat_sectors \
+                         - self.root_dir_sectors
+            clusters = data_sectors // spc
+            needed = ((clusters + 2) * entry_size + bps - 1) // bps
+            if needed <= fat_sectors:
+                break
+            fat_sectors = needed
+
+        if fat_type == 16 and not 4085 <= clusters < 65525:
+            raise ValueError("volume size does not suit FAT16")
+        if fat_type == 32 and clusters < 65525:
+            raise ValueError("volume too small for FAT32")
+
+        self.sectors_per_cluster = spc
+        self.cluster_bytes = spc * bps
+        self.fat_sectors = fat_sectors
+        self.fat_entry_size = entry_size
+        self.cluster_count = clusters
+        self.total_sectors = total
+        self.fat_start = self.reserved_sectors
+        self.root_dir_start = self.fat_start + 2 * fat_sectors
+        self.data_start = self.root_dir_start + self.root_dir_sectors
+
+        if fat_type == 16:
+            self.eoc = 0xffff
+            self.fat_media = (0xfff8, 0xffff)
+        else:
+            self.eoc = 0x0fffffff
+            self.fat_media = (0x0ffffff8, 0x0fffffff)
+
+    def allocate(self):
+        """Give every directory and non-empty file one contiguous run of
+        clusters, so FAT entries can be computed from the run table."""
+
+        self.run_starts = [ ]
+        self.run_nodes = [ ]
+        next_cluster = 2
+
+        if self.fat_type == 16 and \
+                self.entry_count(self.root) > self.fat16_root_entries:
+            raise ValueError("too many files in the FAT16 root directory")
+
+        queue = [ self.root ]
+        while queue:
+            node = queue.pop(0)
+
+            if node.is_dir:
+                queue += node.children
+                if node is self.root and self.fat_type == 16:
+                    continue
+                nbytes = self.entry_count(node) * 32
+            else:
+                nbytes = node.size
+
+            if nbytes == 0:
+                continue
+
+            n = (nbytes + self.cluster_bytes - 1) // self.cluster_bytes
+            if next_cluster + n > self.cluster_count + 2:
+                raise ValueError("files do not fit in the FAT volume")
+
+            node.first_cluster = next_cluster
+            node.cluster_count = n
+            self.run_starts.append(next_cluster)
+            self.run_nodes.append(node)
+            next_cluster += n
+
+        self.next_free_cluster = next_cluster
+
+    # sector synthesis
+    #####################################################
+
+    def boot_sector(self):
+        bps = self.block_size
+        total16 = self.total_sectors if self.total_sectors < 0x10000 else 0
+        total32 = 0 if total16 else self.total_sectors
+
+        b = bytearray(bps)
+        b[0:3] = b'\xeb\x58\x90' if self.fat_type == 32 else b'\xeb\x3c\x90'
+        b[3:11] = b'MSWIN4.1'
+        struct.pack_into('<HBHBHHBHHHII', b, 11, bps, self.sectors_per_cluster,
+                self.reserved_sectors, 2,
+                self.fat16_root_entries if self.fat_type == 16 else 0,
+                total16, 0xf8,
+                self.fat_sectors if self.fat_type == 16 else 0,
+                63, 255, 0, total32)
+
+        if self.fat_type == 32:
+            struct.pack_into('<IHHIHH', b, 36, self.fat_sectors, 0, 0,
+                    self.root.first_cluster, 1, 6)
+            struct.pack_into('<BBBI', b, 64, 0x80, 0, 0x29, self.volume_id)
+            b[71:82] = self.label
+            b[82:90] = b'FAT32   '
+        else:
+            struct.pack_into('<BBBI', b, 36, 0x80, 0, 0x29, self.volume_id)
+            b[43:54] = self.label
+            b[54:62] = b'FAT16   '
+
+        b[510:512] = b'\x55\xaa'
+        return b
+
+    def fsinfo_sector(self):
+        b = bytearray(self.block_size)
+        free = self.cluster_count + 2 - self.next_free_cluster
+        struct.pack_into('<I', b, 0, 0x41615252)
+        struct.pack_into('<IIII', b, 484, 0x61417272, free,
+                self.next_free_cluster, 0)
+        struct.pack_into('<I', b, 508, 0xaa550000)
+        return b
+
+    def fat_sector(self, index):
+        per_sector = self.block_size // self.fat_entry_size
+        first = index * per_sector
+        last = first + per_sector
+
+        entries = array('H' if self.fat_type == 16 else 'I', bytes(self.block_size))
+
+        if first == 0:
+            entries[0], entries[1] = self.fat_media
+
+        i = max(0, bisect.bisect_right(self.run_starts, first) - 1)
+        while i < len(self.run_starts) and self.run_starts[i] < last:
+            start = self.run_starts[i]
+            end = start + self.run_nodes[i].cluster_count    # exclusive
+            for c in range(max(start, first), min(end, last)):
+                entries[c - first] = c + 1 if c + 1 < end else self.eoc
+            i += 1
+
+        return entries.tobytes()
+
+    def dir_entry(self, short_name, attr, cluster, size, mtime):
+        t = time.localtime(mtime)
+        if t.tm_year < 1980:
+            t = time.localtime(315532800)
+        fat_time = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+        fat_date = ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+
+        return short_name + struct.pack('<BBBHHHHHHHI', attr, 0, 0,
+                fat_time, fat_date, fat_date, cluster >> 16,
+                fat_time, fat_date, cluster & 0xffff, size)
+
+    def directory_bytes(self, node):
+        if node.dir_bytes is not None:
+            return node.dir_bytes
+
+        entries = [ ]
+        if node is self.root:
+            entries.append(self.dir_entry(self.label, 0x08, 0, 0, node.mtime))
+        else:
+            parent = node.parent
+            parent_cluster = 0 if parent is self.root else parent.first_cluster
+            entries.append(self.dir_entry(b'.          ', 0x10,
+                    node.first_cluster, 0, node.mtime))
+            entries.append(self.dir_entry(b'..         ', 0x10,
+                    parent_cluster, 0, parent.mtime))
+
+        for child in node.children:
+            if child.needs_lfn:
+                entries += self.lfn_entries(child)
+            entries.append(self.dir_entry(child.short_name,
+                    0x10 if child.is_dir else 0x20, child.first_cluster,
+                    0 if child.is_dir else child.size, child.mtime))
+
+        node.dir_bytes = b''.join(entries)
+        return node.dir_bytes
+
+    def node_read(self, node, offset, n):
+        if node.is_dir:
+            return self.directory_bytes(node)[offset:offset + n]
+
+        return node.read(offset, n)
+
+    def read_sectors(self, lba, count):
+        """Synthesize count sectors from lba; returns exactly count sectors."""
+
+        bps = self.block_size
+        out = bytearray(count * bps)
+        pos = 0
+        end = lba + count
+
+        while lba < end:
+            if lba >= self.data_start:
+                rel = lba - self.data_start
+                cluster = rel // self.sectors_per_cluster + 2
+                i = bisect.bisect_right(self.run_starts, cluster) - 1
+
+                if i >= 0 and cluster < self.run_starts[i] + self.run_nodes[i].cluster_count:
+                    # read straight through the rest of this node's run
+                    node = self.run_nodes[i]
+                    run_end = self.data_start + (self.run_starts[i] - 2 \
+                            + node.cluster_count) * self.sectors_per_cluster
+                    n = min(end, run_end) - lba
+                    offset = (rel - (self.run_starts[i] - 2) \
+                            * self.sectors_per_cluster) * bps
+                    data = self.node_read(node, offset, n * bps)
+                else:
+                    # free space: skip to the next allocated run
+                    n = end - lba
+                    if i + 1 < len(self.run_starts):
+                        next_lba = self.data_start + (self.run_starts[i + 1] - 2) \
+                                * self.sectors_per_cluster
+                        n = max(1, min(n, next_lba - lba))
+                    data = b''
+
+            elif lba >= self.root_dir_start:
+                n = 1
+                offset = (lba - self.root_dir_start) * bps
+                data = self.directory_bytes(self.root)[offset:offset + bps]
+
+            elif lba >= self.fat_start:
+                n = 1
+                data = self.fat_sector((lba - self.fat_start) % self.fat_sectors)
+
+            elif lba == 0 or (self.fat_type == 32 and lba == 6):
+                n = 1
+                data = self.boot_sector()
+
+            elif self.fat_type == 32 and lba in (1, 7):
+                n = 1
+                data = self.fsinfo_sector()
+
+            else:
+                n = 1
+                data = b''
+
+            out[pos:pos + len(data)] = data
+            pos += n * bps
+            lba += n
+
+        return out
+
+    # DiskImage interface
+    #####################################################
+
+    def close(self):
+        self.delta = { }
+
+    def flush(self):
+        pass
+
+    def flush_if_due(self):
+        pass
+
+    # same copy-on-write state handling as OverlayDiskImage
+    def snapshot(self):
+        return dict(self.delta)
+
+    def restore(self, snapshot):
+        self.delta = dict(snapshot)
+
+    def reset(self):
+        self.delta = { }
+
+    def get_sector_count(self):
+        return int(self.size / self.block_size) - 1
+
+    def get_sector_data(self, address):
+        if address in self.delta:
+            return self.delta[address]
+
+        return bytes(self.read_sectors(address, 1))
+
+    def get_sector_range(self, address, count):
+        count = max(0, min(count, self.total_sectors - address))
+        data = self.read_sectors(address, count)
+
+        for block in range(address, address + count):
+            if block in self.delta:
+                start = (block - address) * self.block_size
+                data[start:start + self.block_size] = self.delta[block]
+
+        return memoryview(data)
+
+    def put_sector_data(self, address, data):
+        self.put_sector_range(address, data[:self.block_size])
+
+    def put_sector_range(self, address, data):
+        bps = self.block_size
+        for offset in range(0, len(data), bps):
+            block = address + offset // bps
+            if block >= self.total_sectors:
+                break
+
+            chunk = bytes(data[offset:offset + bps])
+            if len(chunk) < bps:
+                chunk += self.get_sector_data(block)[len(chunk):]
+
+            self.delta[block] = chunk
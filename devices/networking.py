@@ -1,46 +1,308 @@
-from threading import Thread
-from socket import *
-import sys
+# networking.py
+#
+# Contains the network bridge used by -n: endpoint traffic of the emulated
+# device is published to clients connected over TCP or Unix domain
+# sockets, and a responder client answers the data the host sends to the
+# bulk OUT endpoint.
+#
+# Every message on a socket is one frame: a 12-byte header of the payload
+# length and a sequence number (both 32-bit big-endian), the endpoint
+# address the frame belongs to and three reserved bytes, followed by the
+# payload.  Endpoint addresses are the USB ones: 0x00 carries setup
+# packets, 0x01 OUT data and 0x80-0x83 IN data.  Address 0xff is the
+# bridge's own channel, on which a client sends one of:
+#
+#   b'respond'              become the responder
+#   b'release'              stop being the responder
+#   b'observe' + addresses  receive copies of these channels (all if none)
+#
+# The first client to connect is the responder and observes nothing; later
+# clients observe every channel.  A client that takes over as responder
+# likewise stops observing, and the one it replaced observes everything.
+# A responder's reply to an OUT frame is sent on the IN channel and
+# carries the sequence number it answers.
 
-class netserver(Thread):
-    def __init__( self, maxusb_app, port):
-        Thread.__init__( self )
+from threading import Thread, Lock
+from socket import AF_INET, AF_INET6, IPPROTO_TCP, TCP_NODELAY
+import asyncio
+import concurrent.futures
+import os
+import struct
 
-        self.maxusb_app = maxusb_app
-    
-        self.sock = socket( AF_INET, SOCK_STREAM )
-        self.maxusb_app.netserver_to_endpoint_sd = self.sock
+bridge_channel = 0xff
+
+class BridgeClient:
+    def __init__(self, writer, observed):
+        self.writer = writer
+        self.observed = observed        # set of addresses, or None for all
+        self.name = writer.get_extra_info("peername") or "unix socket"
+
+    def observes(self, endpoint):
+        return self.observed is None or endpoint in self.observed
+
+
+class EndpointBridge:
+    """The bridge server.  It runs an asyncio loop on a thread of its own;
+    the device models talk to it from the MAXUSB thread through request()
+    and publish(), which are thread safe.
+
+    request() blocks until the responder has taken the frame (so a slow
+    responder holds the device back) and then until its reply arrives or
+    reply_timeout expires.  publish() never blocks: an observer that falls
+    more than max_backlog bytes behind is disconnected."""
+
+    header = struct.Struct(">IIB3x")
+
+    max_frame = 16 * 1024 * 1024
+    max_backlog = 4 * 1024 * 1024
+    reply_timeout = 10.0
+
+    def __init__(self, reply_timeout=None):
+        if reply_timeout is not None:
+            self.reply_timeout = reply_timeout
+
+        self.lock = Lock()
+        self.sequence = 0
+        self.waiting = { }              # sequence -> concurrent Future
+
+        self.loop = None
+        self.thread = None
+        self.servers = [ ]
+        self.unix_paths = [ ]
+        self.clients = [ ]
+        self.responder = None
+        self.observing = False          # any client observing, read unlocked
+        self.closed = False
+
+    # MAXUSB thread
+    #####################################################
+
+    def start(self, addresses):
+        """Listen on each of addresses: a port, "host:port" or
+        "unix:path".  Returns False if none could be opened."""
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+        for address in addresses:
+            try:
+                asyncio.run_coroutine_threadsafe(self.listen(address),
+                        self.loop).result()
+            except (OSError, ValueError) as e:
+                print ("Error: Could not listen on %s: %s" % (address, e))
+
+        if not self.servers:
+            self.close()
+            return False
+
+        return True
+
+    def next_sequence(self):
+        with self.lock:
+            self.sequence = (self.sequence + 1) & 0xffffffff
+            return self.sequence
+
+    def request(self, endpoint, data, timeout=None):
+        """Relay data from OUT endpoint to the responder and return its
+        reply, or None."""
+
+        if self.closed:
+            return None
+
+        if timeout is None:
+            timeout = self.reply_timeout
+
+        sequence = self.next_sequence()
+        reply = concurrent.futures.Future()
+        with self.lock:
+            self.waiting[sequence] = reply
 
-        self.maxusb_app.netserver_sd = self.sock
         try:
-            self.sock.bind(( '', port ))
-        except:
-            print("Error: Could not bind to local port")
+            sent = asyncio.run_coroutine_threadsafe(
+                    self.send_request(endpoint, sequence, bytes(data)), self.loop)
+            if not sent.result(timeout):
+                print ("Error: No network client connected")
+                return None
+
+            return reply.result(timeout)
+        except concurrent.futures.TimeoutError:
+            print ("Error: No reply from network client")
+        except (concurrent.futures.CancelledError, RuntimeError):
+            pass                        # bridge closed meanwhile
+        finally:
+            with self.lock:
+                del self.waiting[sequence]
+
+        return None
+
+    def publish(self, endpoint, data):
+        """Copy traffic on endpoint to the clients observing it."""
+
+        if not self.observing or self.closed:
             return
 
-        self.sock.listen(5)
-   
-    def run( self ):
+        self.loop.call_soon_threadsafe(self.send_observers, endpoint,
+                self.next_sequence(), bytes(data))
 
-        newsock = 0
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
 
-        while (self.maxusb_app.server_running == True):
+        if self.loop.is_running():
             try:
-                if not newsock:
-                    newsock, address = self.sock.accept()    
+                asyncio.run_coroutine_threadsafe(self.shutdown(),
+                        self.loop).result(5)
+            except concurrent.futures.TimeoutError:
+                pass
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
 
-                self.maxusb_app.netserver_from_endpoint_sd = newsock
+        self.loop.close()
 
-                reply = newsock.recv(16384)
-                if len(reply) > 0:
-                    print ("Socket reply: %s" % reply)
-                    self.maxusb_app.reply_buffer = reply
+        with self.lock:
+            for reply in self.waiting.values():
+                reply.cancel()
+
+        for path in self.unix_paths:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+    # bridge thread
+    #####################################################
+
+    async def listen(self, address):
+        address = str(address)
+
+        if address.startswith("unix:"):
+            path = address[5:]
+            server = await asyncio.start_unix_server(self.serve, path)
+            self.unix_paths.append(path)
+        else:
+            host, _, port = address.rpartition(":")
+            server = await asyncio.start_server(self.serve, host or None,
+                    int(port), reuse_address=True)
+
+        self.servers.append(server)
+        print ("Network bridge listening on %s" % address)
+
+    def frame(self, endpoint, sequence, data):
+        return self.header.pack(len(data), sequence, endpoint) + data
+
+    async def send_request(self, endpoint, sequence, data):
+        client = self.responder
+        if client is None:
+            return False
+
+        client.writer.write(self.frame(endpoint, sequence, data))
+        try:
+            await client.writer.drain()
+        except ConnectionError:
+            self.drop(client)
+            return False
+
+        return True
+
+    def send_observers(self, endpoint, sequence, data):
+        frame = None
+
+        for client in list(self.clients):
+            if not client.observes(endpoint):
+                continue
+
+            transport = client.writer.transport
+            if transport.get_write_buffer_size() > self.max_backlog:
+                print ("Network client %s is too slow, disconnecting" % (client.name,))
+                self.drop(client)
+                continue
+
+            if frame is None:
+                frame = self.frame(endpoint, sequence, data)
+            client.writer.write(frame)
+
+    async def serve(self, reader, writer):
+        sock = writer.get_extra_info("socket")
+        if sock is not None and sock.family in (AF_INET, AF_INET6):
+            sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+
+        if self.responder is None:
+            client = BridgeClient(writer, set())
+            self.responder = client
+        else:
+            client = BridgeClient(writer, None)
+        self.clients.append(client)
+        self.update_observing()
+
+        print ("Network client %s connected%s" % (client.name,
+                " as responder" if client is self.responder else ""))
+
+        try:
+            while True:
+                header = await reader.readexactly(self.header.size)
+                length, sequence, endpoint = self.header.unpack(header)
+                if length > self.max_frame:
+                    print ("Error: Network frame of %d bytes is too large" % length)
+                    break
+
+                data = await reader.readexactly(length)
+
+                if endpoint == bridge_channel:
+                    self.command(client, data)
+                elif client is self.responder:
+                    self.deliver(sequence, data)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.drop(client)
+            print ("Network client %s disconnected" % (client.name,))
+
+    def command(self, client, data):
+        if data == b'respond':
+            previous = self.responder
+            if previous is not None and previous is not client:
+                previous.observed = None
+            self.responder = client
+            client.observed = set()
+            self.update_observing()
+        elif data == b'release':
+            if self.responder is client:
+                self.responder = None
+        elif data.startswith(b'observe'):
+            addresses = data[len(b'observe'):]
+            client.observed = set(addresses) if addresses else None
+            self.update_observing()
+        else:
+            print ("Network client %s sent unknown command %r" % (client.name, data))
+
+    def deliver(self, sequence, data):
+        with self.lock:
+            reply = self.waiting.get(sequence)
+
+        if reply is None or reply.done():
+            print ("Dropping late network reply %d" % sequence)
+            return
 
-            except:
-                print ("Error: Socket Accept")
-                sys.exit()
+        reply.set_result(data)
 
-        self.maxusb_app.netserver_to_endpoint_sd.close()
-        self.maxusb_app.netserver_from_endpoint_sd.close()
+    def drop(self, client):
+        if client in self.clients:
+            self.clients.remove(client)
+            self.update_observing()
+        if self.responder is client:
+            self.responder = None
+        client.writer.close()
 
+    def update_observing(self):
+        self.observing = any(c.observed is None or c.observed
+                for c in self.clients)
 
+    async def shutdown(self):
+        for server in self.servers:
+            server.close()
+        for client in list(self.clients):
+            self.drop(client)
+        for server in self.servers:
+            await server.wait_closed()
@@ -0,0 +1,325 @@
+# ptpstore.py
+#
+# Contains the PTPObjectStore class: host directories exposed to the image
+# device as PTP storages and objects.  Handles and metadata are built the
+# first time a folder, object or thumbnail is asked for and then cached.
+
+import io
+import os
+import shutil
+import struct
+import time
+
+# PTP object format codes by file extension
+object_formats = {
+    ".jpg"  : 0x3801,   # EXIF/JPEG
+    ".jpeg" : 0x3801,
+    ".tif"  : 0x380d,   # TIFF
+    ".tiff" : 0x380d,
+    ".png"  : 0x380b,
+    ".gif"  : 0x3807,
+    ".bmp"  : 0x3804,
+    ".avi"  : 0x300a,
+    ".mpg"  : 0x300b,
+    ".mov"  : 0x300d,
+    ".wav"  : 0x3008,
+    ".mp3"  : 0x3009,
+    ".txt"  : 0x3004,
+    ".htm"  : 0x3005,
+    ".html" : 0x3005,
+    ".mrk"  : 0x3006,   # DPOF
+}
+
+format_undefined = 0x3000
+format_association = 0x3001
+
+def ptp_string(s):
+    """PTP string dataset: character count (including the terminator)
+    followed by UTF-16LE; the empty string is a single zero byte."""
+
+    if not s:
+        return b'\x00'
+
+    data = (s[:254] + "\0").encode("utf-16-le")
+    return bytes([len(data) // 2]) + data
+
+def ptp_date(t):
+    return ptp_string(time.strftime("%Y%m%dT%H%M%S", time.localtime(t)))
+
+def jpeg_info(f):
+    """Scan the JPEG headers in file object f.  Returns (width, height,
+    thumbnail offset, thumbnail length); unknown values are 0."""
+
+    width = height = thumb_offset = thumb_length = 0
+
+    if f.read(2) != b'\xff\xd8':
+        return width, height, thumb_offset, thumb_length
+
+    while True:
+        marker = f.read(4)
+        if len(marker) < 4 or marker[0] != 0xff:
+            break
+
+        kind = marker[1]
+        length = marker[2] << 8 | marker[3]
+        start = f.tell()
+
+        if kind == 0xe1 and not thumb_length:
+            thumb_offset, thumb_length = exif_thumbnail(f.read(length - 2), start)
+        elif 0xc0 <= kind <= 0xcf and kind not in (0xc4, 0xc8, 0xcc):
+            sof = f.read(5)
+            if len(sof) == 5:
+                height = sof[1] << 8 | sof[2]
+                width = sof[3] << 8 | sof[4]
+            break
+        elif kind == 0xda:      # start of scan without a frame header
+            break
+
+        f.seek(start + length - 2)
+
+    return width, height, thumb_offset, thumb_length
+
+def exif_thumbnail(app1, base):
+    """(file offset, length) of the JPEG thumbnail in an EXIF APP1 segment
+    that starts at file offset base, or (0, 0)."""
+
+    if app1[:6] != b'Exif\x00\x00' or len(app1) < 14:
+        return 0, 0
+
+    tiff = app1[6:]
+    endian = '<' if tiff[:2] == b'II' else '>'
+
+    def ifd(offset):
+        if offset + 2 > len(tiff):
+            return { }, 0
+        count, = struct.unpack_from(endian + 'H', tiff, offset)
+        end = offset + 2 + count * 12
+        if end + 4 > len(tiff):
+            return { }, 0
+        tags = { }
+        for i in range(count):
+            tag, kind, n, value = struct.unpack_from(endian + 'HHII', tiff, offset + 2 + i * 12)
+            tags[tag] = value
+        return tags, struct.unpack_from(endian + 'I', tiff, end)[0]
+
+    ifd0, next_ifd = ifd(struct.unpack_from(endian + 'I', tiff, 4)[0])
+    if not next_ifd:
+        return 0, 0
+
+    ifd1, _ = ifd(next_ifd)
+    offset = ifd1.get(0x0201, 0)
+    length = ifd1.get(0x0202, 0)
+    if not length or offset + length > len(tiff):
+        return 0, 0
+
+    return base + 6 + offset, length
+
+
+class PTPObject:
+    """One file or folder in a storage.  The JPEG details are filled in by
+    PTPObjectStore.object_details() when first needed."""
+
+    def __init__(self, handle, storage, parent, path, name, is_dir, size, mtime):
+        self.handle = handle
+        self.storage = storage
+        self.parent = parent            # handle, 0 at the storage root
+        self.path = path
+        self.name = name
+        self.is_dir = is_dir
+        self.size = size
+        self.mtime = mtime
+
+        if is_dir:
+            self.format = format_association
+        else:
+            ext = os.path.splitext(name)[1].lower()
+            self.format = object_formats.get(ext, format_undefined)
+
+        self.children = None            # handles, once the folder is listed
+        self.details = None             # see PTPObjectStore.object_details()
+
+
+class PTPStorage:
+    def __init__(self, storage_id, path):
+        self.storage_id = storage_id
+        self.path = path
+        self.description = os.path.basename(os.path.normpath(path))
+        self.children = None            # handles of the top-level objects
+
+
+class PTPObjectStore:
+    """Directories exposed as PTP storages, one storage per directory.
+
+    Nothing is scanned up front: a folder is listed the first time its
+    children (or a flat listing of its storage) are requested, and JPEG
+    dimensions and EXIF thumbnails are read the first time an object's
+    info or thumbnail is requested.  Handles stay valid for the lifetime
+    of the store."""
+
+    thumbnail_cache_size = 64
+
+    def __init__(self, paths):
+        if isinstance(paths, str):
+            paths = [ paths ]
+
+        self.storages = { }
+        for i, path in enumerate(paths):
+            storage_id = (i + 1) << 16 | 0x0001     # physical n, logical 1
+            self.storages[storage_id] = PTPStorage(storage_id, path)
+
+        self.objects = { }
+        self.next_handle = 1
+        self.thumbnails = { }
+
+    def storage_ids(self):
+        return sorted(self.storages)
+
+    def get_storage(self, storage_id):
+        return self.storages.get(storage_id)
+
+    def storage_usage(self, storage):
+        """(total, free) bytes of the filesystem holding storage."""
+
+        try:
+            usage = shutil.disk_usage(storage.path)
+        except OSError:
+            return 0, 0
+
+        return usage.total, usage.free
+
+    def get_object(self, handle):
+        return self.objects.get(handle)
+
+    # listing
+    #####################################################
+
+    def list_directory(self, storage, parent, path):
+        handles = [ ]
+
+        try:
+            with os.scandir(path) as it:
+                entries = sorted(it, key=lambda e: e.name)
+        except OSError:
+            return handles
+
+        for e in entries:
+            try:
+                is_dir = e.is_dir()
+                if not is_dir and not e.is_file():
+                    continue
+                st = e.stat()
+            except OSError:
+                continue
+
+            obj = PTPObject(self.next_handle, storage.storage_id, parent,
+                    e.path, e.name, is_dir, 0 if is_dir else st.st_size,
+                    st.st_mtime)
+            self.objects[obj.handle] = obj
+            handles.append(obj.handle)
+            self.next_handle += 1
+
+        return handles
+
+    def children(self, storage, parent):
+        """Handles directly under parent (0 for the storage root)."""
+
+        if parent == 0:
+            if storage.children is None:
+                storage.children = self.list_directory(storage, 0, storage.path)
+            return storage.children
+
+        obj = self.objects.get(parent)
+        if obj is None or not obj.is_dir or obj.storage != storage.storage_id:
+            return [ ]
+
+        if obj.children is None:
+            obj.children = self.list_directory(storage, parent, obj.path)
+        return obj.children
+
+    def walk(self, storage):
+        handles = [ ]
+        pending = [ 0 ]
+
+        while pending:
+            for handle in self.children(storage, pending.pop()):
+                handles.append(handle)
+                if self.objects[handle].is_dir:
+                    pending.append(handle)
+
+        return handles
+
+    def object_handles(self, storage_id=0xffffffff, object_format=0, parent=0):
+        """GetObjectHandles: storage_id 0xffffffff means every storage,
+        parent 0 a flat listing and 0xffffffff the root folder only."""
+
+        if storage_id == 0xffffffff:
+            storages = [ self.storages[s] for s in self.storage_ids() ]
+        elif storage_id in self.storages:
+            storages = [ self.storages[storage_id] ]
+        else:
+            return [ ]
+
+        handles = [ ]
+        for storage in storages:
+            if parent == 0:
+                handles += self.walk(storage)
+            else:
+                handles += self.children(storage, 0 if parent == 0xffffffff else parent)
+
+        if object_format:
+            handles = [ h for h in handles if self.objects[h].format == object_format ]
+
+        return handles
+
+    # object data
+    #####################################################
+
+    def object_details(self, obj):
+        """(width, height, thumbnail length, thumbnail width, thumbnail
+        height) of a JPEG object; zeros for anything else."""
+
+        if obj.details is None:
+            obj.details = (0, 0, 0, 0, 0)
+            if obj.format == 0x3801:
+                try:
+                    with open(obj.path, 'rb') as f:
+                        width, height, offset, length = jpeg_info(f)
+                        thumb = None
+                        if length:
+                            f.seek(offset)
+                            thumb = f.read(length)
+                except (OSError, struct.error):
+                    return obj.details
+
+                thumb_width = thumb_height = 0
+                if thumb:
+                    thumb_width, thumb_height, _, _ = jpeg_info(io.BytesIO(thumb))
+                if not thumb_width:
+                    thumb = None
+                    length = 0
+
+                obj.details = (width, height, length, thumb_width, thumb_height)
+                if thumb:
+                    self.cache_thumbnail(obj, thumb)
+
+        return obj.details
+
+    def cache_thumbnail(self, obj, data):
+        if len(self.thumbnails) >= self.thumbnail_cache_size:
+            del self.thumbnails[next(iter(self.thumbnails))]
+        self.thumbnails[obj.handle] = data
+
+    def get_thumbnail(self, obj):
+        """The embedded EXIF thumbnail of obj, or None.  The most recently
+        read thumbnail_cache_size thumbnails are kept in memory."""
+
+        data = self.thumbnails.pop(obj.handle, None)
+        if data is None:
+            obj.details = None      # rescan, which reads the thumbnail again
+            if not self.object_details(obj)[2]:
+                return None
+            data = self.thumbnails.pop(obj.handle)
+
+        # most recently used last
+        self.thumbnails[obj.handle] = data
+        return data
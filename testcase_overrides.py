@@ -0,0 +1,203 @@
+# testcase_overrides.py
+#
+# Contains the field registry and the TestcaseOverrides class that turns a
+# [name, field, value] testcase into a lookup table for descriptor builders.
+
+# Fields each descriptor/response builder lets a testcase override, keyed by
+# builder name.
+override_fields = {
+    "device": (
+        "string_Manufacturer", "string_Product", "string_Serial",
+        "dev_bLength", "dev_bDescriptorType", "dev_bMaxPacketSize0",
+    ),
+    "configuration": (
+        "conf_bLength", "conf_bDescriptorType", "conf_wTotalLength",
+        "conf_bNumInterfaces",
+    ),
+    "interface": (
+        "int_bLength", "int_bDescriptorType", "int_bNumEndpoints",
+    ),
+    "endpoint": (
+        "end_bLength", "end_bDescriptorType", "end_bEndpointAddress",
+        "end_wMaxPacketSize",
+    ),
+    "hub": (
+        "hub_bLength", "hub_bDescriptorType", "hub_bNbrPorts",
+        "hub_wHubCharacteristics", "hub_bPwrOn2PwrGood",
+        "hub_bHubContrCurrent", "hub_DeviceRemovable",
+        "hub_PortPwrCtrlMask",
+    ),
+    "audio": (
+        "CSInterface1_wTotalLength", "CSInterface1_bInCollection",
+        "CSInterface1_baInterfaceNr1", "CSInterface1_baInterfaceNr2",
+        "CSInterface2_bTerminalID", "CSInterface2_wTerminalType",
+        "CSInterface2_bAssocTerminal", "CSInterface2_bNrChannel",
+        "CSInterface2_wChannelConfig", "CSInterface4_bSourceID",
+        "CSInterface6_bUnitID", "CSInterface6_bSourceID",
+        "CSInterface6_bControlSize", "CSInterface6_bmaControls0",
+        "CSInterface6_bmaControls1", "CSInterface6_bmaControls2",
+    ),
+    "image": (
+        "DeviceInfo_TransactionID", "StorageIDArray_TransactionID",
+        "StorageInfo_TransactionID", "ObjectHandles_TransactionID",
+        "ObjectInfo_TransactionID", "ThumbData_TransactionID",
+        "PartialData_TransactionID", "ThumbData_ContainerType",
+        "ThumbData_OperationCode", "ThumbData_ContainerLength",
+        "PartialObject_ContainerType", "PartialObject_OperationCode",
+        "PartialObject_ContainerLength",
+        "DeviceInfo_ContainerType", "DeviceInfo_OperationCode",
+        "DeviceInfo_StandardVersion", "DeviceInfo_VendorExtensionID",
+        "DeviceInfo_VendorExtensionVersion",
+        "DeviceInfo_VendorExtensionDesc", "DeviceInfo_FunctionalMode",
+        "DeviceInfo_OperationsSupportedArraySize",
+        "DeviceInfo_OperationSupported",
+        "DeviceInfo_EventsSupportedArraySize",
+        "DeviceInfo_EventSupported",
+        "DeviceInfo_DevicePropertiesSupportedArraySize",
+        "DeviceInfo_DevicePropertySupported",
+        "DeviceInfo_CaptureFormatsSupportedArraySize",
+        "DeviceInfo_ImageFormatsSupportedArraySize",
+        "DeviceInfo_ImageFormatSupported", "DeviceInfo_Manufacturer",
+        "DeviceInfo_Model", "DeviceInfo_DeviceVersion",
+        "DeviceInfo_SerialNumber", "DeviceInfo_ContainerLength",
+        "StorageIDArray_ContainerType",
+        "StorageIDArray_OperationCode",
+        "StorageIDArray_StorageIDsArraySize",
+        "StorageIDArray_StorageID", "StorageIDArray_ContainerLength",
+        "ObjectHandles_ContainerType", "ObjectHandles_OperationCode",
+        "ObjectHandles_ObjectHandleArraySize",
+        "ObjectHandles_ObjectHandle", "ObjectHandles_ContainerLength",
+        "ObjectInfo_ContainerType", "ObjectInfo_OperationCode",
+        "ObjectInfo_StorageID", "ObjectInfo_ObjectFormat",
+        "ObjectInfo_ProtectionStatus",
+        "ObjectInfo_ObjectCompressedSize", "ObjectInfo_ThumbFormat",
+        "ObjectInfo_ThumbCompressedSize",
+        "ObjectInfo_ThumbPixelWidth", "ObjectInfo_ThumbPixelHeight",
+        "ObjectInfo_ImagePixelWidth", "ObjectInfo_ImagePixelHeight",
+        "ObjectInfo_ImagePixelDepth", "ObjectInfo_ParentObject",
+        "ObjectInfo_AssociationType", "ObjectInfo_AssociationDesc",
+        "ObjectInfo_SequenceNumber", "ObjectInfo_Filename",
+        "ObjectInfo_CaptureDate", "ObjectInfo_ModificationDate",
+        "ObjectInfo_Keywords", "ObjectInfo_ContainerLength",
+        "StorageInfo_ContainerType", "StorageInfo_OperationCode",
+        "StorageInfo_StorageType", "StorageInfo_FilesystemType",
+        "StorageInfo_AccessCapability", "StorageInfo_MaxCapacity",
+        "StorageInfo_FreeSpaceInBytes",
+        "StorageInfo_FreeSpaceInImages",
+        "StorageInfo_StorageDescription", "StorageInfo_VolumeLabel",
+        "StorageInfo_ContainerLength",
+    ),
+    "keyboard": (
+        "Report_Usage_Page", "Report_Usage_Keyboard",
+        "Report_Usage_Page_Keyboard", "Report_Usage_Minimum1",
+        "Report_Usage_Maximum1", "Report_Logical_Minimum1",
+        "Report_Logical_Maximum1", "Report_Report_Size1",
+        "Report_Report_Count1",
+        "Report_Input_Data_Variable_Absolute_Bitfield",
+        "Report_Report_Count2", "Report_Report_Size2",
+        "Report_Input_Constant_Array_Absolute_Bitfield",
+        "Report_Usage_Minimum2", "Report_Usage_Maximum2",
+        "Report_Logical_Minimum2", "Report_Logical_Maximum2",
+        "Report_Report_Size3", "Report_Report_Count3",
+        "Report_Input_Data_Array_Absolute_Bitfield",
+        "Report_End_Collection", "HID_bDescriptorType",
+        "HID_bCountryCode", "HID_bNumDescriptors",
+        "HID_bDescriptorType2", "HID_wDescriptorLength",
+        "HID_bLength",
+    ),
+    "mass_storage": (
+        "inquiry_peripheral", "inquiry_RMB", "inquiry_version",
+        "response_data_format", "config1", "config2", "config3",
+        "vendor_id", "product_id", "product_revision_level",
+        "mode_sense_medium_type", "mode_sense_device_specific_param",
+        "mode_sense_block_descriptor_len", "mode_sense_length",
+        "read_format_capacity_capacity_list_length",
+        "read_format_capacity_number_of_blocks",
+        "read_format_capacity_descriptor_type",
+        "read_format_capacity_block_length",
+        "read_capacity_logical_block_address", "read_capacity_length",
+    ),
+    "printer": (
+        "Device_ID_Key1", "Device_ID_Value1", "Device_ID_Key2",
+        "Device_ID_Value2", "Device_ID_Key3", "Device_ID_Value3",
+        "Device_ID_Key4", "Device_ID_Value4", "Device_ID_Key5",
+        "Device_ID_Value5", "Device_ID_Key6", "Device_ID_Value6",
+        "Device_ID_Key7", "Device_ID_Value7",
+    ),
+    "smartcard": (
+        "icc_bLength", "icc_bDescriptorType", "icc_bMaxSlotIndex",
+        "icc_bVoltageSupport", "icc_dwProtocols",
+        "icc_dwDefaultClock", "icc_dwMaximumClock",
+        "icc_bNumClockSupported", "icc_dwDataRate",
+        "icc_dwMaxDataRate", "icc_bNumDataRatesSupported",
+        "icc_dwMaxIFSD", "icc_dwSynchProtocols", "icc_dwMechanical",
+        "icc_dwFeatures", "icc_dwMaxCCIDMessageLength",
+        "icc_bClassGetResponse", "icc_bClassEnvelope",
+        "icc_wLcdLayout", "icc_bPinSupport", "icc_bMaxCCIDBusySlots",
+        "SetParameters_bMessageType", "SetParameters_dwLength",
+        "SetParameters_bSlot", "SetParameters_bStatus",
+        "SetParameters_bError", "SetParameters_bProtocolNum",
+        "IccPowerOn_bMessageType", "IccPowerOn_dwLength",
+        "IccPowerOn_bSlot", "IccPowerOn_bStatus", "IccPowerOn_bError",
+        "IccPowerOn_bChainParameter", "IccPowerOff_bMessageType",
+        "IccPowerOff_dwLength", "IccPowerOff_bSlot",
+        "IccPowerOff_abRFU", "XfrBlock_bMessageType",
+        "XfrBlock_dwLength", "XfrBlock_bSlot", "XfrBlock_bStatus",
+        "XfrBlock_bError", "XfrBlock_bChainParameter",
+        "SetDataRateAndClockFrequency_bMessageType",
+        "SetDataRateAndClockFrequency_dwLength",
+        "SetDataRateAndClockFrequency_bSlot",
+        "SetDataRateAndClockFrequency_bStatus",
+        "SetDataRateAndClockFrequency_bError",
+        "SetDataRateAndClockFrequency_bRFU",
+        "SetDataRateAndClockFrequency_dwClockFrequency",
+        "SetDataRateAndClockFrequency_dwDataRate",
+    ),
+}
+
+# reverse map: field -> builder that exposes it
+field_builders = { }
+for builder, fields in override_fields.items():
+    for field in fields:
+        field_builders.setdefault(field, builder)
+
+
+class TestcaseOverrides:
+    """Testcase compiled once into a field -> value table, so builders do a
+    single dictionary lookup per field instead of comparing testcase[1]."""
+
+    def __init__(self, testcase=None):
+        self.name = None
+        self.values = { }
+
+        if testcase:
+            self.name = testcase[0]
+            if testcase[1]:
+                self.values[testcase[1]] = testcase[2]
+
+        self.builders = set(field_builders.get(f) for f in self.values) - { None }
+
+    def get(self, field, default=None, convert=None):
+        """Return the override for field, passed through convert, or default
+        unchanged when the testcase does not touch field."""
+
+        if field not in self.values:
+            return default
+        if convert:
+            return convert(self.values[field])
+        return self.values[field]
+
+    def affects(self, builder):
+        return builder in self.builders
+
+    def __contains__(self, field):
+        return field in self.values
+
+    def __getitem__(self, field):
+        return self.values[field]
+
+    def __bool__(self):
+        return len(self.values) > 0
+
+    def __repr__(self):
+        return "TestcaseOverrides(%r, %r)" % (self.name, self.values)
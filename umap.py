@@ -2,100 +2,78 @@
 #
 # umap.py
 #
-from serial import Serial, PARITY_NONE
 import time
 from Facedancer import *
 from MAXUSBApp import *
+from MAXUSBSim import *
+from USBIPApp import USBIPSession
+from campaign import run_campaign, EnumerationPacer, CampaignState
 from devices.networking import *
-from devices.USBMassStorage import *
-from devices.USBHub import *
-from devices.USBIphone import *
-from devices.USBAudio import *
-from devices.USBKeyboard import *
-from devices.USBPrinter import *
-from devices.USBImage import *
-from devices.USBCDC import *
-from devices.USBVendorSpecific import *
-from devices.USBSmartcard import *
+from device_registry import *
+from usbids import USBIdsIndex
 from optparse import OptionParser
 from optparse import OptionGroup
-from collections import namedtuple, defaultdict
-import codecs
 import urllib.request
-from testcases import *
-from device_class_data import *
 import sys
 import platform
 import json
+import os
 
 
-current_version = "1.03"
+current_version = "1.04"
 current_platform = platform.system()
 
-print ("\n---------------------------------------")
-print (" _   _ _ __ ___   __ _ _ __")   
-print ("| | | | '_ ` _ \ / _` | '_ \\")  
-print ("| |_| | | | | | | (_| | |_) |") 
-print (" \__,_|_| |_| |_|\__,_| .__/")  
-print ("                      |_|  ")
-print ("\nThe USB host assessment tool")
-print ("Andy Davis, NCC Group 2013")
-print ("Version:", current_version)
-print ("\nBased on Facedancer by Travis Goodspeed\n")
-print ("For help type: umap.py -h")
-print ("---------------------------------------\n")
-
-
-parser = OptionParser(usage="%prog ", version=current_version)
-group = OptionGroup(parser, "Experimental Options")
-
-parser.add_option("-P", dest="serial", help="Facedancer serial port **Mandatory option** (SERIAL=/dev/ttyX or just 1 for COM1)")
-parser.add_option("-L", action="store_true", dest="listclasses", default=False, help="List device classes supported by umap")
-parser.add_option("-i", action="store_true", dest="identify", default=False, help="identify all supported device classes on connected host")
-parser.add_option("-c", dest="cls", help="identify if a specific class on the connected host is supported (CLS=class:subclass:proto)")
-parser.add_option("-O", action="store_true", dest="osid", default=False, help="Operating system identification")
-parser.add_option("-e", dest="device", help="emulate a specific device (DEVICE=class:subclass:proto)")
-parser.add_option("-n", action="store_true", dest="netsocket", default=False, help="Start network server connected to the bulk endpoints (TCP port 2001)")
-parser.add_option("-v", dest="vid", help="specify Vendor ID (hex format e.g. 1a2b)")
-parser.add_option("-p", dest="pid", help="specify Product ID (hex format e.g. 1a2b)")
-parser.add_option("-r", dest="rev", help="specify product Revision (hex format e.g. 1a2b)")
-parser.add_option("-f", dest="fuzzc", help="fuzz a specific class (FUZZC=class:subclass:proto:E/C/A[:start fuzzcase])")
-parser.add_option("-s", dest="fuzzs", help="send a single fuzz testcase (FUZZS=class:subclass:proto:E/C:Testcase)")
-parser.add_option("-d", dest="dly", help="delay between enumeration attempts (seconds): Default=1")
-parser.add_option("-l", dest="log", help="log to a file")
-parser.add_option("-R", dest="ref", help="Reference the VID/PID database (REF=VID:PID)")
-parser.add_option("-u", action="store_true", dest="updatedb", default=False, help="update the VID/PID database (Internet connectivity required)")
-
-group.add_option("-A", dest="apple", help="emulate an Apple iPhone device (APPLE=VID:PID:REV)")
-group.add_option("-b", dest="vendor", help="brute-force vendor driver support (VENDOR=VID:PID)")
-
-parser.add_option_group(group)
-
-(options, args) = parser.parse_args()
-
 device_vid = 0x1111
 device_pid = 0x2222
 device_rev = 0x3333
 network_socket = False
+campaign_state = None       # CampaignState of a -f campaign
+options = None
+fplog = None
+serial_ports = []
+serial0 = None
+usbip = False
+pacer = EnumerationPacer()
+
+# the board is opened on first use, then reset and the MAXUSB app enabled
+# once; every emulated device after that only costs a soft disconnect/connect
+session = None
 
-if not options.serial:
-    print ("Error: Facedancer serial port not supplied\n")
-    sys.exit()
-else:
-    tmp_serial = options.serial
+def list_classes (devices_list):
+    from device_class_data import device_class_list, device_subclass_list, device_protocol_list
 
-    if current_platform == "Windows":
-        try:
-            serial0 = int(tmp_serial)-1
-        except:
-            print ("Error: Invalid serial port specification")
-            sys.exit()
+    x = 0
+    while x < len(devices_list):
+        print ("%02x:%02x:%02x - " % (devices_list[x][0], devices_list[x][1], devices_list[x][2]), end="")
+
+        class_name = 0
+        while class_name < len (device_class_list):
+            if (devices_list[x][0] == device_class_list[class_name][1]):
+                print (device_class_list[class_name][0],": ",end="")
+            class_name += 1
+
+        subclass_name = 0
+        while subclass_name < len (device_subclass_list):
+            if (devices_list[x][0] == device_subclass_list[subclass_name][0]) and (devices_list[x][1] == device_subclass_list[subclass_name][2]):
+                print (device_subclass_list[subclass_name][1],": ",end="")
+            subclass_name += 1
+
+        protocol_name = 0
+        while protocol_name < len (device_protocol_list):
+            if (devices_list[x][0] == device_protocol_list[protocol_name][0]) and (devices_list[x][2] == device_protocol_list[protocol_name][2]):
+                print (device_protocol_list[protocol_name][1])
+            protocol_name += 1
+
+        x+=1
 
-    else:
-        serial0 = tmp_serial
 
 def connectserial():
 
+    if serial0 == "sim":
+        return SimulatedSerialPort()
+
+    from serial import Serial, PARITY_NONE
+
     try:
         sp = Serial(serial0, 115200, parity=PARITY_NONE, timeout=2)
         return sp
@@ -103,444 +81,124 @@ def connectserial():
         print ("\nError: Check serial port is connected to Facedancer board\n")
         sys.exit(0)
 
-sp = connectserial()
-
-if options.log:
-    logfilepath = options.log
-    fplog = open(logfilepath, mode='a')
-    fplog.write ("---------------------------------------\n")
-    fplog.write ("umap - the USB host assessment tool\n")
-    fplog.write ("Andy Davis, NCC Group 2013\n")
-    write_string = "Version:" + current_version + "\n"
-    fplog.write (write_string)
-    fplog.write ("\nBased on Facedancer by Travis Goodspeed\n")
-    fplog.write ("---------------------------------------\n")
 
-if options.netsocket:
-    network_socket = True
+def get_session():
+    global session
 
-if options.updatedb:
-    print ("Downloading latest VID/PID database...")
-    try:
-        urllib.request.urlretrieve("http://www.linux-usb.org/usb.ids", "usb.ids")
-        print ("Finished")
-    except:
-        print ("Error: Unable to contact server")
-
-
-if options.vid:
-    try:
-        device_vid = int(options.vid,16)
-        if device_vid > 65535:
-            print ("Error: Invalid VID")
-        else:
-            print_output = "VID = %04x" % device_vid
-            print (print_output)
-            if options.log:
-                fplog.write (print_output + "\n")
-    except:
-        print ("Error: Invalid VID")
-
-if options.pid:
-    try:
-        device_pid = int(options.pid,16)
-        if device_pid > 65535:
-            print ("Error: Invalid PID")
+    if session is None and usbip:
+        host, _, port = serial0[len("usbip:"):].rpartition(":")
+        address = (host or "127.0.0.1", int(port or 3240))
+        if options.log:
+            session = USBIPSession(address, fplog)
         else:
-            print_output = "PID = %04x" % device_pid
-            print (print_output)
-            if options.log:
-                fplog.write (print_output + "\n")
-    except:
-        print ("Error: Invalid PID")
+            session = USBIPSession(address)
 
-if options.rev:
-    try:
-        device_rev = int(options.rev,16)
-        if device_rev > 65535:
-            print ("Error: Invalid REV")
+    if session is None:
+        sp = connectserial()
+        if options.log:
+            session = MAXUSBSession(sp, fplog)
         else:
-            print_output = "REV = %04x" % device_rev
-            print (print_output)
-            if options.log:
-                fplog.write (print_output + "\n")
-    except:
-        print ("Error: Invalid REV")
-
-if options.ref:
-    vidpid = options.ref.split(':')
-    if len(vidpid) != 2:
-        print ("Error: VID/PID invalid")
-    else:
-        lookup_vid = vidpid[0]
-        lookup_pid = vidpid[1]
-
-        print ("Looking up VID=",lookup_vid, "/ PID=", lookup_pid)
+            session = MAXUSBSession(sp)
 
-        Vendor = namedtuple("Vendor", ['name', 'devices'])
-        vendors = dict()
-
-        with codecs.open("usb.ids", "r", "latin-1") as f:
-            for line in f:
-                if not line.strip():
-                    continue
-                line = line.rstrip()
-                if line.startswith("#"):
-                    continue
-                if line.startswith("# List of known device classes, subclasses and protocols"): 
-                    break
-                if not line.startswith("\t"):
-                    current_vendor, name = line.split(None, 1)
-                    vendors[current_vendor] = Vendor(name=name, devices=dict())
-                if line.startswith("\t"):
-                    device_id, desc = line.lstrip().split(None, 1)
-                    vendors[current_vendor].devices[device_id] = desc
-        try:       
-            print(vendors[lookup_vid].name, end=" ") 
-        except:
-            print ("\nVID could not be located")
-        try:
-            print(vendors[lookup_vid].devices[lookup_pid])
-        except:
-            print ("\nPID could not be located\n")
-
-if options.dly:
-    enumeration_delay = options.dly
-
-    try:
-        print ("Enumeration delay set to:", int(enumeration_delay))
-        if options.log:
-            write_string = "Enumeration delay set to:" + int( enumeration_delay) + "\n"
-            fplog.write (write_string)
+    return session
 
-    except ValueError:
-        print("Error: Enumeration delay is not an integer")
-    
-else:
-    enumeration_delay = 1     
 
 def optionerror():
     print ("Error: Invalid option\n")
     return
 
 
-def execute_fuzz_testcase (device_class, device_subclass, device_proto, current_testcase, serialnum):
-    
-#    sp = connectserial()
-    mode = 3
-
-    if device_class == 8:
-        mode = 4    # Hack to get the Mass storage device to stop for each fuzz case
-
-    fd = Facedancer(sp, verbose=0)
-    logfp = 0
-    if options.log:
-        logfp = fplog
-    u = MAXUSBApp(fd, logfp, mode, current_testcase, verbose=0)
-    if device_class == 1:
-        d = USBAudioDevice(u, device_vid, device_pid, device_rev, verbose=0)
-    elif device_class == 2:
-        d = USBCDCDevice(u, device_vid, device_pid, device_rev, verbose=0)
-    elif device_class == 3:
-        d = USBKeyboardDevice(u, device_vid, device_pid, device_rev, verbose=0)
-    elif device_class == 6:
-        d = USBImageDevice(u, device_vid, device_pid, device_rev, device_class, device_subclass, device_proto, "ncc_group_logo.jpg", verbose=0)
-    elif device_class == 7:
-        d = USBPrinterDevice(u, device_vid, device_pid, device_rev, device_class, device_subclass, device_proto, verbose=0)
-    elif device_class == 8:
-        try:
-            d = USBMassStorageDevice(u, device_vid, device_pid, device_rev, device_class, device_subclass, device_proto, "stick.img", verbose=0)
-        except:
-            print ("Error: stick.img not found - please create a disk image using dd")
-
-    elif device_class == 9:
-        d = USBHubDevice(u, device_vid, device_pid, device_rev, verbose=0)
-    elif device_class == 10:
-        d = USBCDCDevice(u, device_vid, device_pid, device_rev, verbose=0)
-    elif device_class == 11:
-        d = USBSmartcardDevice(u, device_vid, device_pid, device_rev, verbose=0)
-    elif device_class == 14:
-        d = USBImageDevice(u, device_vid, device_pid, device_rev, 0xe, 1, 0, "ncc_group_logo.jpg", verbose=0)   #HACK
-
-    try:
-        d.connect()
-    except:
-        pass
-    try:
-        d.run()
-    except KeyboardInterrupt:
-        d.disconnect()
-        if options.log:
-            fplog.close()
-
-    time.sleep(int(enumeration_delay))
-
-
-def connect_as_image (vid, pid, rev, mode):
-    if mode == 1:
-        ver1 = 0
-        ver2 = 0
-    else:
-        ver1 = 1
-        ver2 = 4
-#    sp = connectserial()
-    fake_testcase = ["dummy","",0]
-    fd = Facedancer(sp, verbose=ver1)
-    logfp = 0
-    if options.log:
-        logfp = fplog
-    u = MAXUSBApp(fd, logfp, mode, fake_testcase, verbose=ver1)
-
-    if network_socket == True:
-        netserver(u, 2001).start()
-        u.server_running = True
-        input("Network socket listening on TCP port 2001 - Press Enter to continue with device emulation...")
-
-    d = USBImageDevice(u, vid, pid, rev, 6, 1, 1, "ncc_group_logo.jpg", verbose=ver2)
-    d.connect()
-    try:
-        d.run()
-    except KeyboardInterrupt:
-        d.disconnect()
-        if options.log:
-            fplog.close()
-
-
-def connect_as_cdc (vid, pid, rev, mode):
-    if mode == 1:
-        ver1 = 0
-        ver2 = 0
-    else:
-        ver1 = 1
-        ver2 = 4
-#    sp = connectserial()
-    fake_testcase = ["dummy","",0]
-    fd = Facedancer(sp, verbose=ver1)
-    logfp = 0
-    if options.log:
-        logfp = fplog
-    u = MAXUSBApp(fd, logfp, mode, fake_testcase, verbose=ver1)
-    d = USBCDCDevice(u, vid, pid, rev, verbose=ver2)
-    d.connect()
-    try:
-        d.run()
-    except KeyboardInterrupt:
-        d.disconnect()
-        if options.log:
-            fplog.close()
+def execute_fuzz_testcase (device_class, device_subclass, device_proto, current_testcase, serialnum, phase=None, index=None):
 
+    u = None
+    started = time.time()
+    outcome = "ok"
 
-def connect_as_iphone (vid, pid, rev, mode):
-    if mode == 1:
-        ver1 = 0
-        ver2 = 0
-    else:
-        ver1 = 1
-        ver2 = 4
-#    sp = connectserial()
-    fake_testcase = ["dummy","",0]
-    fd = Facedancer(sp, verbose=ver1)
-    logfp = 0
-    if options.log:
-        logfp = fplog
-    u = MAXUSBApp(fd, logfp, mode, fake_testcase, verbose=ver1)
-    d = USBIphoneDevice(u, vid, pid, rev, verbose=ver2)
-    d.connect()
     try:
-        d.run()
+        entry = lookup_device_class(device_class, device_subclass, device_proto)
+        if not entry:
+            outcome = "error: device not supported"
+        else:
+            u = connect_device (entry, [device_class, device_subclass, device_proto],
+                    device_vid, device_pid, device_rev, entry.fuzz_mode,
+                    current_testcase)
+            if u is None:
+                outcome = "error: %s" % entry.setup_error
+    except SystemExit:
+        # MAXUSBApp gives up when the host stops answering
+        outcome = "no response"
+        raise
     except KeyboardInterrupt:
-        d.disconnect()
-        if options.log:
-            fplog.close()
+        outcome = "interrupted"
+        raise
+    except Exception as e:
+        outcome = "error: %s" % e
+        raise
+    finally:
+        if campaign_state and phase:
+            campaign_state.record(phase, index, started, outcome, str(serialnum))
 
+    pacer.observe(u)
+    pacer.wait()
 
-def connect_as_audio (vid, pid, rev, mode):
-    if mode == 1:
-        ver1 = 0
-        ver2 = 0
-    else:
-        ver1 = 1
-        ver2 = 4
-#    sp = connectserial()
-    fake_testcase = ["dummy","",0]
-    fd = Facedancer(sp, verbose=ver1)
-    logfp = 0
-    if options.log:
-        logfp = fplog
-    u = MAXUSBApp(fd, logfp, mode, fake_testcase, verbose=ver1)
-    d = USBAudioDevice(u, vid, pid, rev, verbose=ver2)
-    d.connect()
-    try:
-        d.run()
-    except KeyboardInterrupt:
-        d.disconnect()
-        if options.log:
-            fplog.close()
 
+def connect_device (entry, usbids, vid, pid, rev, mode, testcase=None, quiet=False, run=True):
+    """Emulate one device from the registry; with a testcase it runs
+    quietly as a fuzz case.  Returns the MAXUSBApp so callers can inspect
+    the fingerprint, or None if the device could not be built.  With run
+    False the device is left connected for the caller to serve."""
 
-def connect_as_printer (vid, pid, rev, mode):
-    if mode == 1:
-        ver1 = 0
-        ver2 = 0
-    else:
-        ver1 = 1
-        ver2 = 4
-#    sp = connectserial()
-    fake_testcase = ["dummy","",0]
-    fd = Facedancer(sp, verbose=ver1)
-    logfp = 0
-    if options.log:
-        logfp = fplog
-    u = MAXUSBApp(fd, logfp, mode, fake_testcase, verbose=ver1)
-    d = USBPrinterDevice(u, vid, pid, rev, 7, 1, 2, verbose=ver2)
-    d.connect()
-    try:
-        d.run()
-    except KeyboardInterrupt:
-        d.disconnect()
-        if options.log:
-            fplog.close()
+    fuzzing = testcase is not None
 
-
-def connect_as_keyboard (vid, pid, rev, mode):
-    print ("network socket={0}".format(network_socket))
-    if mode == 1:
+    if mode == 1 or fuzzing or quiet:
         ver1 = 0
         ver2 = 0
     else:
         ver1 = 1
         ver2 = 4
-#    sp = connectserial()
-    fake_testcase = ["dummy","",0]
-    fd = Facedancer(sp, verbose=ver1)
-    logfp = 0
-    if options.log:
-        logfp = fplog
-    u = MAXUSBApp(fd, logfp, mode, fake_testcase, verbose=ver1)
-    d = USBKeyboardDevice(u, vid, pid, rev, verbose=ver2)
-    d.connect()
-    try:
-        d.run()
-    except KeyboardInterrupt:
-        d.disconnect()
-        if options.log:
-            fplog.close()
 
+    if not fuzzing:
+        testcase = ["dummy","",0]
 
-def connect_as_smartcard (vid, pid, rev, mode):
+    u = get_session().begin_testcase(mode, testcase, verbose=ver1)
 
-    if mode == 1:
-        ver1 = 0
-        ver2 = 0
-    else:
-        ver1 = 1
-        ver2 = 4
-#    sp = connectserial()
-    fake_testcase = ["dummy","",0]
-    fd = Facedancer(sp, verbose=ver1)
-    logfp = 0
-    if options.log:
-        logfp = fplog
-    u = MAXUSBApp(fd, logfp, mode, fake_testcase, verbose=ver1)
-
-    if network_socket == True:
-        netserver(u, 2001).start()
-        u.server_running = True
-        input("Network socket listening on TCP port 2001 - Press Enter to continue with device emulation...")
+    if network_socket == True and entry.netserver and not fuzzing:
+        bridge = EndpointBridge()
+        if bridge.start(options.bridge or [ 2001 ]):
+            u.endpoint_bridge = bridge
+            u.server_running = True
+            input("Network bridge ready - Press Enter to continue with device emulation...")
 
-    d = USBSmartcardDevice(u, vid, pid, rev, verbose=ver2)
-    d.connect()
     try:
-        d.run()
-    except KeyboardInterrupt:
-        d.disconnect()
-        if options.log:
-            fplog.close()
-
-
-def connect_as_vendor (vid, pid, rev, mode):
-    if mode == 1:
-        ver1 = 0
-        ver2 = 0
+        d = entry.create(u, vid, pid, rev, usbids, verbose=ver2)
+    except Exception:
+        if not entry.setup_error:
+            raise
+        print ("Error:", entry.setup_error)
+        return None
+
+    if fuzzing:
+        try:
+            d.connect()
+        except:
+            pass
     else:
-        ver1 = 1
-        ver2 = 4
-#    sp = connectserial()
-    fake_testcase = ["dummy","",0]
-    fd = Facedancer(sp, verbose=ver1)
-    logfp = 0
-    if options.log:
-        logfp = fplog
-    u = MAXUSBApp(fd, logfp, mode, fake_testcase, verbose=ver1)
-    d = USBVendorDevice(u, vid, pid, rev, verbose=ver2)
-    d.connect()
-    try:
-        d.run()
-    except KeyboardInterrupt:
-        d.disconnect()
-        if options.log:
-            fplog.close()
-
+        d.connect()
 
+    if not run:
+        return u
 
-def connect_as_hub (vid, pid, rev, mode):
-    if mode == 1:
-        ver1 = 0
-        ver2 = 0
-    else:
-        ver1 = 1
-        ver2 = 4
-#    sp = connectserial()
-    fake_testcase = ["dummy","",0]
-    fd = Facedancer(sp, verbose=ver1)
-    logfp = 0
-    if options.log:
-        logfp = fplog
-    u = MAXUSBApp(fd, logfp, mode, fake_testcase, verbose=ver1)
-    d = USBHubDevice(u, vid, pid, rev, verbose=ver2)
-    d.connect()
     try:
         d.run()
     except KeyboardInterrupt:
         d.disconnect()
+        if fuzzing:
+            # stops the campaign; the testcase is recorded as interrupted
+            raise
         if options.log:
             fplog.close()
 
-
-def connect_as_mass_storage (vid, pid, rev, mode):
-    if mode == 1:
-        ver1 = 0
-        ver2 = 0
-    else:
-        ver1 = 1
-        ver2 = 4
-#    sp = connectserial()
-    fake_testcase = ["dummy","",0] 
-    fd = Facedancer(sp, verbose=ver1)
-    logfp = 0
-    if options.log:
-        logfp = fplog
-    u = MAXUSBApp(fd, logfp, mode, fake_testcase, verbose=ver1)
-
-    if network_socket == True:
-        netserver(u, 2001).start()
-        u.server_running = True
-        input("Network socket listening on TCP port 2001 - Press Enter to continue with device emulation...")
-
-    try:
-        d = USBMassStorageDevice(u, vid, pid, rev, 8, 6, 80, "stick.img", verbose=ver2)
-        d.connect()
-        try:
-            d.run()
-        except KeyboardInterrupt:
-            d.disconnect()
-            if options.log:
-                fplog.close()
-
-    except:
-        print ("Error: stick.img not found - please create a disk image using dd")
-
-
+    return u
 
 
 def identify_classes (single_device):
@@ -548,70 +206,69 @@ def identify_classes (single_device):
     if single_device:
         supported_devices_id = single_device
     else:
-        supported_devices_id = supported_devices
+        supported_devices_id = supported_device_ids()
         
     class_count = 0
 
 
     while class_count < len(supported_devices_id):
-        list_classes([supported_devices_id[class_count]])
+        usbids = supported_devices_id[class_count]
+        list_classes([usbids])
 
-        logfp = 0
-        if options.log:
-            logfp = fplog
-        mode = 1 # identity mode
-
-        if supported_devices_id[class_count][0] == 1:
-            connect_as_audio (device_vid, device_pid, device_rev, 1)
-        elif supported_devices_id[class_count][0] == 2:
-            connect_as_cdc (device_vid, device_pid, device_rev, 1)
-        elif supported_devices_id[class_count][0] == 3:
-            connect_as_keyboard (device_vid, device_pid, device_rev, 1)
-        elif supported_devices_id[class_count][0] == 6:
-            connect_as_image (device_vid, device_pid, device_rev, 1)
-        elif supported_devices_id[class_count][0] == 7:
-            connect_as_printer (device_vid, device_pid, device_rev, 1)
-        elif supported_devices_id[class_count][0] == 8:
-            connect_as_mass_storage (device_vid, device_pid, device_rev, 1)
-        elif supported_devices_id[class_count][0] == 9:
-            connect_as_hub (device_vid, device_pid, device_rev, 1)
-        elif supported_devices_id[class_count][0] == 10:
-            connect_as_cdc (device_vid, device_pid, device_rev, 1)
-        elif supported_devices_id[class_count][0] == 11:
-            connect_as_smartcard (device_vid, device_pid, device_rev, 1)
+        u = None
+        entry = lookup_device_class(*usbids)
+        if entry:
+            u = connect_device (entry, usbids, device_vid, device_pid, device_rev, 1)
 
         sys.stdout.flush()
 
         print ("")
-        time.sleep(int(enumeration_delay)) 
+        pacer.observe(u)
+        pacer.wait()
         class_count += 1
 
 
+def fuzz_campaign (usbclass, usbsubclass, usbproto, fuzztype, start_fuzzcase):
+    """-f with several boards: the testcases of the selected phases are
+    shared out between the boards and reported in order."""
 
-def list_classes (devices_list):
-    x = 0
-    while x < len(devices_list):
-        print ("%02x:%02x:%02x - " % (devices_list[x][0], devices_list[x][1], devices_list[x][2]), end="")
+    usbids = [usbclass, usbsubclass, usbproto]
+    entry = lookup_device_class(*usbids)
+    if not entry:
+        print ("Error: Device not supported\n")
+        return
 
-        class_name = 0
-        while class_name < len (device_class_list):
-            if (devices_list[x][0] == device_class_list[class_name][1]):
-                print (device_class_list[class_name][0],": ",end="")
-            class_name += 1
+    cases = []
 
-        subclass_name = 0
-        while subclass_name < len (device_subclass_list):
-            if (devices_list[x][0] == device_subclass_list[subclass_name][0]) and (devices_list[x][1] == device_subclass_list[subclass_name][2]):
-                print (device_subclass_list[subclass_name][1],": ",end="")
-            subclass_name += 1
+    if fuzztype == "E" or fuzztype == "A":
+        testcases = load_testcases("testcases_class_independent")
+        x = get_start_fuzzcase (start_fuzzcase, testcases)
+        cases += [("E", i, "Enumeration phase: %04d - %s" % (i, testcases[i][0]))
+                for i in range(x, len(testcases))
+                if not campaign_state.completed("E", i)]
 
-        protocol_name = 0
-        while protocol_name < len (device_protocol_list):
-            if (devices_list[x][0] == device_protocol_list[protocol_name][0]) and (devices_list[x][2] == device_protocol_list[protocol_name][2]):
-                print (device_protocol_list[protocol_name][1])
-            protocol_name += 1
+    if fuzztype == "C" or fuzztype == "A":
+        class_testcases = entry.testcases()
+        if class_testcases:
+            x = get_start_fuzzcase (start_fuzzcase, class_testcases)
+            cases += [("C", i, "%s class: %04d - %s" % (entry.label, i, class_testcases[i][0]))
+                    for i in range(x, len(class_testcases))
+                    if not campaign_state.completed("C", i)]
+        else:
+            print ("\nError: Class fuzzing not yet implemented for this device\n")
 
-        x+=1
+    print ("Fuzzing on %d boards:" % len(serial_ports))
+    if options.log:
+        fplog.write ("Fuzzing on %d boards:\n" % len(serial_ports))
+
+    skipped = run_campaign(serial_ports, entry, usbids, device_vid, device_pid,
+            device_rev, pacer, cases,
+            fplog if options.log else None, campaign_state)
+
+    if skipped:
+        print ("Error: %d testcases were not run - check the hosts are still functioning correctly" % skipped)
+
+    return skipped
 
 
 def get_start_fuzzcase (start_fuzzcase, testcases):
@@ -625,401 +282,553 @@ def get_start_fuzzcase (start_fuzzcase, testcases):
     return 0
 
 
-if options.listclasses:
-    print ("XX:YY:ZZ - XX = Class : YY = Subclass : ZZ = Protocol")
-    list_classes(supported_devices)
+def main():
+    global options, fplog, serial_ports, serial0, usbip, network_socket
+    global device_vid, device_pid, device_rev, campaign_state, pacer
+
+    print ("\n---------------------------------------")
+    print (" _   _ _ __ ___   __ _ _ __")   
+    print ("| | | | '_ ` _ \ / _` | '_ \\")  
+    print ("| |_| | | | | | | (_| | |_) |") 
+    print (" \__,_|_| |_| |_|\__,_| .__/")  
+    print ("                      |_|  ")
+    print ("\nThe USB host assessment tool")
+    print ("Andy Davis, NCC Group 2013")
+    print ("Version:", current_version)
+    print ("\nBased on Facedancer by Travis Goodspeed\n")
+    print ("For help type: umap.py -h")
+    print ("---------------------------------------\n")
+
+
+    parser = OptionParser(usage="%prog ", version=current_version)
+    group = OptionGroup(parser, "Experimental Options")
+
+    parser.add_option("-P", dest="serial", help="Facedancer serial port **Mandatory option** (SERIAL=/dev/ttyX or just 1 for COM1, or sim for the software MAX3421E simulator, or usbip[:HOST:PORT] to export devices over USB/IP instead, by default on 127.0.0.1:3240); with -f, a comma-separated list of boards to fuzz with in parallel")
+    parser.add_option("-L", action="store_true", dest="listclasses", default=False, help="List device classes supported by umap")
+    parser.add_option("-i", action="store_true", dest="identify", default=False, help="identify all supported device classes on connected host")
+    parser.add_option("-c", dest="cls", help="identify if a specific class on the connected host is supported (CLS=class:subclass:proto)")
+    parser.add_option("-O", action="store_true", dest="osid", default=False, help="Operating system identification")
+    parser.add_option("-e", dest="device", help="emulate a specific device (DEVICE=class:subclass:proto); with -P usbip, a comma-separated list of devices to export together")
+    parser.add_option("-n", action="store_true", dest="netsocket", default=False, help="Start network server connected to the bulk endpoints (TCP port 2001)")
+    parser.add_option("--bridge", dest="bridge", action="append", help="network bridge address (PORT, HOST:PORT or unix:PATH) to listen on instead of TCP port 2001; implies -n, may be repeated")
+    parser.add_option("-v", dest="vid", help="specify Vendor ID (hex format e.g. 1a2b)")
+    parser.add_option("-p", dest="pid", help="specify Product ID (hex format e.g. 1a2b)")
+    parser.add_option("-r", dest="rev", help="specify product Revision (hex format e.g. 1a2b)")
+    parser.add_option("-f", dest="fuzzc", help="fuzz a specific class (FUZZC=class:subclass:proto:E/C/A[:start fuzzcase])")
+    parser.add_option("--state", dest="state", default="umap-campaign.json", help="file the progress of a -f campaign is saved to after every testcase (default: umap-campaign.json)")
+    parser.add_option("--resume", action="store_true", dest="resume", default=False, help="resume the -f campaign saved in the --state file, skipping the testcases it has already run")
+    parser.add_option("--force", action="store_true", dest="force", default=False, help="start a new -f campaign even if the --state file holds an unfinished one")
+    parser.add_option("-s", dest="fuzzs", help="send a single fuzz testcase (FUZZS=class:subclass:proto:E/C:Testcase)")
+    parser.add_option("-d", dest="dly", help="delay between enumeration attempts (seconds): Default=1; auto[:MIN:MAX] adapts it to how soon the host is ready, within MIN-MAX seconds (default 0.05-5)")
+    parser.add_option("-l", dest="log", help="log to a file")
+    parser.add_option("-R", dest="ref", help="Reference the VID/PID database (REF=VID:PID)")
+    parser.add_option("-u", action="store_true", dest="updatedb", default=False, help="update the VID/PID database (Internet connectivity required)")
+    parser.add_option("--disk", dest="disk", action="append", help="mass storage backing: an image file, or a directory to present as a synthesized FAT volume (default: stick.img); repeat to add LUNs")
+    parser.add_option("--block-size", dest="block_size", help="mass storage logical block size in bytes, e.g. 4096 for a 4Kn disk (default: 512)")
+    parser.add_option("--disk-size", dest="disk_size", help="size in MB of the FAT volume synthesized for --disk DIR (default: fit the files, at least 64)")
+    parser.add_option("--photos", dest="photos", action="append", help="image class: expose DIR as a PTP storage of objects instead of the built-in picture; repeat for more storages")
+    parser.add_option("--plugin", action="append", dest="plugins", default=[], help="import a module that registers extra device classes (may be repeated)")
+
+    group.add_option("-A", dest="apple", help="emulate an Apple iPhone device (APPLE=VID:PID:REV)")
+    group.add_option("-b", dest="vendor", help="brute-force vendor driver support (VENDOR=VID:PID)")
+
+    parser.add_option_group(group)
+
+    (options, args) = parser.parse_args()
+
+    load_plugins(options.plugins)
+
+    if options.disk or options.disk_size or options.block_size:
+        mass_storage = lookup_device_class(8, 6, 0x50)
+        if options.disk:
+            mass_storage.extra_args = (options.disk,)
+        if options.disk_size:
+            mass_storage.extra_kwargs["disk_size"] = int(options.disk_size) * 1024 * 1024
+        if options.block_size:
+            mass_storage.extra_kwargs["block_size"] = int(options.block_size)
+
+    if options.photos:
+        lookup_device_class(6, 1, 1).extra_kwargs["object_dirs"] = options.photos
+
+
+    if options.listclasses:
+        print ("XX:YY:ZZ - XX = Class : YY = Subclass : ZZ = Protocol")
+        list_classes(supported_device_ids())
+
+        # listing needs no board
+        if not options.serial:
+            sys.exit()
 
-if options.identify:
-    devtmp = []
-    identify_classes(devtmp)
+    if not options.serial:
+        print ("Error: Facedancer serial port not supplied\n")
+        sys.exit()
+    else:
+        serial_ports = []
 
-if options.fuzzs:
-    error = 0
-    devsubproto = options.fuzzs.split(':')
+        for tmp_serial in options.serial.split(','):
+            if tmp_serial == "sim" or tmp_serial.startswith("usbip"):
+                serial_ports.append(tmp_serial)
 
-    if len(devsubproto) != 5:
-        print ("Error: Device class specification invalid - too many parameters\n")
-        sys.exit()
+            elif current_platform == "Windows":
+                try:
+                    serial_ports.append(int(tmp_serial)-1)
+                except:
+                    print ("Error: Invalid serial port specification")
+                    sys.exit()
 
-    try:
-        usbclass = int(devsubproto[0],16)
-        usbsubclass = int(devsubproto[1],16)
-        usbproto = int(devsubproto[2],16)
-        fuzztype = devsubproto[3]
-        fuzztestcase = int(devsubproto[4])
-    except:
-        print ("Error: Device class specification invalid\n")
-        sys.exit()
+            else:
+                serial_ports.append(tmp_serial)
 
-    if fuzztype == "E" and error != 1:
-        print ("Fuzzing:")
-        devicetmp = [[usbclass,usbsubclass,usbproto]]
-        identify_classes(devicetmp)
-        timestamp = time.strftime("%Y/%m/%d %H:%M:%S", time.localtime())
-        print (timestamp, end="")
-        print (" Enumeration phase: %04d -" % fuzztestcase, testcases_class_independent[fuzztestcase][0])
-        execute_fuzz_testcase (usbclass,usbsubclass,usbproto,testcases_class_independent[fuzztestcase],serial0)
-
-    elif fuzztype == "C" and error != 1:
-        print ("Fuzzing:")
-        timestamp = time.strftime("%Y/%m/%d %H:%M:%S", time.localtime())
-        print (timestamp, end="")
-
-        devicetmp = [[usbclass,usbsubclass,usbproto]]
-        identify_classes(devicetmp)
-        print (" Class-specific data...")
-        if usbclass == 1:   #Audio
-            print (" Audio class: %04d -" % fuzztestcase, testcases_audio_class[fuzztestcase][0])
-            execute_fuzz_testcase (usbclass,usbsubclass,usbproto,testcases_audio_class[fuzztestcase],serial0)
-        elif usbclass == 3:   #HID
-            print (" HID class: %04d -" % fuzztestcase, testcases_hid_class[fuzztestcase][0])
-            execute_fuzz_testcase (usbclass,usbsubclass,usbproto,testcases_hid_class[fuzztestcase],serial0)
-        elif usbclass == 6:   #Image
-            print (" Image class: %04d -" % fuzztestcase, testcases_image_class[fuzztestcase][0])
-            execute_fuzz_testcase (usbclass,usbsubclass,usbproto,testcases_image_class[fuzztestcase],serial0)
-        elif usbclass == 7:    #Printer
-            print (" Printer class: %04d -" % fuzztestcase, testcases_printer_class[fuzztestcase][0])
-            execute_fuzz_testcase (usbclass,usbsubclass,usbproto,testcases_printer_class[fuzztestcase],serial0)
-        elif usbclass == 8:    #Mass Storage
-            print (" Mass Storage class: %04d -" % fuzztestcase, testcases_mass_storage_class[fuzztestcase][0])
-            execute_fuzz_testcase (usbclass,usbsubclass,usbproto,testcases_mass_storage_class[fuzztestcase],serial0)
-        elif usbclass == 9:    #Hub
-            print (" Hub class: %04d -" % fuzztestcase, testcases_hub_class[fuzztestcase][0])
-            execute_fuzz_testcase (usbclass,usbsubclass,usbproto,testcases_hub_class[fuzztestcase],serial0)
-        elif usbclass == 11:    #Printer
-            print (" Smartcard class: %04d -" % fuzztestcase, testcases_smartcard_class[fuzztestcase][0])
-            execute_fuzz_testcase (usbclass,usbsubclass,usbproto,testcases_smartcard_class[fuzztestcase],serial0)
-        else:
-            print ("\n***Class fuzzing not yet implemented for this device***\n")
-        
-    else:
-        optionerror()
+        # everything but a -f campaign runs on the first board
+        serial0 = serial_ports[0]
 
-if options.fuzzc:
-    start_fuzzcase = 0
-    devsubproto = options.fuzzc.split(':')
-    if len(devsubproto) > 5:
-        print ("Error: Device class specification invalid - too many parameters\n")
-        sys.exit()
+    if options.log:
+        logfilepath = options.log
+        fplog = open(logfilepath, mode='a')
+        fplog.write ("---------------------------------------\n")
+        fplog.write ("umap - the USB host assessment tool\n")
+        fplog.write ("Andy Davis, NCC Group 2013\n")
+        write_string = "Version:" + current_version + "\n"
+        fplog.write (write_string)
+        fplog.write ("\nBased on Facedancer by Travis Goodspeed\n")
+        fplog.write ("---------------------------------------\n")
+
+    if options.netsocket or options.bridge:
+        network_socket = True
+
+    usbip = str(serial0).startswith("usbip")
+
+    if options.updatedb:
+        print ("Downloading latest VID/PID database...")
+        try:
+            urllib.request.urlretrieve("http://www.linux-usb.org/usb.ids", "usb.ids")
+            print ("Finished")
+        except:
+            print ("Error: Unable to contact server")
 
-    try:
-        usbclass = int(devsubproto[0],16)
-        usbsubclass = int(devsubproto[1],16)
-        usbproto = int(devsubproto[2],16)
-        fuzztype = devsubproto[3]
+
+    if options.vid:
+        try:
+            device_vid = int(options.vid,16)
+            if device_vid > 65535:
+                print ("Error: Invalid VID")
+            else:
+                print_output = "VID = %04x" % device_vid
+                print (print_output)
+                if options.log:
+                    fplog.write (print_output + "\n")
+        except:
+            print ("Error: Invalid VID")
+
+    if options.pid:
         try:
-            if devsubproto[4]:
-                start_fuzzcase = int(devsubproto[4])
+            device_pid = int(options.pid,16)
+            if device_pid > 65535:
+                print ("Error: Invalid PID")
+            else:
+                print_output = "PID = %04x" % device_pid
+                print (print_output)
+                if options.log:
+                    fplog.write (print_output + "\n")
         except:
-            pass
-    except:
-        print ("Error: Device class specification invalid\n")
-        sys.exit()
+            print ("Error: Invalid PID")
 
-    if fuzztype == "E" or fuzztype == "A": 
+    if options.rev:
+        try:
+            device_rev = int(options.rev,16)
+            if device_rev > 65535:
+                print ("Error: Invalid REV")
+            else:
+                print_output = "REV = %04x" % device_rev
+                print (print_output)
+                if options.log:
+                    fplog.write (print_output + "\n")
+        except:
+            print ("Error: Invalid REV")
 
-        print ("Fuzzing:")
-        if options.log:
-            fplog.write ("Fuzzing:\n")
-        devicetmp = [[usbclass,usbsubclass,usbproto]]
-        identify_classes(devicetmp)
-        print ("Enumeration phase...")
-        if options.log:
-            fplog.write ("Enumeration phase...\n")
+    if options.ref:
+        vidpid = options.ref.split(':')
+        if len(vidpid) != 2:
+            print ("Error: VID/PID invalid")
+        else:
+            lookup_vid = vidpid[0]
+            lookup_pid = vidpid[1]
 
-        current_serial_port = 0
-        x = get_start_fuzzcase (start_fuzzcase, testcases_class_independent)
-        while (x < len (testcases_class_independent)):
-            timestamp = time.strftime("%Y/%m/%d %H:%M:%S", time.localtime())
-            print (timestamp, end="")
-            print_output = " Enumeration phase: %04d - %s" % (x, testcases_class_independent[x][0])
-            print (print_output)
+            print ("Looking up VID=",lookup_vid, "/ PID=", lookup_pid)
 
-            if options.log:
-                fplog.write (timestamp)
-                fplog.write (print_output)
-                
-            execute_fuzz_testcase (usbclass,usbsubclass,usbproto,testcases_class_independent[x],serial0)
-            x+=1
+            try:
+                vendor, product = USBIdsIndex("usb.ids").lookup(int(lookup_vid,16), int(lookup_pid,16))
+            except ValueError:
+                vendor = product = None
 
-    if fuzztype == "C" or fuzztype == "A":
+            if vendor:
+                print(vendor, end=" ")
+            else:
+                print ("\nVID could not be located")
+            if product:
+                print(product)
+            else:
+                print ("\nPID could not be located\n")
 
-        print ("Fuzzing:")
-        if options.log:
-            fplog.write ("Fuzzing:\n")
-        devicetmp = [[usbclass,usbsubclass,usbproto]]
-        identify_classes(devicetmp)
-        print ("Class-specific data...")
+    if options.dly and options.dly.startswith("auto"):
+        try:
+            bounds = [float(x) for x in options.dly.split(':')[1:]]
+            if len(bounds) not in (0, 2):
+                raise ValueError
+            pacer = EnumerationPacer(1.0, True, *bounds)
+        except ValueError:
+            print("Error: Enumeration delay bounds invalid - using defaults")
+            pacer = EnumerationPacer(adaptive=True)
+
+        print ("Enumeration delay set to:", pacer)
         if options.log:
-            fplog.write ("Class-specific data...\n")
-        if usbclass == 3:   #HID
+            fplog.write ("Enumeration delay set to:" + str(pacer) + "\n")
 
-            x = get_start_fuzzcase (start_fuzzcase, testcases_hid_class)
-            while (x < len (testcases_hid_class)):
-                timestamp = time.strftime("%Y/%m/%d %H:%M:%S", time.localtime())
-                print (timestamp, end="")
-                print_output = " HID class: %04d - %s" % (x, testcases_hid_class[x][0])
-                print (print_output)
+    elif options.dly:
+        try:
+            pacer = EnumerationPacer(int(options.dly))
+            print ("Enumeration delay set to:", int(options.dly))
+            if options.log:
+                write_string = "Enumeration delay set to:" + str(int(options.dly)) + "\n"
+                fplog.write (write_string)
 
-                if options.log:
-                    fplog.write (timestamp)
-                    fplog.write (print_output)
+        except ValueError:
+            print("Error: Enumeration delay is not an integer")
 
-                execute_fuzz_testcase (usbclass,usbsubclass,usbproto,testcases_hid_class[x],serial0)
-                x+=1
 
-        elif usbclass == 6:   #Image
-            x = get_start_fuzzcase (start_fuzzcase, testcases_image_class)
-            while (x < len (testcases_image_class)):
-                timestamp = time.strftime("%Y/%m/%d %H:%M:%S", time.localtime())
-                print (timestamp, end="")
-                print_output = " Image class: %04d - %s" % (x, testcases_image_class[x][0])
-                print (print_output)
+    if options.identify:
+        devtmp = []
+        identify_classes(devtmp)
 
-                if options.log:
-                    fplog.write (timestamp)
-                    fplog.write (print_output)
+    if options.fuzzs:
+        error = 0
+        devsubproto = options.fuzzs.split(':')
 
-                execute_fuzz_testcase (usbclass,usbsubclass,usbproto,testcases_image_class[x],serial0)
-                x+=1
+        if len(devsubproto) != 5:
+            print ("Error: Device class specification invalid - too many parameters\n")
+            sys.exit()
 
-        elif usbclass == 7:   #Printer
-            x = get_start_fuzzcase (start_fuzzcase, testcases_printer_class)
-            while (x < len (testcases_printer_class)):
-                timestamp = time.strftime("%Y/%m/%d %H:%M:%S", time.localtime())
-                print (timestamp, end="")
-                print_output = " Printer class: %04d - %s" % (x, testcases_printer_class[x][0])
-                print (print_output)
+        try:
+            usbclass = int(devsubproto[0],16)
+            usbsubclass = int(devsubproto[1],16)
+            usbproto = int(devsubproto[2],16)
+            fuzztype = devsubproto[3]
+            fuzztestcase = int(devsubproto[4])
+        except:
+            print ("Error: Device class specification invalid\n")
+            sys.exit()
 
-                if options.log:
-                    fplog.write (timestamp)
-                    fplog.write (print_output)
+        if fuzztype == "E" and error != 1:
+            print ("Fuzzing:")
+            devicetmp = [[usbclass,usbsubclass,usbproto]]
+            identify_classes(devicetmp)
+            timestamp = time.strftime("%Y/%m/%d %H:%M:%S", time.localtime())
+            print (timestamp, end="")
+            testcases_class_independent = load_testcases("testcases_class_independent")
+            print (" Enumeration phase: %04d -" % fuzztestcase, testcases_class_independent[fuzztestcase][0])
+            execute_fuzz_testcase (usbclass,usbsubclass,usbproto,testcases_class_independent[fuzztestcase],serial0)
 
-                execute_fuzz_testcase (usbclass,usbsubclass,usbproto,testcases_printer_class[x],serial0)
-                x+=1
+        elif fuzztype == "C" and error != 1:
+            print ("Fuzzing:")
+            timestamp = time.strftime("%Y/%m/%d %H:%M:%S", time.localtime())
+            print (timestamp, end="")
 
-        elif usbclass == 1:   #Audio
-            x = get_start_fuzzcase (start_fuzzcase, testcases_audio_class)
-            while (x < len (testcases_audio_class)):
-                timestamp = time.strftime("%Y/%m/%d %H:%M:%S", time.localtime())
-                print (timestamp, end="")
-                print_output = " Audio class: %04d - %s" % (x, testcases_audio_class[x][0])
-                print (print_output)
+            devicetmp = [[usbclass,usbsubclass,usbproto]]
+            identify_classes(devicetmp)
+            print (" Class-specific data...")
+            entry = lookup_device_class(usbclass, usbsubclass, usbproto)
+            class_testcases = entry and entry.testcases()
+            if class_testcases:
+                print (" %s class: %04d -" % (entry.label, fuzztestcase), class_testcases[fuzztestcase][0])
+                execute_fuzz_testcase (usbclass,usbsubclass,usbproto,class_testcases[fuzztestcase],serial0)
+            else:
+                print ("\n***Class fuzzing not yet implemented for this device***\n")
 
-                if options.log:
-                    fplog.write (timestamp)
-                    fplog.write (print_output)
+        else:
+            optionerror()
 
-                execute_fuzz_testcase (usbclass,usbsubclass,usbproto,testcases_audio_class[x],serial0)
-                x+=1
+    if options.resume:
+        try:
+            campaign_state = CampaignState.load(options.state)
+        except (OSError, ValueError, KeyError) as e:
+            print ("Error: Cannot resume from %s: %s\n" % (options.state, e))
+            sys.exit()
 
-        elif usbclass == 8:   #Mass Storage
-            x = get_start_fuzzcase (start_fuzzcase, testcases_mass_storage_class)
-            while (x < len (testcases_mass_storage_class)):
-                timestamp = time.strftime("%Y/%m/%d %H:%M:%S", time.localtime())
-                print (timestamp, end="")
-                print_output = " Mass Storage class: %04d - %s" % (x, testcases_mass_storage_class[x][0])
-                print (print_output)
+        if options.fuzzc and options.fuzzc != campaign_state.campaign:
+            print ("Error: %s holds the campaign %s, not %s\n" % (options.state,
+                    campaign_state.campaign, options.fuzzc))
+            sys.exit()
 
-                if options.log:
-                    fplog.write (timestamp)
-                    fplog.write (print_output)
+        options.fuzzc = campaign_state.campaign
+        print ("Resuming campaign %s started %s: %d testcases already run" % (
+                campaign_state.campaign, campaign_state.started,
+                len(campaign_state.done)))
 
-                execute_fuzz_testcase (usbclass,usbsubclass,usbproto,testcases_mass_storage_class[x],serial0)
-                x+=1
+    if options.fuzzc:
+        start_fuzzcase = 0
+        devsubproto = options.fuzzc.split(':')
+        if len(devsubproto) > 5:
+            print ("Error: Device class specification invalid - too many parameters\n")
+            sys.exit()
 
-        elif usbclass == 9:   #Hub
-            x = get_start_fuzzcase (start_fuzzcase, testcases_hub_class)
-            while (x < len (testcases_hub_class)):
-                timestamp = time.strftime("%Y/%m/%d %H:%M:%S", time.localtime())
-                print (timestamp, end="")
-                print_output = " Hub class: %04d - %s" % (x, testcases_hub_class[x][0])
-                print (print_output)
+        try:
+            usbclass = int(devsubproto[0],16)
+            usbsubclass = int(devsubproto[1],16)
+            usbproto = int(devsubproto[2],16)
+            fuzztype = devsubproto[3]
+            try:
+                if devsubproto[4]:
+                    start_fuzzcase = int(devsubproto[4])
+            except:
+                pass
+        except:
+            print ("Error: Device class specification invalid\n")
+            sys.exit()
 
-                if options.log:
-                    fplog.write (timestamp)
-                    fplog.write (print_output)
+        if fuzztype != "C" and fuzztype != "E" and fuzztype != "A":
+            optionerror()
+            sys.exit()
 
-                execute_fuzz_testcase (usbclass,usbsubclass,usbproto,testcases_hub_class[x],serial0)
-                x+=1
+        if not lookup_device_class(usbclass, usbsubclass, usbproto):
+            print ("Error: Device not supported\n")
+            sys.exit()
+
+        # a new campaign's state is only written once its spec is known good
+        if campaign_state is None:
+            if os.path.exists(options.state) and not options.force:
+                try:
+                    previous = CampaignState.load(options.state)
+                except (OSError, ValueError, KeyError):
+                    previous = None
+
+                if previous is None or (previous.cases and not previous.finished):
+                    print ("Error: %s holds an unfinished campaign - continue it with --resume, or use --force to start over\n" % options.state)
+                    sys.exit()
+
+            campaign_state = CampaignState(options.state, options.fuzzc)
+            campaign_state.save()
+
+        skipped = 0
+
+        if len(serial_ports) > 1 and fuzztype in ("E", "C", "A"):
+            skipped = fuzz_campaign (usbclass, usbsubclass, usbproto, fuzztype, start_fuzzcase)
+
+        elif fuzztype == "E" or fuzztype == "A": 
+
+            print ("Fuzzing:")
+            if options.log:
+                fplog.write ("Fuzzing:\n")
+            devicetmp = [[usbclass,usbsubclass,usbproto]]
+            identify_classes(devicetmp)
+            print ("Enumeration phase...")
+            if options.log:
+                fplog.write ("Enumeration phase...\n")
+
+            current_serial_port = 0
+            testcases_class_independent = load_testcases("testcases_class_independent")
+            x = get_start_fuzzcase (start_fuzzcase, testcases_class_independent)
+            while (x < len (testcases_class_independent)):
+                if campaign_state.completed("E", x):
+                    x+=1
+                    continue
 
-        elif usbclass == 11:   #Smartcard
-            x = get_start_fuzzcase (start_fuzzcase, testcases_smartcard_class)
-            while (x < len (testcases_smartcard_class)):
                 timestamp = time.strftime("%Y/%m/%d %H:%M:%S", time.localtime())
                 print (timestamp, end="")
-                print_output = " Smartcard class: %04d - %s" % (x, testcases_smartcard_class[x][0])
+                print_output = " Enumeration phase: %04d - %s" % (x, testcases_class_independent[x][0])
                 print (print_output)
 
                 if options.log:
                     fplog.write (timestamp)
                     fplog.write (print_output)
 
-                execute_fuzz_testcase (usbclass,usbsubclass,usbproto,testcases_smartcard_class[x],serial0)
+                execute_fuzz_testcase (usbclass,usbsubclass,usbproto,testcases_class_independent[x],serial0,"E",x)
                 x+=1
 
-        else:
-            print ("\nError: Class fuzzing not yet implemented for this device\n")
+        if len(serial_ports) == 1 and (fuzztype == "C" or fuzztype == "A"):
 
+            print ("Fuzzing:")
+            if options.log:
+                fplog.write ("Fuzzing:\n")
+            devicetmp = [[usbclass,usbsubclass,usbproto]]
+            identify_classes(devicetmp)
+            print ("Class-specific data...")
+            if options.log:
+                fplog.write ("Class-specific data...\n")
+            entry = lookup_device_class(usbclass, usbsubclass, usbproto)
+            class_testcases = entry and entry.testcases()
+            if class_testcases:
+                x = get_start_fuzzcase (start_fuzzcase, class_testcases)
+                while (x < len (class_testcases)):
+                    if campaign_state.completed("C", x):
+                        x+=1
+                        continue
+
+                    timestamp = time.strftime("%Y/%m/%d %H:%M:%S", time.localtime())
+                    print (timestamp, end="")
+                    print_output = " %s class: %04d - %s" % (entry.label, x, class_testcases[x][0])
+                    print (print_output)
+
+                    if options.log:
+                        fplog.write (timestamp)
+                        fplog.write (print_output)
+
+                    execute_fuzz_testcase (usbclass,usbsubclass,usbproto,class_testcases[x],serial0,"C",x)
+                    x+=1
 
-    if fuzztype != "C" and fuzztype != "E" and fuzztype != "A":
-        optionerror()
+            else:
+                print ("\nError: Class fuzzing not yet implemented for this device\n")
 
-if options.vendor:
-    vidpid = options.vendor.split(':')
-    vid = int(vidpid[0],16)
-    pid = int(vidpid[1],16)
-    rev = device_rev
 
-    print ("Emulating vendor-specific device:", vidpid[0], vidpid[1])
-    connect_as_vendor (vid, pid, rev, 1)
+        if not skipped:
+            campaign_state.finish()
 
-if options.apple:
-    vidpidrev = options.apple.split(':')
-    vid = int(vidpidrev[0],16)
-    pid = int(vidpidrev[1],16)
-    rev = int(vidpidrev[2],16)
-    print ("Emulating iPhone device:", vidpidrev[0], vidpidrev[1], vidpidrev[2])
-    connect_as_iphone (vid, pid, rev, 3)
+        # each board of a campaign adapts its own copy
+        if pacer.adaptive and len(serial_ports) == 1:
+            print ("Enumeration delay finished at %.2fs" % pacer.delay)
 
-if options.cls:
-    devsubproto = options.cls.split(':')
-    if len(devsubproto) != 3:
-        print ("Error: Device class specification invalid\n")
-    else:
-        try:
-            dev = int(devsubproto[0],16)
-            sub = int(devsubproto[1],16)
-            proto = int(devsubproto[2],16)
-            devicetmp = [[dev,sub,proto]]
-            identify_classes(devicetmp)
-        except:
-            print ("Error: Device class specification invalid\n")
+    if options.vendor:
+        vidpid = options.vendor.split(':')
+        vid = int(vidpid[0],16)
+        pid = int(vidpid[1],16)
+        rev = device_rev
 
-if options.device:
-    devsubproto = options.device.split(':')
-    if len(devsubproto) != 3:
-        print ("Error: Device class specification invalid\n")
-        sys.exit()
+        print ("Emulating vendor-specific device:", vidpid[0], vidpid[1])
+        connect_device (vendor_device, [0xff, 0, 0], vid, pid, rev, 1)
 
-    try:
-        dev = int(devsubproto[0],16)
-        sub = int(devsubproto[1],16)
-        proto = int(devsubproto[2],16)
-        devicetmp = [[dev,sub,proto]]
-    except:
-        print ("Error: Device class specification invalid\n")
-        sys.exit()
+    if options.apple:
+        vidpidrev = options.apple.split(':')
+        vid = int(vidpidrev[0],16)
+        pid = int(vidpidrev[1],16)
+        rev = int(vidpidrev[2],16)
+        print ("Emulating iPhone device:", vidpidrev[0], vidpidrev[1], vidpidrev[2])
+        connect_device (iphone_device, [0, 0, 0], vid, pid, rev, 3)
 
+    if options.cls:
+        devsubproto = options.cls.split(':')
+        if len(devsubproto) != 3:
+            print ("Error: Device class specification invalid\n")
+        else:
+            try:
+                dev = int(devsubproto[0],16)
+                sub = int(devsubproto[1],16)
+                proto = int(devsubproto[2],16)
+                devicetmp = [[dev,sub,proto]]
+                identify_classes(devicetmp)
+            except:
+                print ("Error: Device class specification invalid\n")
+
+    if options.device:
+        devicetmp = []
+        for spec in options.device.split(','):
+            devsubproto = spec.split(':')
+            if len(devsubproto) != 3:
+                print ("Error: Device class specification invalid\n")
+                sys.exit()
+
+            try:
+                devicetmp.append([int(x,16) for x in devsubproto])
+            except:
+                print ("Error: Device class specification invalid\n")
+                sys.exit()
+
+        if len(devicetmp) > 1 and not usbip:
+            print ("Error: Only one device can be emulated on a Facedancer board\n")
+            sys.exit()
 
-    print ("Emulating ",end="")
-
-    list_classes(devicetmp)
-
-
-    if dev == 1:
-        connect_as_audio (device_vid, device_pid, device_rev, 3)
-    elif dev == 2:
-        connect_as_cdc (device_vid, device_pid, device_rev, 3)
-    elif dev == 3:
-        connect_as_keyboard (device_vid, device_pid, device_rev, 3)
-    elif dev == 6:
-        connect_as_image (device_vid, device_pid, device_rev, 2)   
-    elif dev == 7:
-        connect_as_printer (device_vid, device_pid, device_rev, 0)
-    elif dev == 8:
-        connect_as_mass_storage (device_vid, device_pid, device_rev, 3)
-    elif dev == 9:
-        connect_as_hub (device_vid, device_pid, device_rev, 3)
-    elif dev == 10:
-        connect_as_cdc (device_vid, device_pid, device_rev, 0)
-    elif dev == 11:
-        connect_as_smartcard (device_vid, device_pid, device_rev, 3)
-    else:
-        print ("Error: Device not supported\n")
 
-if options.osid:
+        print ("Emulating ",end="")
 
-    # --- Read fingerprint file ---
-    fingerprintfile = './umap-device-fingerprints.json'
-    print ("Reading fingerprints from %s" % fingerprintfile)
-    fpfile = open (fingerprintfile, 'r')
-    fingerprints = json.load(fpfile)
-    print ("Read %d fingerprints." % len(fingerprints))
+        list_classes(devicetmp)
 
-    print ("Fingerprinting the connected host - please wait...")
 
-    try:
-        print (vid)
-    except:
-        vid = 0x1111
+        for dev, sub, proto in devicetmp:
+            entry = lookup_device_class(dev, sub, proto)
+            if not entry:
+                print ("Error: Device not supported\n")
+            elif len(devicetmp) == 1:
+                connect_device (entry, [dev, sub, proto], device_vid, device_pid, device_rev, entry.emulate_mode)
+            else:
+                connect_device (entry, [dev, sub, proto], device_vid, device_pid, device_rev, entry.emulate_mode, run=False)
 
-    try:
-        print (pid)
-    except:
-        pid = 0x2222
+        if len(devicetmp) > 1:
+            # every exported device is served from here until the hosts detach
+            try:
+                get_session().serve()
+            except KeyboardInterrupt:
+                get_session().close()
 
-    try:
-        print (rev)
-    except:
-        rev = 0x3333
+    if options.osid:
 
-    # --- Attempt fingerprint ---
-#    sp = connectserial()
-    fake_testcase = ["dummy","",0]
-    fd = Facedancer(sp, verbose=0)
-    logfp = 0
-    if options.log:
-        logfp = fplog
-    u = MAXUSBApp(fd, logfp, 3, fake_testcase, verbose=0)
-    d = USBPrinterDevice(u, vid, pid, rev, 7, 1, 2, verbose=0)
-    d.connect()
-    try:
-        d.run()
-    except KeyboardInterrupt:
-        d.disconnect()
-        if options.log:
-            fplog.close()
+        # --- Read fingerprint file ---
+        fingerprintfile = './umap-device-fingerprints.json'
+        print ("Reading fingerprints from %s" % fingerprintfile)
+        fpfile = open (fingerprintfile, 'r')
+        fingerprints = json.load(fpfile)
+        print ("Read %d fingerprints." % len(fingerprints))
 
-    # --- Try to match fingerprint responses ---
-    matchedfingerprints = []
-    for fingerprint in fingerprints:
+        print ("Fingerprinting the connected host - please wait...")
 
-        # --- Perform each match in the fingerprint ---
-        numfpmatched = 0
-        for match in fingerprint['matches']:
+        try:
+            print (vid)
+        except:
+            vid = 0x1111
 
-            # --- If match is on the count of a particular item ---
-            if match['match-type'] == 'match-freq':
-                if getattr(u.fingerprint.count("Dev:" + match['match-text']),match['match-condition'])(int(match['match-value'])):
-                   numfpmatched += 1
+        try:
+            print (pid)
+        except:
+            pid = 0x2222
 
-            # --- If match is on the number of items ---
-            elif match['match-type'] == 'match-count':
-                if getattr(len(u.fingerprint),match['match-condition'])(int(match['match-value'])):
-                    numfpmatched += 1
+        try:
+            print (rev)
+        except:
+            rev = 0x3333
+
+        # --- Attempt fingerprint ---
+        u = connect_device (lookup_device_class(7, 1, 2), [7, 1, 2], vid, pid, rev, 3, quiet=True)
+
+        # --- Try to match fingerprint responses ---
+        matchedfingerprints = []
+        for fingerprint in fingerprints:
+
+            # --- Perform each match in the fingerprint ---
+            numfpmatched = 0
+            for match in fingerprint['matches']:
+
+                # --- If match is on the count of a particular item ---
+                if match['match-type'] == 'match-freq':
+                    if getattr(u.fingerprint.count("Dev:" + match['match-text']),match['match-condition'])(int(match['match-value'])):
+                       numfpmatched += 1
+
+                # --- If match is on the number of items ---
+                elif match['match-type'] == 'match-count':
+                    if getattr(len(u.fingerprint),match['match-condition'])(int(match['match-value'])):
+                        numfpmatched += 1
+
+                # --- If match is on a single item in a particular position ---
+                elif match['match-type'] == 'match-pos':
+                    if getattr("Dev:" + match['match-text'],match['match-condition'])(u.fingerprint[int(match['match-value'])]):
+                        numfpmatched += 1
+
+                else:
+                    print ("Unknown match type: %s" % match['match-type'])
+                    next
+
+            # --- If fingerprint succeeded ---
+            if numfpmatched == len(fingerprint['matches']):
+                matchedfingerprints.extend(fingerprint['match-names'])
+
+        # --- Tell the user which fingerprints matched ---
+        if matchedfingerprints:
+            print ("\nFingerprint matches:")
+            for matchedfingerprint in matchedfingerprints:
+                print (matchedfingerprint)
+        else:
+            print ("\nUnknown OS - Fingerprint:")
+            print (u.fingerprint)
 
-            # --- If match is on a single item in a particular position ---
-            elif match['match-type'] == 'match-pos':
-                if getattr("Dev:" + match['match-text'],match['match-condition'])(u.fingerprint[int(match['match-value'])]):
-                    numfpmatched += 1
+    if options.log:
+        fplog.close()
 
-            else:
-                print ("Unknown match type: %s" % match['match-type'])
-                next
-
-        # --- If fingerprint succeeded ---
-        if numfpmatched == len(fingerprint['matches']):
-            matchedfingerprints.extend(fingerprint['match-names'])
-
-    # --- Tell the user which fingerprints matched ---
-    if matchedfingerprints:
-        print ("\nFingerprint matches:")
-        for matchedfingerprint in matchedfingerprints:
-            print (matchedfingerprint)
-    else:
-        print ("\nUnknown OS - Fingerprint:")
-        print (u.fingerprint)
 
-if options.log:
-    fplog.close()
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+# usbids.py
+#
+# Contains the USBIdsIndex class: a compiled, memory-mapped index of the
+# vendor/product section of usb.ids, rebuilt whenever usb.ids changes.
+#
+# Index layout (all little endian):
+#   header    magic, version, source mtime/size/sha1, section counts/offsets
+#   vendors   sorted (vid, name_len, name_off, first_product, product_count)
+#   products  (pid, name_len, name_off), sorted by pid within each vendor
+#   strings   latin-1 names referenced by (name_off, name_len)
+
+import codecs
+import hashlib
+import os
+import struct
+from mmap import mmap, ACCESS_READ
+
+class USBIdsIndex:
+    magic = b'UIDX'
+    version = 1
+
+    header = struct.Struct('<4sHxxqQ20sIIIIII')
+    vendor_record = struct.Struct('<HHIII')
+    product_record = struct.Struct('<HHI')
+
+    def __init__(self, ids_filename="usb.ids", index_filename=None):
+        self.ids_filename = ids_filename
+        self.index_filename = index_filename or ids_filename + ".idx"
+        self.fp = None
+        self.data = None
+
+        self.open()
+
+    def open(self):
+        st = os.stat(self.ids_filename)
+
+        if not self.load_index(st):
+            data = self.build(st)
+            try:
+                tmp = self.index_filename + ".tmp"
+                with open(tmp, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp, self.index_filename)
+                self.load_index(st)
+            except OSError:
+                # read-only install: keep the freshly built index in memory
+                self.data = data
+                self.parse_header()
+
+    def close(self):
+        if isinstance(self.data, mmap):
+            self.data.close()
+        if self.fp:
+            self.fp.close()
+
+        self.fp = None
+        self.data = None
+
+    def load_index(self, st):
+        """Map the index file; returns False if it is missing or was built
+        from a different usb.ids."""
+
+        try:
+            fp = open(self.index_filename, 'rb')
+        except OSError:
+            return False
+
+        try:
+            data = mmap(fp.fileno(), 0, access=ACCESS_READ)
+        except ValueError:      # empty file
+            fp.close()
+            return False
+
+        ok = len(data) >= self.header.size
+        if ok:
+            h = self.header.unpack_from(data, 0)
+            ok = h[0] == self.magic and h[1] == self.version and h[3] == st.st_size
+            if ok and h[2] != st.st_mtime_ns:
+                # touched but maybe not edited (e.g. copied or re-downloaded)
+                ok = h[4] == self.source_digest()
+
+        if not ok:
+            data.close()
+            fp.close()
+            return False
+
+        self.close()
+        self.fp = fp
+        self.data = data
+        self.parse_header()
+        return True
+
+    def parse_header(self):
+        (magic, version, mtime, size, digest,
+         self.vendor_count, self.vendors_offset,
+         self.product_count, self.products_offset,
+         self.strings_offset, self.strings_size) = self.header.unpack_from(self.data, 0)
+
+    def source_digest(self):
+        with open(self.ids_filename, 'rb') as f:
+            return hashlib.sha1(f.read()).digest()
+
+    def parse_source(self):
+        """Return {vid: (name, {pid: name})} from the vendor section of
+        usb.ids; the class/subclass lists after it are not indexed."""
+
+        vendors = { }
+        products = None
+
+        with codecs.open(self.ids_filename, "r", "latin-1") as f:
+            for line in f:
+                if line.startswith("# List of known device classes"):
+                    break
+                line = line.rstrip()
+                if not line.strip() or line.startswith("#"):
+                    continue
+
+                if not line.startswith("\t"):
+                    vid, name = line.split(None, 1)
+                    products = { }
+                    vendors[int(vid, 16)] = (name, products)
+                elif not line.startswith("\t\t") and products is not None:
+                    # "\t\t" lines are interfaces, not products
+                    pid, name = line.lstrip().split(None, 1)
+                    products[int(pid, 16)] = name
+
+        return vendors
+
+    def build(self, st):
+        vendors = self.parse_source()
+
+        strings = bytearray()
+        vendor_table = bytearray()
+        product_table = bytearray()
+        product_count = 0
+
+        def add_string(s):
+            b = s.encode("latin-1")[:0xffff]
+            off = len(strings)
+            strings.extend(b)
+            return len(b), off
+
+        for vid in sorted(vendors):
+            name, products = vendors[vid]
+            name_len, name_off = add_string(name)
+            vendor_table += self.vendor_record.pack(vid, name_len, name_off,
+                    product_count, len(products))
+
+            for pid in sorted(products):
+                name_len, name_off = add_string(products[pid])
+                product_table += self.product_record.pack(pid, name_len, name_off)
+                product_count += 1
+
+        vendors_offset = self.header.size
+        products_offset = vendors_offset + len(vendor_table)
+        strings_offset = products_offset + len(product_table)
+
+        head = self.header.pack(self.magic, self.version, st.st_mtime_ns,
+                st.st_size, self.source_digest(),
+                len(vendors), vendors_offset,
+                product_count, products_offset,
+                strings_offset, len(strings))
+
+        return bytes(head + vendor_table + product_table + strings)
+
+    def get_string(self, name_len, name_off):
+        start = self.strings_offset + name_off
+        return bytes(self.data[start:start + name_len]).decode("latin-1")
+
+    def find_vendor(self, vid):
+        lo = 0
+        hi = self.vendor_count
+        rec = self.vendor_record
+
+        while lo < hi:
+            mid = (lo + hi) // 2
+            r = rec.unpack_from(self.data, self.vendors_offset + mid * rec.size)
+            if r[0] < vid:
+                lo = mid + 1
+            elif r[0] > vid:
+                hi = mid
+            else:
+                return r
+
+        return None
+
+    def find_product(self, vendor, pid):
+        lo = vendor[3]
+        hi = lo + vendor[4]
+        rec = self.product_record
+
+        while lo < hi:
+            mid = (lo + hi) // 2
+            r = rec.unpack_from(self.data, self.products_offset + mid * rec.size)
+            if r[0] < pid:
+                lo = mid + 1
+            elif r[0] > pid:
+                hi = mid
+            else:
+                return r
+
+        return None
+
+    def vendor_name(self, vid):
+        v = self.find_vendor(vid)
+        if v is None:
+            return None
+
+        return self.get_string(v[1], v[2])
+
+    def lookup(self, vid, pid=None):
+        """Return (vendor name, product name); either is None when usb.ids
+        does not list it."""
+
+        v = self.find_vendor(vid)
+        if v is None:
+            return (None, None)
+
+        vendor = self.get_string(v[1], v[2])
+        if pid is None:
+            return (vendor, None)
+
+        p = self.find_product(v, pid)
+        if p is None:
+            return (vendor, None)
+
+        return (vendor, self.get_string(p[1], p[2]))